@@ -0,0 +1,326 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+# Time-to-first-frame benchmark of the decoder path.
+#
+# Runs the real DecoderClient -> bin/telescreen --decode -> Decoder path
+# for every media type against locally generated media, optionally under
+# a private Xvfb server.  Records time from spawn to the ready, prepared,
+# playing and rendered events together with decoder RSS and CPU usage.
+# Results are written as JSON so that runs can be compared.
+
+from getopt import gnu_getopt
+from os.path import dirname, abspath, join
+from platform import python_version
+from subprocess import Popen, check_call, DEVNULL
+from tempfile import mkdtemp
+from time import perf_counter, sleep, time
+from sys import argv, path, exit
+from shutil import rmtree
+
+import os
+import simplejson
+
+ROOT = dirname(dirname(abspath(__file__)))
+path.insert(0, ROOT)
+
+# Decoder executable we are measuring.
+TELESCREEN = join(ROOT, 'bin', 'telescreen')
+
+# Media types to measure by default.
+MEDIA = ['image', 'video', 'stream']
+
+# How many times to launch the decoder for every media type.
+REPEAT = 5
+
+# How long to keep the decoder playing after the first frame.
+SETTLE = 2.0
+
+# How long to wait for a decoder before giving up on it.
+TIMEOUT = 30.0
+
+# Encoders to try when generating the test video, in order.
+ENCODERS = [
+    ('x264enc', 'x264enc tune=zerolatency ! h264parse ! mp4mux', 'mp4'),
+    ('vp8enc', 'vp8enc deadline=1 ! webmmux', 'webm'),
+    ('theoraenc', 'theoraenc ! oggmux', 'ogv'),
+]
+
+# Clock ticks per second for the CPU times in /proc.
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def start_xvfb(display):
+    """
+    Start a private X server and point Gtk to it.
+    """
+
+    server = Popen(['Xvfb', display, '-screen', '0', '1280x720x24',
+                    '-nolisten', 'tcp'], stdout=DEVNULL, stderr=DEVNULL)
+    os.environ['DISPLAY'] = display
+
+    # Give the server a moment to start accepting clients.
+    sleep(1)
+    return server
+
+
+def make_media(workdir, Gst):
+    """
+    Generate test image and video using videotestsrc.
+    """
+
+    image = join(workdir, 'image.jpg')
+    check_call(['gst-launch-1.0', '-q', 'videotestsrc', 'num-buffers=1',
+                '!', 'video/x-raw,width=1920,height=1080',
+                '!', 'jpegenc', '!', 'filesink', 'location=' + image])
+
+    for factory, encoder, suffix in ENCODERS:
+        if Gst.ElementFactory.find(factory) is not None:
+            break
+    else:
+        raise RuntimeError('No usable video encoder found.')
+
+    video = join(workdir, 'video.' + suffix)
+    check_call(['gst-launch-1.0', '-q', '-e',
+                'videotestsrc', 'num-buffers=750', '!',
+                'video/x-raw,width=1280,height=720,framerate=25/1', '!'] +
+               encoder.split() +
+               ['!', 'filesink', 'location=' + video])
+
+    return image, video
+
+
+def process_stats(pid):
+    """
+    Return resident memory in bytes and consumed CPU time in seconds.
+    """
+
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fp:
+            fields = fp.read().rsplit(')', 1)[1].split()
+
+        with open('/proc/{}/status'.format(pid)) as fp:
+            rss = 0
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+
+    except OSError:
+        return None, None
+
+    # utime and stime are 14th and 15th fields, we dropped first two.
+    cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK
+    return rss, cpu
+
+
+def bench(media, repeat, workdir):
+    """
+    Run the benchmark inside the Gtk / Twisted reactor.
+    """
+
+    import gi
+    gi.require_version('Gtk', '3.0')
+    gi.require_version('Gdk', '3.0')
+    gi.require_version('Gst', '1.0')
+
+    from twisted.internet import gireactor
+    gireactor.install(useGtk=True)
+
+    from twisted.internet import reactor
+    from twisted.internet.defer import Deferred, inlineCallbacks
+    from twisted.web.server import Site
+    from twisted.web.static import File
+
+    from gi.repository import Gtk
+    from gi.repository import Gst
+    Gst.init([])
+
+    from telescreen.decoder.client import DecoderClient
+    from telescreen import common
+
+    # Plain X11 servers such as Xvfb do not offer XVideo.
+    common.video_sink = 'ximagesink'
+
+    image, video = make_media(workdir, Gst)
+
+    # Serve the video over HTTP to emulate streams.
+    port = reactor.listenTCP(0, Site(File(workdir)), interface='127.0.0.1')
+    stream = 'http://127.0.0.1:{}/{}'.format(port.getHost().port,
+                                             video.rsplit('/', 1)[1])
+
+    urls = {
+        'image': 'file://' + image,
+        'video': 'file://' + video,
+        'stream': stream,
+    }
+
+    window = Gtk.Window(title='Telescreen Benchmark')
+    stage = Gtk.DrawingArea()
+    stage.set_double_buffered(False)
+    window.add(stage)
+    window.set_default_size(1280, 720)
+    window.show_all()
+
+    class TimedDecoder (DecoderClient):
+        def __init__(self, xid, media, url):
+            self.t0 = perf_counter()
+            self.times = {}
+            self.stats = {}
+            self.done = Deferred()
+            self.timeout = reactor.callLater(TIMEOUT, self.finish)
+            super().__init__(xid, media, url, executable=TELESCREEN)
+            self.prepare()
+
+        def mark(self, event):
+            if event not in self.times:
+                self.times[event] = perf_counter() - self.t0
+
+        def on_ready(self):
+            self.mark('ready')
+
+        def on_prepared(self):
+            self.mark('prepared')
+            self.play()
+
+        def on_playing(self):
+            self.mark('playing')
+
+        def on_rendered(self):
+            self.mark('rendered')
+            self.rss, self.cpu = process_stats(self.transport.pid)
+            self.t1 = perf_counter()
+
+            self.timeout.cancel()
+            self.timeout = reactor.callLater(SETTLE, self.finish)
+
+        def finish(self):
+            if self.transport.pid is None:
+                return
+
+            rss, cpu = process_stats(self.transport.pid)
+
+            self.stats['rss'] = rss
+            self.stats['cpu_total'] = cpu
+
+            if 'rendered' in self.times and cpu is not None:
+                self.stats['rss_first_frame'] = self.rss
+                self.stats['cpu_first_frame'] = self.cpu
+                self.stats['cpu_playing'] = \
+                    (cpu - self.cpu) / (perf_counter() - self.t1)
+
+            self.stop()
+
+        def processEnded(self, status):
+            super().processEnded(status)
+
+            if self.timeout.active():
+                self.timeout.cancel()
+
+            self.done.callback({'events': self.times, 'process': self.stats})
+
+    results = []
+
+    @inlineCallbacks
+    def run():
+        try:
+            xid = stage.get_window().get_xid()
+
+            for kind in media:
+                for i in range(repeat):
+                    print('Measuring {} decoder, run {}...'.format(kind, i))
+                    decoder = TimedDecoder(xid, kind, urls[kind])
+                    result = yield decoder.done
+                    result.update({'media': kind, 'run': i})
+                    results.append(result)
+
+        finally:
+            reactor.stop()
+
+    reactor.callLater(0.5, run)
+    reactor.run()
+
+    return results
+
+
+def summarize(results):
+    """
+    Return median event times per media type.
+    """
+
+    summary = {}
+
+    for result in results:
+        events = summary.setdefault(result['media'], {})
+        for event, value in result['events'].items():
+            events.setdefault(event, []).append(value)
+
+    for events in summary.values():
+        for event, values in events.items():
+            values.sort()
+            events[event] = values[len(values) // 2]
+
+    return summary
+
+
+def do_help():
+    print('Usage: bench/decoder.py [--xvfb] [--output=file.json]')
+    print('Measure time to first frame of the media decoders.')
+    print('')
+    print('OPTIONS:')
+    print('  --help, -h             Display this help.')
+    print('  --media, -m list       Comma-separated media types to measure.')
+    print('  --repeat, -r count     How many times to launch each decoder.')
+    print('  --xvfb, -x             Run under a private Xvfb server.')
+    print('  --output, -o file      Where to write the JSON results.')
+
+
+def main():
+    longopts = ['help', 'media=', 'repeat=', 'xvfb', 'output=']
+    opts, args = gnu_getopt(argv, 'hm:r:xo:', longopts)
+
+    media = MEDIA
+    repeat = REPEAT
+    xvfb = False
+    output = 'bench-decoder.json'
+
+    for k, v in opts:
+        if k in ('--help', '-h'):
+            do_help()
+            exit(0)
+        elif k in ('--media', '-m'):
+            media = v.split(',')
+        elif k in ('--repeat', '-r'):
+            repeat = int(v)
+        elif k in ('--xvfb', '-x'):
+            xvfb = True
+        elif k in ('--output', '-o'):
+            output = v
+
+    server = start_xvfb(':{}'.format(90 + os.getpid() % 100)) \
+             if xvfb else None
+    workdir = mkdtemp(prefix='telescreen-bench-')
+
+    try:
+        results = bench(media, repeat, workdir)
+    finally:
+        rmtree(workdir)
+
+        if server is not None:
+            server.terminate()
+
+    with open(output, 'w') as fp:
+        simplejson.dump({
+            'benchmark': 'decoder',
+            'time': time(),
+            'python': python_version(),
+            'summary': summarize(results),
+            'results': results,
+        }, fp, indent=2)
+
+    print('Results written to {}.'.format(output))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,490 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+# Leader simulator and 0MQ load generator.
+#
+# Binds a ROUTER socket as a stand-in Indoktrinator leader and lets it
+# talk to emulated screen identities (bare 0MQ sockets sending status
+# storms) and to headless telescreen Manager instances (the real Router
+# and Manager stack with stub items).  The leader pushes plan churn and
+# malformed messages.  Message throughput, validation latency and
+# reactor stalls are written as JSON so that runs can be compared.
+
+# Use GObject-Introspection versions the manager expects.
+import gi
+gi.require_version('Gtk', '3.0')
+gi.require_version('Gdk', '3.0')
+gi.require_version('WebKit2', '4.0')
+gi.require_version('Gst', '1.0')
+gi.require_version('GstController', '1.0')
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from getopt import gnu_getopt
+from os.path import dirname, abspath
+from platform import python_version
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter, time
+from sys import argv, path, exit
+from uuid import uuid4
+
+import simplejson
+import zmq
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+from telescreen.journal import Journal
+from telescreen.manager import Manager
+from telescreen.tzmq import Router
+
+
+# Endpoint the simulated leader binds to.
+ENDPOINT = 'tcp://127.0.0.1:5901'
+
+# Interval of the reactor lag probe.
+PROBE_INTERVAL = 0.05
+
+
+class Histogram:
+    """
+    Collects samples and summarizes them.
+    """
+
+    def __init__(self):
+        self.samples = []
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def summary(self):
+        values = sorted(self.samples)
+
+        if not values:
+            return {'count': 0}
+
+        return {
+            'count': len(values),
+            'mean': sum(values) / len(values),
+            'p50': values[len(values) // 2],
+            'p99': values[min(len(values) - 1, len(values) * 99 // 100)],
+            'max': values[-1],
+        }
+
+
+class HeadlessWeb:
+    def status(self):
+        return {}
+
+
+class HeadlessScreen:
+    """
+    Screen stand-in for the managers.
+    """
+
+    def __init__(self):
+        self.layout = {'mode': 'full'}
+        self.web = HeadlessWeb()
+
+    def set_layout(self, layout):
+        self.layout = layout
+
+
+class StubItem:
+    def __init__(self, url, zone='main'):
+        self.url = url
+        self.zone = zone
+
+    def prepare(self, screen):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+STUB_ITEMS = {'video': StubItem, 'image': StubItem, 'stream': StubItem}
+
+
+def make_plan(rng, size, now):
+    """
+    Generate a plan message with the given number of items.
+    """
+
+    types = ('video', 'image', 'stream')
+    items = []
+
+    for i in range(size):
+        items.append({
+            'start': now + i * 10,
+            'end': now + (i + 1) * 10,
+            'type': rng.choice(types),
+            'url': 'http://media.example.com/{}.mkv'.format(uuid4().hex),
+        })
+
+    return {
+        'id': uuid4().hex,
+        'type': 'plan',
+        'plan': {
+            'id': uuid4().hex,
+            'items': items,
+            'layouts': [{
+                'start': now,
+                'end': now + size * 10,
+                'mode': rng.choice(('full', 'sidebar', 'panel')),
+                'sidebar': None,
+                'panel': None,
+            }],
+            'power': [],
+        },
+    }
+
+
+def make_malformed(rng, now):
+    """
+    Return raw message frames that the screens should reject.
+    """
+
+    valid = simplejson.dumps({'id': uuid4().hex, 'type': 'plan',
+                              'plan': {'id': uuid4().hex}})
+    stamp = str(int(now)).encode('utf-8')
+
+    return rng.choice([
+        # Not a JSON at all.
+        [b'\xff\x00garbage', stamp],
+        # JSON, but not an object.
+        [b'[1, 2, 3]', stamp],
+        # Object failing the schema.
+        [valid.encode('utf-8'), stamp],
+        # Unknown message type.
+        [b'{"id": "00", "type": "bogus"}', stamp],
+        # Stale message that should be dropped.
+        [b'{}', str(int(now) - 3600).encode('utf-8')],
+        # Missing timestamp frame.
+        [b'{}'],
+    ])
+
+
+class Leader:
+    """
+    Stand-in leader tracking screens and pushing plans to them.
+    """
+
+    def __init__(self, endpoint, rng, plan_size, malformed):
+        self.rng = rng
+        self.plan_size = plan_size
+        self.malformed = malformed
+
+        self.router = Router(identity='leader')
+        self.router.bind(endpoint)
+        self.router.on_message = self.on_message
+
+        self.peers = set()
+        self.received = 0
+        self.sent = 0
+        self.sent_malformed = 0
+
+    def on_message(self, message, sender):
+        self.received += 1
+        self.peers.add(sender)
+
+        if isinstance(message, dict) and message.get('type') == 'ping':
+            # Show the screen we are alive.
+            self.router.send({
+                'id': uuid4().hex,
+                'type': 'pong',
+                'pong': message['ping'],
+            }, sender)
+
+        if isinstance(message, dict) and message.get('type') == 'journal':
+            # Acknowledge proof-of-play records right away.
+            self.router.send({
+                'id': uuid4().hex,
+                'type': 'journal',
+                'journal': {'ack': message['journal']['last']},
+            }, sender)
+
+    def churn(self):
+        """
+        Push a new plan, or occasionally garbage, to every known peer.
+        """
+
+        now = time()
+
+        for peer in list(self.peers):
+            if self.rng.random() < self.malformed:
+                frames = make_malformed(self.rng, now)
+                self.router.send_frames(peer, frames)
+                self.sent_malformed += 1
+            else:
+                self.router.send(make_plan(self.rng, self.plan_size, now),
+                                 peer)
+                self.sent += 1
+
+
+class Identities:
+    """
+    Thousands of bare screen identities sending status messages.
+    """
+
+    def __init__(self, endpoint, count):
+        self.sockets = []
+        self.poller = zmq.Poller()
+        self.received = 0
+        self.sent = 0
+
+        for i in range(count):
+            socket = zmq.Context.instance().socket(zmq.ROUTER)
+            socket.setsockopt_string(zmq.IDENTITY, 'sim-{:06d}'.format(i))
+            socket.connect(endpoint)
+            self.poller.register(socket, zmq.POLLIN)
+            self.sockets.append(socket)
+
+    def storm(self):
+        """
+        Send a status message from every identity.
+        """
+
+        stamp = str(int(time())).encode('utf-8')
+
+        for socket in self.sockets:
+            payload = simplejson.dumps({
+                'id': uuid4().hex,
+                'type': 'status',
+                'status': {'plan': '0' * 32, 'power': 'unknown'},
+            }).encode('utf-8')
+
+            try:
+                socket.send_multipart([b'leader', payload, stamp],
+                                      zmq.NOBLOCK)
+                self.sent += 1
+            except zmq.ZMQError:
+                pass
+
+    def drain(self):
+        """
+        Receive and count everything the leader sent us.
+        """
+
+        for socket, event in self.poller.poll(0):
+            while True:
+                try:
+                    socket.recv_multipart(zmq.NOBLOCK)
+                    self.received += 1
+                except zmq.ZMQError:
+                    break
+
+    def close(self):
+        for socket in self.sockets:
+            socket.close(linger=0)
+
+
+class Screens:
+    """
+    Headless Manager instances with their own Routers.
+    """
+
+    def __init__(self, endpoint, count):
+        self.managers = []
+        self.validation = Histogram()
+        self.handling = Histogram()
+        self.workdir = mkdtemp(prefix='telescreen-bench-')
+
+        for i in range(count):
+            router = Router('mgr-{:06d}'.format(i), default_recipient='leader')
+            router.connect(endpoint)
+
+            manager = Manager(router, HeadlessScreen(), None)
+            manager.item_scheduler.item_types = STUB_ITEMS
+            manager.journal = Journal('{}/journal-{:06d}'
+                                      .format(self.workdir, i))
+            router.on_message = self.timed(manager.on_message,
+                                           self.validation)
+            manager.on_plan = self.timed(manager.on_plan, self.handling)
+
+            self.managers.append(manager)
+
+    def timed(self, fn, histogram):
+        def wrapper(*args):
+            t = perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                histogram.add(perf_counter() - t)
+
+        return wrapper
+
+    def start(self):
+        for manager in self.managers:
+            manager.start()
+
+    def storm(self):
+        for manager in self.managers:
+            manager.send_status()
+
+    def routers(self):
+        totals = {}
+
+        for manager in self.managers:
+            for key, value in manager.router.status().items():
+                if key in ('max_depth', 'depth'):
+                    totals[key] = max(totals.get(key, 0), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+
+        return totals
+
+
+class LagProbe:
+    """
+    Measures how late the reactor runs a periodic call.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lag = Histogram()
+        self.last = None
+        self.loop = LoopingCall(self.tick)
+
+    def start(self):
+        self.last = perf_counter()
+        self.loop.start(self.interval, now=False)
+
+    def tick(self):
+        now = perf_counter()
+        self.lag.add(max(now - self.last - self.interval, 0))
+        self.last = now
+
+
+def do_help():
+    print('Usage: bench/leader.py [--identities=1000] [--managers=10]')
+    print('Simulate a leader talking to many screens over 0MQ.')
+    print('')
+    print('OPTIONS:')
+    print('  --help, -h             Display this help.')
+    print('  --endpoint, -e url     Endpoint for the leader to bind.')
+    print('  --identities, -i N     Number of bare screen identities.')
+    print('  --managers, -m N       Number of headless Manager instances.')
+    print('  --duration, -t secs    How long to run the simulation.')
+    print('  --churn, -c secs       Interval between plan pushes.')
+    print('  --storm, -s secs       Interval between status storms.')
+    print('  --plan-size, -p N      Number of items in every plan.')
+    print('  --malformed, -M ratio  Ratio of malformed messages pushed.')
+    print('  --seed, -S number      Seed of the random generator.')
+    print('  --output, -o file      Where to write the JSON results.')
+
+
+def main():
+    longopts = ['help', 'endpoint=', 'identities=', 'managers=',
+                'duration=', 'churn=', 'storm=', 'plan-size=',
+                'malformed=', 'seed=', 'output=']
+    opts, args = gnu_getopt(argv, 'he:i:m:t:c:s:p:M:S:o:', longopts)
+
+    config = {
+        'endpoint': ENDPOINT,
+        'identities': 1000,
+        'managers': 10,
+        'duration': 60.0,
+        'churn': 5.0,
+        'storm': 1.0,
+        'plan_size': 100,
+        'malformed': 0.1,
+        'seed': 0,
+    }
+    output = 'bench-leader.json'
+
+    for k, v in opts:
+        if k in ('--help', '-h'):
+            do_help()
+            exit(0)
+        elif k in ('--endpoint', '-e'):
+            config['endpoint'] = v
+        elif k in ('--identities', '-i'):
+            config['identities'] = int(v)
+        elif k in ('--managers', '-m'):
+            config['managers'] = int(v)
+        elif k in ('--duration', '-t'):
+            config['duration'] = float(v)
+        elif k in ('--churn', '-c'):
+            config['churn'] = float(v)
+        elif k in ('--storm', '-s'):
+            config['storm'] = float(v)
+        elif k in ('--plan-size', '-p'):
+            config['plan_size'] = int(v)
+        elif k in ('--malformed', '-M'):
+            config['malformed'] = float(v)
+        elif k in ('--seed', '-S'):
+            config['seed'] = int(v)
+        elif k in ('--output', '-o'):
+            output = v
+
+    rng = Random(config['seed'])
+
+    leader = Leader(config['endpoint'], rng, config['plan_size'],
+                    config['malformed'])
+    identities = Identities(config['endpoint'], config['identities'])
+    screens = Screens(config['endpoint'], config['managers'])
+    probe = LagProbe(PROBE_INTERVAL)
+
+    loops = [
+        (LoopingCall(identities.storm), config['storm']),
+        (LoopingCall(screens.storm), config['storm']),
+        (LoopingCall(identities.drain), 0.01),
+        (LoopingCall(leader.churn), config['churn']),
+    ]
+
+    def start():
+        screens.start()
+        probe.start()
+
+        for loop, interval in loops:
+            loop.start(interval, now=False)
+
+    reactor.callLater(0, start)
+    reactor.callLater(config['duration'], reactor.stop)
+
+    print('Running simulation for {} seconds...'.format(config['duration']))
+    t = perf_counter()
+    reactor.run()
+    elapsed = perf_counter() - t
+
+    identities.close()
+    rmtree(screens.workdir)
+
+    with open(output, 'w') as fp:
+        simplejson.dump({
+            'benchmark': 'leader',
+            'time': time(),
+            'python': python_version(),
+            'config': config,
+            'elapsed': elapsed,
+            'leader': {
+                'peers': len(leader.peers),
+                'received': leader.received,
+                'received_per_second': leader.received / elapsed,
+                'sent': leader.sent,
+                'sent_malformed': leader.sent_malformed,
+            },
+            'identities': {
+                'sent': identities.sent,
+                'received': identities.received,
+            },
+            'managers': {
+                'validation': screens.validation.summary(),
+                'plan_handling': screens.handling.summary(),
+                'routers': screens.routers(),
+            },
+            'reactor_lag': probe.lag.summary(),
+        }, fp, indent=2)
+
+    print('Results written to {}.'.format(output))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,384 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+# Scheduler benchmark driven by a virtual clock.
+#
+# Replays synthetic plans of various sizes through the item, layout and
+# power schedulers with a headless screen and records plan installation
+# latency, memory, number of pending timers and start time accuracy.
+# Memory of the plan as received (lists of dicts) is compared with the
+# compact plan store the schedulers keep and with a loop rule playing
+# the same kind of content, which does not grow with the plan length.
+# Results are written as JSON so that runs can be compared.
+
+# Use GObject-Introspection versions the schedulers expect.
+import gi
+gi.require_version('Gtk', '3.0')
+gi.require_version('Gdk', '3.0')
+gi.require_version('WebKit2', '4.0')
+gi.require_version('Gst', '1.0')
+gi.require_version('GstController', '1.0')
+
+from twisted.internet.task import Clock
+
+from getopt import gnu_getopt
+from os.path import dirname, abspath
+from platform import python_version
+from time import perf_counter, time
+from sys import argv, path, exit
+
+import simplejson
+import tracemalloc
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+from telescreen.scheduler import ItemScheduler, LayoutScheduler, \
+                                 PowerScheduler, plan_window, pop_queue_tasks
+from telescreen.plan import Plan, PlanQueue
+
+
+# Sizes of the plans to replay by default.
+SIZES = [10, 100, 1000, 10000, 100000]
+
+# Length of every synthetic item in seconds.
+ITEM_DURATION = 10
+
+# How long to replay the plan on the virtual clock, in seconds.
+HORIZON = 900
+
+# Fixed virtual time the benchmark starts at, so that runs are comparable.
+EPOCH = 1500000000
+
+
+class HeadlessScreen:
+    """
+    Screen stand-in that only counts layout changes.
+    """
+
+    def __init__(self):
+        self.layout = {'mode': 'full'}
+        self.layout_changes = 0
+
+    def set_layout(self, layout):
+        if self.layout != layout:
+            self.layout = layout
+            self.layout_changes += 1
+
+
+class Recorder:
+    """
+    Collects what the stub items were asked to do.
+    """
+
+    def __init__(self, clock, starts):
+        self.clock = clock
+        self.starts = starts
+        self.prepared = 0
+        self.started = 0
+        self.stopped = 0
+        self.lateness = []
+        self.lead = []
+
+    def item_types(self):
+        recorder = self
+
+        class StubItem:
+            def __init__(self, url, zone='main'):
+                self.url = url
+                self.zone = zone
+                self.prepared_at = None
+
+            def prepare(self, screen):
+                recorder.prepared += 1
+                self.prepared_at = recorder.clock.seconds()
+
+            def start(self):
+                now = recorder.clock.seconds()
+                recorder.started += 1
+                recorder.lateness.append(now - recorder.starts[self.url])
+                recorder.lead.append(now - self.prepared_at)
+
+            def stop(self):
+                recorder.stopped += 1
+
+        return {'video': StubItem, 'image': StubItem, 'stream': StubItem}
+
+
+def synthetic_plan(size, t0):
+    """
+    Generate a plan with the given number of back-to-back items.
+    """
+
+    types = ('video', 'image', 'stream')
+    items = []
+
+    for i in range(size):
+        items.append({
+            'start': t0 + i * ITEM_DURATION,
+            'end': t0 + (i + 1) * ITEM_DURATION,
+            'type': types[i % len(types)],
+            'url': 'http://media.example.com/content/{:08d}.mkv'.format(i),
+        })
+
+    span = size * ITEM_DURATION
+    modes = ('full', 'sidebar', 'panel')
+    layouts = []
+
+    for i in range(span // 300 + 1):
+        layouts.append({
+            'start': t0 + i * 300,
+            'end': t0 + (i + 1) * 300,
+            'mode': modes[i % len(modes)],
+            'sidebar': 'http://web.example.com/sidebar',
+            'panel': 'http://web.example.com/panel',
+        })
+
+    power = []
+
+    for day in range(span // 86400 + 1):
+        midnight = t0 + day * 86400
+        power.append({'start': midnight + 7 * 3600,
+                      'end': midnight + 22 * 3600,
+                      'power': 'on'})
+        power.append({'start': midnight + 22 * 3600,
+                      'end': midnight + 31 * 3600,
+                      'power': 'standby'})
+
+    return {'items': items, 'layouts': layouts, 'power': power}
+
+
+def synthetic_loop(t0):
+    """
+    Generate a loop rule with a short playlist playing all day long.
+    """
+
+    types = ('video', 'image', 'stream')
+
+    return {
+        'start': t0,
+        'days': list(range(7)),
+        'from': 0,
+        'to': 86400,
+        'items': [{
+            'type': types[i % len(types)],
+            'url': 'http://media.example.com/content/{:08d}.mkv'.format(i),
+            'duration': ITEM_DURATION,
+        } for i in range(12)],
+    }
+
+
+def copy_plan(plan, shift=0):
+    return {k: [dict(t, start=t['start'] + shift, end=t['end'] + shift)
+                for t in v] for k, v in plan.items()}
+
+
+def timed(fn, *args):
+    t = perf_counter()
+    fn(*args)
+    return perf_counter() - t
+
+
+def summarize(values):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'min': values[0],
+        'p50': values[len(values) // 2],
+        'p99': values[min(len(values) - 1, len(values) * 99 // 100)],
+        'max': values[-1],
+    }
+
+
+def replay(clock, until):
+    """
+    Advance the clock event by event, returning the peak timer count.
+    """
+
+    peak = 0
+
+    while True:
+        calls = clock.getDelayedCalls()
+        peak = max(peak, len(calls))
+
+        if not calls:
+            break
+
+        due = min(call.getTime() for call in calls)
+        if due > until:
+            break
+
+        clock.advance(max(due - clock.seconds(), 0))
+
+    clock.advance(max(until - clock.seconds(), 0))
+    return peak
+
+
+def run(size, horizon):
+    clock = Clock()
+    clock.advance(EPOCH)
+
+    tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    plan = synthetic_plan(size, EPOCH + 1)
+    plan_bytes = tracemalloc.get_traced_memory()[0] - before
+
+    # The same plan packed into the store, once the dicts are gone.
+    before = tracemalloc.get_traced_memory()[0]
+    store = {k: Plan(v) for k, v in synthetic_plan(size, EPOCH + 1).items()}
+    store_bytes = tracemalloc.get_traced_memory()[0] - before
+    del store
+
+    # A loop rule does not depend on the size at all.
+    before = tracemalloc.get_traced_memory()[0]
+    looped = Plan([], [synthetic_loop(EPOCH + 1)])
+    loop_bytes = tracemalloc.get_traced_memory()[0] - before
+
+    starts = {item['url']: item['start'] for item in plan['items']}
+    recorder = Recorder(clock, starts)
+    screen = HeadlessScreen()
+
+    items = ItemScheduler(screen, recorder.item_types(), clock=clock)
+    layouts = LayoutScheduler(screen, clock=clock)
+    power = PowerScheduler(None, clock=clock)
+
+    schedulers = (('items', items), ('layouts', layouts), ('power', power))
+
+    for name, scheduler in schedulers:
+        scheduler.start()
+
+    # Install the plan for the first time.  Schedulers keep the copy,
+    # so it counts towards their memory.
+    before = tracemalloc.get_traced_memory()[0]
+    fresh = copy_plan(plan)
+    install = {}
+
+    for name, scheduler in schedulers:
+        install[name] = timed(scheduler.change_plan, fresh[name])
+
+    del fresh
+    scheduler_bytes = tracemalloc.get_traced_memory()[0] - before
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del plan
+
+    timers = len(clock.getDelayedCalls())
+
+    # Re-install the very same plan, which only adjusts the schedule.
+    plan = synthetic_plan(size, EPOCH + 1)
+    fresh = copy_plan(plan)
+    adjust = {}
+
+    for name, scheduler in schedulers:
+        adjust[name] = timed(scheduler.change_plan, fresh[name])
+
+    # Helpers used by the schedulers on their own.
+    now = clock.seconds()
+    store = Plan(plan['items'])
+    helpers = {
+        'plan_store': timed(Plan, plan['items']),
+        'plan_window': timed(plan_window, store, now, now + 60),
+        'pop_queue_tasks': timed(pop_queue_tasks, PlanQueue(store), 60, now),
+        'pop_loop_tasks': timed(pop_queue_tasks, PlanQueue(looped), 60, now),
+    }
+
+    # Let the plan play for a while.
+    t = perf_counter()
+    peak_timers = replay(clock, EPOCH + horizon)
+    replay_time = perf_counter() - t
+
+    # Finally install a shifted plan, which resets the schedule.
+    shifted = copy_plan(plan, ITEM_DURATION / 2)
+    starts.update({item['url']: item['start'] for item in shifted['items']})
+    reset = {}
+
+    for name, scheduler in schedulers:
+        reset[name] = timed(scheduler.change_plan, shifted[name])
+
+    return {
+        'size': size,
+        'change_plan': {
+            'install': install,
+            'adjust': adjust,
+            'reset': reset,
+        },
+        'helpers': helpers,
+        'memory': {
+            'plan': plan_bytes,
+            'store': store_bytes,
+            'loop': loop_bytes,
+            'reduction': 1 - store_bytes / plan_bytes if plan_bytes else 0,
+            'schedulers': scheduler_bytes,
+            'peak': peak_bytes,
+        },
+        'timers': {
+            'after_install': timers,
+            'peak': peak_timers,
+        },
+        'replay': {
+            'horizon': horizon,
+            'wall_time': replay_time,
+            'prepared': recorder.prepared,
+            'started': recorder.started,
+            'stopped': recorder.stopped,
+            'layout_changes': screen.layout_changes,
+            'lateness': summarize(recorder.lateness),
+            'preroll_lead': summarize(recorder.lead),
+        },
+    }
+
+
+def do_help():
+    print('Usage: bench/scheduler.py [--sizes=10,100] [--output=file.json]')
+    print('Replay synthetic plans through the schedulers on a virtual clock.')
+    print('')
+    print('OPTIONS:')
+    print('  --help, -h             Display this help.')
+    print('  --sizes, -s list       Comma-separated plan sizes to replay.')
+    print('  --horizon, -H secs     How long to replay every plan.')
+    print('  --output, -o file      Where to write the JSON results.')
+
+
+def main():
+    longopts = ['help', 'sizes=', 'horizon=', 'output=']
+    opts, args = gnu_getopt(argv, 'hs:H:o:', longopts)
+
+    sizes = SIZES
+    horizon = HORIZON
+    output = 'bench-scheduler.json'
+
+    for k, v in opts:
+        if k in ('--help', '-h'):
+            do_help()
+            exit(0)
+        elif k in ('--sizes', '-s'):
+            sizes = [int(x) for x in v.split(',')]
+        elif k in ('--horizon', '-H'):
+            horizon = int(v)
+        elif k in ('--output', '-o'):
+            output = v
+
+    results = []
+
+    for size in sizes:
+        print('Replaying plan with {} items...'.format(size))
+        results.append(run(size, horizon))
+
+    with open(output, 'w') as fp:
+        simplejson.dump({
+            'benchmark': 'scheduler',
+            'time': time(),
+            'python': python_version(),
+            'results': results,
+        }, fp, indent=2)
+
+    print('Results written to {}.'.format(output))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set sw=4 ts=4 et:
@@ -4,14 +4,13 @@
 import os
 import re
 
-from time import time
 from twisted.internet.task import LoopingCall
-from twisted.python import log
+from twisted.internet.defer import Deferred
 from twisted.internet import reactor
 from twisted.python.procutils import which
 from twisted.internet.protocol import ProcessProtocol
 
-from telescreen.common import Logging
+from telescreen.common import Logging, ERROR
 
 __all__ = ['CEC']
 
@@ -24,29 +23,57 @@ CEC_POWER_STATUSES = {
     'unknown': 'unknown',
 }
 
+# Power status operands of the <Report Power Status> message.
+CEC_POWER_OPERANDS = {
+    0x00: 'on',
+    0x01: 'standby',
+    0x02: 'to-on',
+    0x03: 'to-standby',
+}
+
+# Opcodes sent by the TV that we are interested in.
+CEC_STANDBY = 0x36
+CEC_REPORT_POWER_STATUS = 0x90
+
+# Messages the TV sends when it wakes up or switches inputs.
+# They do not say much about the power status, so we ask for it.
+CEC_WAKE_HINTS = {0x80, 0x82, 0x84, 0x86}
+
+# Command line to run the cec-client with.  We want errors (1) and bus
+# traffic (8) so that we can follow the TV without polling it.
+CEC_CLIENT = ['cec-client', '-d', '9', '-t', 'p', '-o', 'Telescreen']
+
+# Minimal delay between two commands sent to the bus.
+MIN_INTERVAL = 1.0
+
+# How long to wait for a reply before giving up.
+REPLY_TIMEOUT = 5.0
+
+# How long to wait after a power change before checking the result.
+SETTLE_DELAY = 10.0
+
+# Interval of the fallback status query, in case we miss some traffic.
+WATCHDOG_INTERVAL = 300
+
 
 class CECProtocol(ProcessProtocol, Logging):
     def __init__(self, recipient):
         self.recipient = recipient
+        self.buffer = b''
 
     def connectionMade(self):
-        pass
+        self.buffer = b''
 
-    def set_active_source(self):
-        self.msg('Setting Telescreen as the active source...')
-        self.transport.write('as 0\n'.encode('utf-8'))
-
-    def set_power_status(self, status):
-        self.msg('Setting power status to {!r}...'.format(status))
-        self.transport.write('{} 0\n'.format(status).encode('utf-8'))
-
-    def query_power_status(self):
-        self.msg('Querying power status...')
-        self.transport.write('pow 0\n'.encode('utf-8'))
+    def send(self, command):
+        self.transport.write('{}\n'.format(command).encode('utf-8'))
 
     def outReceived(self, data):
-        for line in data.decode('utf8').strip().split('\n'):
-            self.lineReceived(line)
+        # Output may arrive in arbitrary chunks, keep the incomplete line.
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+
+        for line in lines:
+            self.lineReceived(line.decode('utf8', 'replace').strip())
 
     def lineReceived(self, line):
         try:
@@ -54,9 +81,14 @@ class CECProtocol(ProcessProtocol, Logging):
                 m = re.match('power status: (.*)', line)
                 self.recipient.on_power_status(m.group(1).strip())
 
+            elif line.startswith('TRAFFIC:') and '>>' in line:
+                m = re.search('>> ([0-9a-f]{2})((?::[0-9a-f]{2})*)', line)
+                frame = [int(x, 16) for x in m.group(2).split(':')[1:]]
+                self.recipient.on_frame(int(m.group(1), 16), frame)
+
             elif 'ERROR:' in line:
                 m = re.match('ERROR:.*\t(.*)', line)
-                self.msg('Error: {}'.format(m.group(1).strip()))
+                self.warn('Error: {}', m.group(1).strip())
 
         except AttributeError:
             # Some of the m.group() calls above have failed...
@@ -69,46 +101,296 @@ class CECProtocol(ProcessProtocol, Logging):
         return 'cec'
 
 
-class CEC(object):
+class CECCommand(object):
+    """
+    Command waiting in the queue, possibly expecting a reply.
+    """
+
+    def __init__(self, kind, line, reply=None):
+        self.kind = kind
+        self.line = line
+        self.reply = reply
+
+        # Deferreds of the callers waiting for the command.
+        self.waiting = []
+
+    def wait(self):
+        """
+        Return a new Deferred firing with the reply of the command.
+        """
+
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def finish(self, reply):
+        waiting, self.waiting = self.waiting, []
+
+        for d in waiting:
+            d.callback(reply)
+
+    def __repr__(self):
+        return 'CECCommand({!r})'.format(self.line)
+
+
+class CECQueue(Logging):
+    """
+    Rate-limited queue of commands for the CEC bus.
+
+    There is at most one command of every kind waiting in the queue.
+    Newer commands replace the older ones, so that redundant power and
+    active source changes never reach the bus.  Commands expecting a
+    reply block the queue until the reply arrives or times out.
+    """
+
+    # Kinds of commands in the order of their priority.
+    KINDS = ('power', 'source', 'query')
+
+    def __init__(self, send, clock=reactor):
+        self.send = send
+        self.clock = clock
+
+        self.pending = {}
+        self.inflight = None
+        self.timeout = None
+        self.wakeup = None
+        self.last_sent = 0.0
+
+        # Statistics for the status report.
+        self.sent = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def logPrefix(self):
+        return 'cec'
+
+    def put(self, kind, line, reply=None):
+        """
+        Enqueue a command, replacing older command of the same kind.
+
+        Returns a Deferred that fires with the reply (or None for
+        commands not expecting any) once the command is done.  Callers
+        of a replaced command get None right away, since their command
+        never reaches the bus.
+        """
+
+        if self.inflight is not None and self.inflight.line == line:
+            # The very same command is already waiting for a reply.
+            self.coalesced += 1
+            return self.inflight.wait()
+
+        old = self.pending.get(kind)
+
+        if old is not None:
+            self.coalesced += 1
+
+            if old.line == line:
+                return old.wait()
+
+            old.finish(None)
+
+        command = CECCommand(kind, line, reply)
+        d = command.wait()
+
+        self.pending[kind] = command
+        self.dispatch()
+
+        return d
+
+    def dispatch(self):
+        """
+        Send the next command if the bus is free.
+        """
+
+        if self.inflight is not None or not self.pending:
+            return
+
+        if self.wakeup is not None and self.wakeup.active():
+            return
+
+        delay = self.last_sent + MIN_INTERVAL - self.clock.seconds()
+        if delay > 0:
+            self.wakeup = self.clock.callLater(delay, self.dispatch)
+            return
+
+        kind = next(k for k in self.KINDS if k in self.pending)
+        command = self.pending.pop(kind)
+
+        self.send(command.line)
+        self.sent += 1
+        self.last_sent = self.clock.seconds()
+
+        if command.reply is None:
+            command.finish(None)
+            self.dispatch()
+        else:
+            self.inflight = command
+            self.timeout = self.clock.callLater(REPLY_TIMEOUT,
+                                                self.on_timeout)
+
+    def on_reply(self, kind, value):
+        """
+        Called when the client prints a reply to a command.
+        """
+
+        if self.inflight is None or self.inflight.reply != kind:
+            return
+
+        command, self.inflight = self.inflight, None
+        self.timeout.cancel()
+
+        command.finish(value)
+        self.dispatch()
+
+    def on_timeout(self):
+        command, self.inflight = self.inflight, None
+        self.timeouts += 1
+
+        self.warn('No reply to {!r}, moving on.', command)
+        command.finish(None)
+        self.dispatch()
+
+    def clear(self):
+        """
+        Forget all commands, the client have gone away.
+        """
+
+        if self.timeout is not None and self.timeout.active():
+            self.timeout.cancel()
+
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+
+        commands = list(self.pending.values())
+
+        if self.inflight is not None:
+            commands.append(self.inflight)
+
+        self.pending = {}
+        self.inflight = None
+
+        for command in commands:
+            command.finish(None)
+
+
+class CEC (Logging):
     """
     TV power control using HDMI sub-protocol CEC.
+
+    Follows the bus traffic printed by the ``cec-client`` to learn
+    about power status changes as they happen and only queries the TV
+    now and then to make sure we did not miss anything.
+
+    The client is started using the ``spawn`` function, with the
+    signature of ``reactor.spawnProcess``, so that it can be replaced
+    along with the clock.
     """
 
-    def __init__(self):
+    def __init__(self, command=CEC_CLIENT, clock=reactor, spawn=None):
+        self.command = command
+        self.clock = clock
+        self.spawn = spawn if spawn is not None else reactor.spawnProcess
         self.status = 'unknown'
-        self.last_retry = time()
+        self.last_retry = clock.seconds()
         self.protocol = CECProtocol(self)
+        self.queue = CECQueue(self.protocol.send, clock)
         self.status_loop = None
+        self.settle = None
+        self.closing = False
+
+    def logPrefix(self):
+        return 'cec'
 
     def start(self):
-        args = ['cec-client', '-d', '1', '-t', 'p', '-o', 'Telescreen']
-        reactor.spawnProcess(self.protocol, which('cec-client')[0], args)
+        executable = self.command[0]
+        if not os.path.isabs(executable):
+            executable = which(executable)[0]
+
+        self.spawn(self.protocol, executable, self.command)
         self.status_loop = LoopingCall(self.query_power_status)
-        self.status_loop.start(15)
+        self.status_loop.clock = self.clock
+        self.status_loop.start(WATCHDOG_INTERVAL)
+
+    def close(self):
+        self.closing = True
+
+        if self.status_loop is not None and self.status_loop.running:
+            self.status_loop.stop()
+
+        self.queue.clear()
+
+        if self.protocol.transport is not None:
+            self.protocol.send('q')
 
     def set_active_source(self):
-        self.protocol.set_active_source()
+        self.msg('Setting Telescreen as the active source...')
+        return self.queue.put('source', 'as 0')
 
     def set_power_status(self, status):
-        self.protocol.set_power_status(status)
+        self.msg('Setting power status to {!r}...', status)
+        d = self.queue.put('power', '{} 0'.format(status))
+
+        # Check the result once the TV had some time to react.
+        if self.settle is not None and self.settle.active():
+            self.settle.cancel()
+
+        self.settle = self.clock.callLater(SETTLE_DELAY,
+                                           self.query_power_status)
+        return d
 
     def query_power_status(self):
-        self.protocol.query_power_status()
+        return self.queue.put('query', 'pow 0', reply='power')
 
     def on_power_status(self, status):
+        self.update_status(CEC_POWER_STATUSES.get(status, 'unknown'))
+        self.queue.on_reply('power', self.status)
+
+    def on_frame(self, header, frame):
+        """
+        Called for every message received from the bus.
+        """
+
+        # Only consider messages sent by the TV.
+        if header >> 4 != 0 or not frame:
+            return
+
+        opcode = frame[0]
+
+        if opcode == CEC_REPORT_POWER_STATUS and len(frame) > 1:
+            self.update_status(CEC_POWER_OPERANDS.get(frame[1], 'unknown'))
+
+        elif opcode == CEC_STANDBY:
+            self.update_status('standby')
+
+        elif opcode in CEC_WAKE_HINTS:
+            self.query_power_status()
+
+    def update_status(self, status):
         prev_status = self.status
-        self.status = CEC_POWER_STATUSES.get(status, 'unknown')
+        self.status = status
 
         if self.status != prev_status:
-            log.msg('CEC power status changed: {!r}'.format(self.status))
+            self.msg('CEC power status changed: {!r}', self.status)
+            self.on_status_change(self.status)
+
+    def on_status_change(self, status):
+        """Method called when the display power status changes."""
+        pass
 
     def on_exit(self):
-        if (time() - self.last_retry) > 10:
-            self.status_loop.stop()
+        self.queue.clear()
+
+        if self.closing:
+            return
+
+        if (self.clock.seconds() - self.last_retry) > 10:
+            if self.status_loop.running:
+                self.status_loop.stop()
+
             self.start()
-            self.last_retry = time()
+            self.last_retry = self.clock.seconds()
         else:
-            log.msg('CEC process dying too often, exiting.')
+            self.log(ERROR, 'CEC process dying too often, exiting.')
             reactor.stop()
 
 # vim:set sw=4 ts=4 et:
@@ -1,10 +1,16 @@
 #!/usr/bin/python3 -tt
 # -*- coding: utf-8 -*-
 
+from twisted.python.failure import Failure
 from twisted.python import log
 
+from collections import deque
+from time import time
 
-__all__ = ['Logging', 'debug']
+
+__all__ = ['Logging', 'debug', 'video_sink', 'thumbnail_interval',
+           'engine', 'level', 'ring_level',
+           'DEBUG', 'INFO', 'WARNING', 'ERROR', 'LEVELS', 'recent']
 
 
 debug = False
@@ -12,16 +18,167 @@ debug = False
 Global debugging flag.
 """
 
+video_sink = 'xvimagesink'
+"""
+GStreamer element the decoders render video with.
+"""
+
+thumbnail_interval = None
+"""
+Seconds between two thumbnails taken by the decoders, None to disable.
+"""
+
+engine = 'decoder'
+"""
+Playback engine, either ``decoder`` processes per item or a single
+``compositor`` pipeline.
+"""
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+level = WARNING
+"""
+Minimal level of messages written to the Twisted log (stderr).
+"""
+
+ring_level = INFO
+"""
+Minimal level of messages kept in the in-memory ring buffer.
+"""
+
+# Number of messages kept in the ring buffer.
+RING_SIZE = 2000
+
+# Every message is written at most RATE_LIMIT times per RATE_WINDOW
+# seconds, the rest is only counted and reported later.
+RATE_LIMIT = 10
+RATE_WINDOW = 60
+
+ring = deque(maxlen=RING_SIZE)
+"""
+Recent messages as (time, level, system, text, args) tuples.
+Debug messages are only formatted when someone asks for them, the
+others are kept formatted, without any arguments.
+"""
+
+# Rate limiting state, (system, text) -> [window start, count].
+rates = {}
+
 
 class Logging:
+    """
+    Mixin for classes that log.
+
+    Messages are format strings with separate arguments, so that they
+    are only formatted when they are really going to be written.
+    """
+
     def logPrefix(self):
         return '-'
 
-    def msg(self, text, **kw):
-        return log.msg(text, system=self.logPrefix(), **kw)
+    def log(self, severity, text, *args):
+        if severity < ring_level and severity < level:
+            return
+
+        system = self.logPrefix()
+        message = None
+
+        # Arguments could change or pin a lot of memory until read,
+        # only the plentiful debug messages are worth keeping as such.
+        if severity > DEBUG:
+            message = format_message(text, args)
+
+        if severity >= ring_level:
+            if message is None:
+                ring.append((time(), severity, system, text, args))
+            else:
+                ring.append((time(), severity, system, message, ()))
+
+        if severity >= level and not limited(system, text):
+            if message is None:
+                message = format_message(text, args)
+
+            log.msg(message, system=system)
+
+    def debug(self, text, *args):
+        self.log(DEBUG, text, *args)
+
+    def msg(self, text, *args):
+        self.log(INFO, text, *args)
+
+    def warn(self, text, *args):
+        self.log(WARNING, text, *args)
+
+    def err(self, failure=None, why=None, **kw):
+        # Capture the exception being handled, as log.err() would.
+        if failure is None:
+            failure = Failure()
+
+        # Keep just the text, not the frames of the traceback.
+        message = str(failure)
+
+        if why is not None:
+            message = '{}: {}'.format(why, message)
+
+        ring.append((time(), ERROR, self.logPrefix(), message, ()))
+        return log.err(failure, why, system=self.logPrefix(), **kw)
+
+
+def format_message(text, args):
+    if not args:
+        return text
+
+    try:
+        return text.format(*args)
+    except Exception as e:
+        return '{} {!r} (failed to format: {})'.format(text, args, e)
+
+
+def limited(system, text):
+    """
+    Decide whether a message should be suppressed due to rate limiting.
+    """
+
+    now = time()
+    key = (system, text)
+    state = rates.get(key)
+
+    if state is None or state[0] + RATE_WINDOW < now:
+        if state is not None and state[1] > RATE_LIMIT:
+            log.msg('Suppressed {} more messages like {!r}.'
+                    .format(state[1] - RATE_LIMIT, text), system=system)
+
+        # Do not let the table grow forever with one-off messages.
+        if len(rates) > RING_SIZE:
+            rates.clear()
+
+        rates[key] = [now, 1]
+        return False
+
+    state[1] += 1
+    return state[1] > RATE_LIMIT
+
+
+def recent(minimum=DEBUG, limit=RING_SIZE):
+    """
+    Return recent messages from the ring buffer, formatted.
+    """
+
+    entries = [entry for entry in ring if entry[1] >= minimum]
 
-    def err(self, *args, **kw):
-        return log.err(*args, system=self.logPrefix(), **kw)
+    return [[ts, severity, system, format_message(text, args)]
+            for ts, severity, system, text, args in entries[-limit:]]
 
 
 # vim:set sw=4 ts=4 et:
@@ -0,0 +1,467 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from gi.repository import Gst
+from gi.repository import GstController
+
+from twisted.internet import reactor
+
+from threading import Lock
+from urllib.parse import quote
+from weakref import WeakKeyDictionary
+
+from telescreen.common import Logging
+from telescreen.screen import Item
+from telescreen import common
+
+
+__all__ = ['Compositor', 'CompositedVideoItem', 'CompositedImageItem',
+           'CompositedStreamItem', 'compositor_for']
+
+
+# Frames are composed in this size and scaled to the stage by the sink.
+OUTPUT_WIDTH = 1920
+OUTPUT_HEIGHT = 1080
+OUTPUT_FPS = 25
+
+# Length of the crossfades, in seconds.
+FADE = 1.0
+
+# Black background keeps the live pipeline running without any items.
+PIPELINE = '''
+    compositor name=video background=black
+    ! video/x-raw,width={width},height={height},framerate={fps}/1
+    ! videoconvert
+    ! {sink} name=sink
+    videotestsrc is-live=true pattern=black
+    ! video/x-raw,width={width},height={height},framerate={fps}/1
+    ! video.
+    audiomixer name=audio
+    ! audioconvert
+    ! autoaudiosink
+    audiotestsrc is-live=true wave=silence
+    ! audio.
+'''
+
+# Elements between the decoded pads of the items and the mixers.
+VIDEO_CHAIN = 'queue ! videoconvert'
+IMAGE_CHAIN = 'queue ! imagefreeze ! videoconvert'
+AUDIO_CHAIN = 'queue ! audioconvert ! audioresample'
+
+
+compositors = WeakKeyDictionary()
+"""
+Compositors of the stage pools, one per media zone.
+"""
+
+
+class Compositor (Logging):
+    """
+    Single long-lived pipeline playing all items of a media zone.
+
+    Instead of a decoder process with its own X window per item, every
+    item is a source branch attached to the compositor and the audio
+    mixer of a pipeline rendering to a single stage.  Branches are
+    prerolled with their data blocked, started with their timestamps
+    shifted to the current running time and faded in and out using
+    alpha and volume ramps on the mixer pads, so that consecutive items
+    crossfade.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.stage = stages.acquire()
+
+        self.pipeline = None
+        self.video = None
+        self.audio = None
+
+        # Items prepared before the pipeline was ready.
+        self.waiting = []
+
+        # Items -> their branches.
+        self.branches = {}
+
+        # Stacking order of the next item, later items go on top.
+        self.zorder = 1
+
+        if self.stage.get_realized():
+            self.on_realize(self.stage)
+        else:
+            stages.when_realized(self.stage, self.on_realize)
+
+    def logPrefix(self):
+        return 'compositor'
+
+    def on_realize(self, stage):
+        self.msg('Starting compositor pipeline...')
+
+        self.pipeline = Gst.parse_launch(PIPELINE.format(
+            width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT, fps=OUTPUT_FPS,
+            sink=common.video_sink))
+
+        self.video = self.pipeline.get_by_name('video')
+        self.audio = self.pipeline.get_by_name('audio')
+
+        sink = self.pipeline.get_by_name('sink')
+        sink.set_window_handle(self.stages.xid(stage))
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message', self.on_bus_event)
+
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self.stages.raise_stage(stage)
+
+        waiting, self.waiting = self.waiting, []
+
+        for item, show in waiting:
+            self.attach(item)
+
+            if show:
+                self.show(item)
+
+    def running_time(self):
+        """
+        Return current running time of the pipeline.
+        """
+
+        clock = self.pipeline.get_clock()
+
+        if clock is None:
+            return 0
+
+        return clock.get_time() - self.pipeline.get_base_time()
+
+    def attach(self, item):
+        """
+        Add hidden branch for the item and let it preroll.
+        """
+
+        if self.pipeline is None:
+            self.waiting.append([item, False])
+            return
+
+        source = Gst.ElementFactory.make('uridecodebin')
+        source.set_property('uri', quote(item.url, '/:'))
+        source.set_property('buffer-size', 2**22)
+
+        branch = Branch(item, source, self.zorder)
+        self.zorder += 1
+        self.branches[item] = branch
+
+        source.connect('pad-added', self.on_pad_added, branch)
+
+        self.pipeline.add(source)
+        source.set_state(Gst.State.PAUSED)
+
+    def on_pad_added(self, source, pad, branch):
+        # Called from a streaming thread.
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        kind = caps.get_structure(0).get_name()
+
+        if kind == 'video/x-raw':
+            mixer = self.video
+
+            if branch.item.MEDIA == 'image':
+                description = IMAGE_CHAIN
+            else:
+                description = VIDEO_CHAIN
+
+        elif kind == 'audio/x-raw':
+            mixer = self.audio
+            description = AUDIO_CHAIN
+
+        else:
+            return
+
+        chain = Gst.parse_bin_from_description(description, True)
+        self.pipeline.add(chain)
+
+        sink = mixer.get_request_pad('sink_%u')
+
+        if mixer is self.video:
+            sink.set_property('alpha', 0.0)
+            sink.set_property('zorder', branch.zorder)
+            sink.set_property('width', OUTPUT_WIDTH)
+            sink.set_property('height', OUTPUT_HEIGHT)
+
+            # Letterbox instead of stretching, since GStreamer 1.20.
+            if sink.find_property('sizing-policy') is not None:
+                sink.set_property('sizing-policy', 'keep-aspect-ratio')
+        else:
+            sink.set_property('volume', 0.0)
+
+        src = chain.get_static_pad('src')
+        src.link(sink)
+
+        link = Link(chain, mixer, sink)
+
+        # The item may be started from the reactor thread meanwhile.
+        with branch.lock:
+            branch.links.append(link)
+            started = branch.started
+
+            if started is None:
+                # Hold the data back until the item is started.
+                link.block = src.add_probe(
+                    Gst.PadProbeType.BLOCK_DOWNSTREAM, hold)
+            else:
+                self.start_link(branch, link, self.running_time())
+
+        if started is None:
+            chain.set_state(Gst.State.PAUSED)
+        else:
+            chain.set_state(Gst.State.PLAYING)
+
+        pad.link(chain.get_static_pad('sink'))
+
+    def show(self, item):
+        """
+        Start the branch of the item and fade it in.
+        """
+
+        if self.pipeline is None:
+            for entry in self.waiting:
+                if entry[0] is item:
+                    entry[1] = True
+
+            return
+
+        branch = self.branches.get(item)
+
+        if branch is None:
+            return
+
+        # Streams may be getting linked from a streaming thread meanwhile.
+        with branch.lock:
+            now = self.running_time()
+            branch.started = now
+
+            for link in branch.links:
+                self.start_link(branch, link, now)
+
+            chains = [link.chain for link in branch.links]
+
+        for element in [branch.source] + chains:
+            element.set_state(Gst.State.PLAYING)
+
+    def start_link(self, branch, link, now):
+        """
+        Let the data of the link flow with shifted timestamps.
+        """
+
+        src = link.chain.get_static_pad('src')
+        src.set_offset(now)
+
+        fade = int(FADE * Gst.SECOND)
+
+        if link.mixer is self.video:
+            src.add_probe(Gst.PadProbeType.BUFFER, self.on_first_buffer,
+                          branch.item)
+            ramp(link.pad, 'alpha', [(now, 0.0), (now + fade, 1.0)])
+        else:
+            ramp(link.pad, 'volume', [(now, 0.0), (now + fade, 1.0)])
+
+        if link.block is not None:
+            src.remove_probe(link.block)
+            link.block = None
+
+    def on_first_buffer(self, pad, info, item):
+        # Called from a streaming thread, hand over to the reactor.
+        reactor.callFromThread(item.on_rendered)
+        return Gst.PadProbeReturn.REMOVE
+
+    def hide(self, item):
+        """
+        Fade the item out and remove its branch afterwards.
+
+        Pictures stay in place while the next item fades in on top of
+        them and only then fade out, so that the crossfades do not dip
+        to the background.
+        """
+
+        self.waiting = [entry for entry in self.waiting
+                        if entry[0] is not item]
+        branch = self.branches.pop(item, None)
+
+        if branch is None:
+            return
+
+        now = self.running_time()
+        fade = int(FADE * Gst.SECOND)
+
+        for link in branch.links:
+            if link.mixer is self.video:
+                ramp(link.pad, 'alpha', [(now + fade, 1.0),
+                                         (now + 2 * fade, 0.0)])
+            else:
+                ramp(link.pad, 'volume', [(now, 1.0), (now + fade, 0.0)])
+
+        reactor.callLater(2 * FADE, self.remove, branch)
+
+    def remove(self, branch):
+        """
+        Tear the branch down and give the mixer pads back.
+        """
+
+        branch.source.set_state(Gst.State.NULL)
+
+        for link in branch.links:
+            link.chain.set_state(Gst.State.NULL)
+            link.chain.get_static_pad('src').unlink(link.pad)
+            link.mixer.release_request_pad(link.pad)
+            self.pipeline.remove(link.chain)
+
+        self.pipeline.remove(branch.source)
+        branch.links = []
+
+    def on_bus_event(self, bus, msg):
+        if Gst.MessageType.ERROR != msg.type:
+            return
+
+        error, debug = msg.parse_error()
+
+        for item, branch in list(self.branches.items()):
+            if branch.owns(msg.src):
+                self.warn('Item {!r} failed: {}', item, error.message)
+                del self.branches[item]
+                self.remove(branch)
+                item.on_error(' '.join(error.message.split()))
+                return
+
+        self.warn('GStreamer: {} {}', error.message, debug)
+
+
+class Branch:
+    """
+    Source branch of a single item.
+    """
+
+    def __init__(self, item, source, zorder):
+        self.item = item
+        self.source = source
+        self.zorder = zorder
+
+        # Running time the item was started at, None until then.
+        self.started = None
+
+        # Decoded streams linked to the mixers.
+        self.links = []
+
+        # Guards the start and the links against the streaming threads.
+        self.lock = Lock()
+
+    def owns(self, element):
+        """
+        Decide whether the element is a part of the branch.
+        """
+
+        for part in [self.source] + [link.chain for link in self.links]:
+            if element is part or element.has_as_ancestor(part):
+                return True
+
+        return False
+
+
+class Link:
+    """
+    Decoded stream of an item linked to a mixer pad.
+    """
+
+    def __init__(self, chain, mixer, pad):
+        self.chain = chain
+        self.mixer = mixer
+        self.pad = pad
+
+        # Probe holding the data back until the item starts.
+        self.block = None
+
+
+class CompositedItem (Item):
+    """
+    Playlist item played by the compositor of its zone.
+    """
+
+    def __init__(self, url, zone='main'):
+        super().__init__(url, zone)
+        self.compositor = None
+
+    def prepare(self, screen):
+        if self.compositor is not None:
+            self.warn('Cannot prepare {!r} twice, ignoring.', self)
+            return
+
+        self.compositor = compositor_for(screen.stage_pool(self.zone))
+        self.compositor.attach(self)
+
+    def start(self):
+        if self.compositor is None:
+            return
+
+        self.compositor.show(self)
+        self.playing = True
+
+    def stop(self):
+        if self.compositor is None:
+            return
+
+        compositor, self.compositor = self.compositor, None
+        compositor.hide(self)
+        self.playing = False
+
+
+class CompositedImageItem (CompositedItem):
+    """Still image played by the compositor."""
+    MEDIA = 'image'
+
+
+class CompositedVideoItem (CompositedItem):
+    """Video played by the compositor."""
+    MEDIA = 'video'
+
+
+class CompositedStreamItem (CompositedItem):
+    """Stream played by the compositor."""
+    MEDIA = 'stream'
+
+
+def compositor_for(stages):
+    """
+    Return compositor of the stage pool, creating it when necessary.
+    """
+
+    if stages not in compositors:
+        compositors[stages] = Compositor(stages)
+
+    return compositors[stages]
+
+
+def hold(pad, info):
+    """
+    Pad probe keeping the data blocked.
+    """
+
+    return Gst.PadProbeReturn.OK
+
+
+def ramp(pad, name, points):
+    """
+    Animate property of the pad linearly between the control points.
+
+    Points are (running time, value) pairs.  Any earlier animation of
+    the property is replaced.
+    """
+
+    source = GstController.InterpolationControlSource()
+    source.set_property('mode', GstController.InterpolationMode.LINEAR)
+
+    for timestamp, value in points:
+        source.set(int(timestamp), value)
+
+    binding = GstController.DirectControlBinding.new_absolute(pad, name,
+                                                              source)
+    pad.add_control_binding(binding)
+
+
+# vim:set sw=4 ts=4 et:
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.defer import Deferred
 from twisted.internet import reactor
 from twisted.python import log
 
@@ -15,21 +16,54 @@ __all__ = []
 
 
 class DecoderClient (ProcessProtocol):
-    def __init__(self, xid, media, url):
+    def __init__(self, xid, media, url, executable=None):
+        # Fires once the decoder process terminates.
+        self.ended = Deferred()
+
+        # Incomplete line received from the decoder.
+        self.buffer = b''
+
+        # Deferreds waiting for thumbnails, in the order requested.
+        self.thumbnails = []
+
+        if executable is None:
+            executable = sys.argv[0]
+
         args = [
-            sys.argv[0],
+            executable,
             '--debug' if common.debug else '--quiet',
-            '--decode', str(xid), media, url,
+            '--sink={}'.format(common.video_sink),
         ]
-        reactor.spawnProcess(self, sys.argv[0], args, os.environ)
+
+        if common.thumbnail_interval is not None:
+            args.append('--thumbnails={}'.format(common.thumbnail_interval))
+
+        args.extend(['--decode', str(xid), media, url])
+        reactor.spawnProcess(self, executable, args, os.environ)
 
     def errReceived(self, data):
         if b'libva info:' not in data:
-            sys.stderr.write(data)
+            sys.stderr.buffer.write(data)
 
     def outReceived(self, data):
-        for event in data.decode('utf8').strip().split('\n'):
-            getattr(self, 'on_{}'.format(event))()
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+
+        for line in lines:
+            event, *args = line.decode('utf8').strip().split(' ', 1)
+            if event:
+                getattr(self, 'on_{}'.format(event), self.on_unknown)(*args)
+
+    def on_unknown(self, *args):
+        pass
+
+    def hints(self, hints):
+        """
+        Tell the decoder what the media contain, before preparing.
+        """
+
+        pairs = ' '.join('{}={}'.format(k, v) for k, v in hints.items())
+        self.transport.write('hints {}\n'.format(pairs).encode('utf8'))
 
     def prepare(self):
         self.transport.write(b'prepare\n')
@@ -37,6 +71,23 @@ class DecoderClient (ProcessProtocol):
     def play(self):
         self.transport.write(b'play\n')
 
+    def profile(self, mode, duration, session):
+        line = 'profile {} {} {}\n'.format(mode, duration, session)
+        self.transport.write(line.encode('utf8'))
+
+    def thumbnail(self):
+        """
+        Request the most recent thumbnail, base64-encoded JPEG.
+
+        Returns a Deferred firing with the thumbnail or None when the
+        decoder does not have any.
+        """
+
+        d = Deferred()
+        self.thumbnails.append(d)
+        self.transport.write(b'thumbnail\n')
+        return d
+
     def stop(self):
         self.transport.write(b'stop\n')
         reactor.callLater(5, self.transport.loseConnection)
@@ -50,9 +101,23 @@ class DecoderClient (ProcessProtocol):
     def on_playing(self):
         pass
 
-    def processEnded(self, status):
+    def on_rendered(self):
         pass
 
+    def on_error(self, error=''):
+        pass
+
+    def on_thumbnail(self, data=None):
+        if self.thumbnails:
+            self.thumbnails.pop(0).callback(data)
+
+    def processEnded(self, status):
+        # Nobody is going to answer anymore.
+        while self.thumbnails:
+            self.thumbnails.pop(0).callback(None)
+
+        self.ended.callback(None)
+
     def connectionMade(self):
         pass
 
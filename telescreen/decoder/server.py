@@ -6,13 +6,38 @@ from gi.repository import GstVideo
 
 from twisted.internet import reactor
 from twisted.protocols.basic import LineReceiver
-from twisted.python import log
 
 from urllib.parse import quote
+from base64 import b64encode
 from os import linesep
 
+from telescreen.common import Logging
+from telescreen.profiling import Profiler
+from telescreen import common
 
-class Decoder (LineReceiver):
+
+# Thumbnail branch teed off the decoded frames.  The leaky queue and the
+# dropping appsink make sure it never holds back the render path.
+THUMBNAIL_BRANCH = '''
+    queue leaky=downstream max-size-buffers=1
+    ! videorate drop-only=true
+    ! videoscale add-borders=true
+    ! videoconvert
+    ! video/x-raw,width={width},height={height},framerate=1/{interval}
+    ! jpegenc quality=60
+    ! appsink name=thumbnail max-buffers=1 drop=true sync=false async=false
+'''
+
+# Size of the thumbnails.
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_HEIGHT = 90
+
+# Playbin flags for the parts media may not need.
+PLAY_FLAG_AUDIO = 0x02
+PLAY_FLAG_TEXT = 0x04
+
+
+class Decoder (LineReceiver, Logging):
     delimiter = linesep.encode('utf8')
 
     def __init__(self, xid, media, url):
@@ -24,23 +49,111 @@ class Decoder (LineReceiver):
         self.sink = None
         self.bus = None
 
+        # Source of the thumbnails and the last one taken.
+        self.thumbnail_sink = None
+        self.thumbnail = None
+
+        # What the prober told us about the media, see on_hints().
+        self.hints = {}
+
+        self.profiler = Profiler('decoder')
+        self.profiler.on_done = self.on_profile_done
+
+    def logPrefix(self):
+        return 'decoder'
+
     def connectionMade(self):
-        log.msg('Starting media decoder...')
+        self.msg('Starting media decoder...')
         self.sendLine(b'ready')
 
     def lineReceived(self, line):
-        event = line.strip().decode('utf8')
-        getattr(self, 'on_{}'.format(event), self.on_unknown)()
+        event, *args = line.strip().decode('utf8').split(' ')
+        getattr(self, 'on_{}'.format(event), self.on_unknown)(*args)
+
+    def on_unknown(self, *args):
+        self.warn('Received an unknown command, ignoring.')
+
+    def on_profile(self, mode='sample', duration='30', session=None):
+        """
+        Profile the decoder and dump the pipeline graph for a while.
+        """
+
+        if self.profiler.start(mode, float(duration), session):
+            self.dump_graph(self.profiler.path('start.dot'))
+
+    def toggle_profile(self):
+        if self.profiler.running:
+            self.profiler.stop()
+        else:
+            self.on_profile()
+
+    def on_profile_done(self, path):
+        self.dump_graph(path.rsplit('.', 1)[0] + '.end.dot')
+
+    def dump_graph(self, path):
+        """
+        Write the pipeline graph in the GraphViz format.
+        """
+
+        if self.pipeline is None:
+            return
+
+        data = Gst.debug_bin_to_dot_data(self.pipeline,
+                                         Gst.DebugGraphDetails.ALL)
+
+        with open(path, 'w') as fp:
+            fp.write(data)
+
+    def on_thumbnail(self):
+        """
+        Send the most recent thumbnail, base64-encoded JPEG.
+        """
+
+        if self.thumbnail_sink is not None:
+            sample = self.thumbnail_sink.emit('try-pull-sample', 0)
+
+            if sample is not None:
+                buf = sample.get_buffer()
+                self.thumbnail = b64encode(buf.extract_dup(0, buf.get_size()))
 
-    def on_unknown(self):
-        log.msg('Received an unknown command, ignoring.')
+        if self.thumbnail is None:
+            self.sendLine(b'thumbnail')
+        else:
+            self.sendLine(b'thumbnail ' + self.thumbnail)
+
+    def on_hints(self, *pairs):
+        """
+        Learn about the media before the pipeline is created.
+
+        Hints are ``name=value`` pairs, ``audio=0`` and ``text=0`` say
+        that the media have no audio or subtitle streams.
+        """
+
+        for pair in pairs:
+            name, _, value = pair.partition('=')
+            self.hints[name] = value
+
+    def simplify(self, playbin):
+        """
+        Leave out parts of the playbin the media do not need.
+        """
+
+        flags = int(playbin.get_property('flags'))
+
+        if self.hints.get('audio') == '0':
+            flags &= ~PLAY_FLAG_AUDIO
+
+        if self.hints.get('text') == '0':
+            flags &= ~PLAY_FLAG_TEXT
+
+        playbin.set_property('flags', flags)
 
     def on_prepare(self):
         if self.pipeline is not None:
-            log.msg('Cannot prepare twice, ignoring.')
+            self.warn('Cannot prepare twice, ignoring.')
             return
 
-        log.msg('Creating pipeline...')
+        self.msg('Creating pipeline...')
 
         constructor = 'make_{}_pipeline'.format(self.media)
         self.pipeline, self.sink = getattr(self, constructor)()
@@ -52,22 +165,32 @@ class Decoder (LineReceiver):
         self.bus.enable_sync_message_emission()
         self.bus.connect('message', self.on_bus_event)
 
-        log.msg('Prerolling...')
+        self.msg('Prerolling...')
         self.pipeline.set_state(Gst.State.PAUSED)
 
         self.sendLine(b'prepared')
 
+    def on_first_buffer(self, pad, info):
+        # Called from a streaming thread, hand over to the reactor.
+        reactor.callFromThread(self.sendLine, b'rendered')
+        return Gst.PadProbeReturn.REMOVE
+
     def on_play(self):
         if self.pipeline is None:
             self.on_prepare()
 
-        log.msg('Starting playback...')
+        self.msg('Starting playback...')
         self.pipeline.set_state(Gst.State.PLAYING)
 
+        # Let the client know when the first frame hits the screen.  Not
+        # any earlier, the preroll frame goes to a stage still hidden.
+        pad = self.sink.get_static_pad('sink')
+        pad.add_probe(Gst.PadProbeType.BUFFER, self.on_first_buffer)
+
         self.sendLine(b'playing')
 
     def on_stop(self):
-        log.msg('Stopping nicely...')
+        self.msg('Stopping nicely...')
 
         if self.pipeline is not None:
             self.pipeline.set_state(Gst.State.NULL)
@@ -76,7 +199,7 @@ class Decoder (LineReceiver):
             reactor.stop()
 
     def connectionLost(self, reason):
-        log.msg('Parent left us, exiting.')
+        self.msg('Parent left us, exiting.')
         self.on_stop()
 
     def on_bus_event(self, bus, msg):
@@ -87,29 +210,58 @@ class Decoder (LineReceiver):
             old, new, pending = msg.parse_state_changed()
 
         elif Gst.MessageType.ERROR == msg.type:
-            log.msg('GStreamer: {} {}'.format(*msg.parse_error()))
+            error, debug = msg.parse_error()
+            self.warn('GStreamer: {} {}', error, debug)
+
+            # Let the client know what went wrong, on a single line.
+            message = ' '.join(error.message.split()) or 'unknown error'
+            self.sendLine('error {}'.format(message).encode('utf8'))
             self.on_stop()
 
+    def make_video_sink(self, filters=None):
+        """
+        Create the video sink, optionally with a thumbnail branch.
+
+        Returns the element to give to the playbin and the real sink
+        to render with.
+        """
+
+        if filters is None and common.thumbnail_interval is None:
+            videosink = Gst.ElementFactory.make(common.video_sink)
+            return videosink, videosink
+
+        description = '{} name=sink'.format(common.video_sink)
+
+        if common.thumbnail_interval is not None:
+            branch = THUMBNAIL_BRANCH.format(
+                width=THUMBNAIL_WIDTH, height=THUMBNAIL_HEIGHT,
+                interval=max(1, int(common.thumbnail_interval)))
+            description = 'tee name=tee ! queue ! {} tee. ! {}' \
+                          .format(description, branch)
+
+        if filters is not None:
+            description = '{} ! {}'.format(filters, description)
+
+        videosink = Gst.parse_bin_from_description(description, True)
+        self.thumbnail_sink = videosink.get_by_name('thumbnail')
+
+        return videosink, videosink.get_by_name('sink')
+
     def make_image_pipeline(self):
         pipeline = Gst.Pipeline()
 
         source = Gst.ElementFactory.make('playbin3')
         pipeline.add(source)
 
-        videosink = Gst.parse_launch('''
+        videosink, realsink = self.make_video_sink('''
             imagefreeze
             ! videoscale add-borders=true
-            ! xvimagesink name=sink
         ''')
-        realpad = videosink.find_unlinked_pad(Gst.PadDirection.SINK)
-        ghostpad = Gst.GhostPad.new(None, realpad)
-        videosink.add_pad(ghostpad)
-
-        realsink = videosink.get_by_name('sink')
 
         source.set_property('uri', quote(self.url, '/:'))
         source.set_property('buffer-size', 2**22)
         source.set_property('video-sink', videosink)
+        self.simplify(source)
 
         return pipeline, realsink
 
@@ -120,13 +272,14 @@ class Decoder (LineReceiver):
         source = Gst.ElementFactory.make('playbin')
         pipeline.add(source)
 
-        videosink = Gst.ElementFactory.make('xvimagesink')
+        videosink, realsink = self.make_video_sink()
 
         source.set_property('uri', quote(self.url, '/:'))
         source.set_property('buffer-size', 2**22)
         source.set_property('video-sink', videosink)
+        self.simplify(source)
 
-        return pipeline, videosink
+        return pipeline, realsink
 
     def make_stream_pipeline(self):
         pipeline = Gst.Pipeline()
@@ -135,13 +288,14 @@ class Decoder (LineReceiver):
         source = Gst.ElementFactory.make('playbin')
         pipeline.add(source)
 
-        videosink = Gst.ElementFactory.make('xvimagesink')
+        videosink, realsink = self.make_video_sink()
 
         source.set_property('uri', quote(self.url, '/:'))
         source.set_property('buffer-size', 2**22)
         source.set_property('video-sink', videosink)
+        self.simplify(source)
 
-        return pipeline, videosink
+        return pipeline, realsink
 
 
 # vim:set sw=4 ts=4 et:
@@ -0,0 +1,74 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from telescreen.common import Logging
+
+
+__all__ = ['Dispatcher']
+
+
+class Dispatcher (Logging):
+    """
+    Routes messages from the leader to managers of more screens.
+
+    Messages carry name of the logical screen in their ``screen``
+    field.  Messages without it go to the first screen, so that leaders
+    unaware of more screens per box keep working.
+    """
+
+    def __init__(self):
+        self.managers = {}
+        self.default = None
+
+    def logPrefix(self):
+        return 'dispatcher'
+
+    def add(self, manager):
+        """
+        Register manager of a named screen.
+        """
+
+        self.managers[manager.name] = manager
+
+        if self.default is None:
+            self.default = manager
+
+    def start(self):
+        for manager in self.managers.values():
+            manager.start()
+
+    def on_message(self, message, sender):
+        """
+        Pass the message to the manager of the addressed screen.
+        """
+
+        name = None
+
+        if isinstance(message, dict) and 'screen' in message:
+            message = dict(message)
+            name = message.pop('screen')
+
+        if name is None:
+            manager = self.default
+        else:
+            manager = self.managers.get(name)
+
+        if manager is None:
+            self.warn('Message for unknown screen {!r}, ignoring.', name)
+            return
+
+        manager.on_message(message, sender)
+
+    def on_reconnect(self):
+        for manager in self.managers.values():
+            manager.on_reconnect()
+
+    def toggle_profile(self):
+        self.default.toggle_profile()
+
+    def on_close(self):
+        for manager in self.managers.values():
+            manager.on_close()
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,203 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor
+
+from os import makedirs, fsync, rename
+from os.path import dirname, exists
+from simplejson import dumps, loads, JSONDecodeError
+
+from telescreen.common import Logging
+
+
+__all__ = ['Journal']
+
+
+# Where the proof-of-play records are kept until the leader has them.
+JOURNAL_PATH = '/var/lib/telescreen/journal'
+
+# Records are written out at most this many seconds after they happen...
+FLUSH_DELAY = 10
+
+# ...or as soon as this many of them pile up.
+FLUSH_BATCH = 64
+
+
+class Journal (Logging):
+    """
+    Append-only proof-of-play journal.
+
+    Every record is a compact JSON array ``[seq, time, event, url,
+    details]`` on its own line.  Records are buffered and written out
+    in batches followed by a single ``fsync``, so that the flash storage
+    is not worn down by a write per event.  A crash can leave a partial
+    line at the end of the file, which is dropped when the journal is
+    opened again.
+
+    Only records the leader have not acknowledged yet are kept.
+    Acknowledging a sequence number rewrites the journal without the
+    records up to and including it, starting with an ``ack`` marker so
+    that the sequence numbers continue across restarts.
+    """
+
+    def __init__(self, path=JOURNAL_PATH, clock=reactor):
+        self.path = path
+        self.clock = clock
+
+        # File the records are appended to.
+        self.fp = None
+
+        # Records waiting to be written, as encoded lines.
+        self.buffer = []
+
+        # Pending flush of the buffer.
+        self.timer = None
+
+        # Sequence number of the last record.
+        self.seq = 0
+
+    def logPrefix(self):
+        return 'journal'
+
+    def open(self):
+        """
+        Recover the journal after a possible crash and open it.
+        """
+
+        makedirs(dirname(self.path), exist_ok=True)
+
+        if exists(self.path):
+            self.recover()
+
+        self.fp = open(self.path, 'ab')
+        self.msg('Journal opened, last record is {}.', self.seq)
+
+    def recover(self):
+        """
+        Truncate partially written tail and find the last sequence number.
+        """
+
+        valid = 0
+
+        with open(self.path, 'r+b') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break
+
+                try:
+                    self.seq = loads(line.decode('utf-8'))[0]
+                except (UnicodeDecodeError, JSONDecodeError, IndexError):
+                    break
+
+                valid += len(line)
+
+            if valid < fp.seek(0, 2):
+                self.warn('Dropping {} bytes of damaged journal tail.',
+                          fp.tell() - valid)
+                fp.truncate(valid)
+
+    def record(self, event, url, **details):
+        """
+        Add a new record to the journal.
+        """
+
+        self.seq += 1
+        line = dumps([self.seq, round(self.clock.seconds(), 3),
+                      event, url, details], separators=(',', ':'))
+        self.buffer.append(line.encode('utf-8') + b'\n')
+
+        if len(self.buffer) >= FLUSH_BATCH:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.clock.callLater(FLUSH_DELAY, self.flush)
+
+        return self.seq
+
+    def flush(self):
+        """
+        Write buffered records out and make sure they hit the disk.
+        """
+
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+
+            self.timer = None
+
+        if not self.buffer or self.fp is None:
+            return
+
+        self.fp.write(b''.join(self.buffer))
+        self.fp.flush()
+        fsync(self.fp.fileno())
+
+        self.debug('Flushed {} records.', len(self.buffer))
+        self.buffer = []
+
+    def pending(self, limit):
+        """
+        Return up to ``limit`` oldest records the leader does not have.
+
+        Records are returned as encoded lines, only the written ones are
+        considered.
+        """
+
+        lines = []
+
+        if not exists(self.path):
+            return lines
+
+        with open(self.path, 'rb') as fp:
+            for line in fp:
+                if len(lines) >= limit:
+                    break
+
+                if loads(line.decode('utf-8'))[2] != 'ack':
+                    lines.append(line)
+
+        return lines
+
+    def ack(self, seq):
+        """
+        Forget all records up to and including the given one.
+        """
+
+        self.flush()
+
+        if self.fp is None:
+            return
+
+        marker = dumps([seq, round(self.clock.seconds(), 3), 'ack', None, {}],
+                       separators=(',', ':'))
+        kept = [marker.encode('utf-8') + b'\n']
+
+        with open(self.path, 'rb') as fp:
+            for line in fp:
+                if loads(line.decode('utf-8'))[0] > seq:
+                    kept.append(line)
+
+        # Replace the journal atomically, so that a crash leaves either
+        # the old or the new version behind.
+        temp = self.path + '.new'
+
+        with open(temp, 'wb') as fp:
+            fp.write(b''.join(kept))
+            fp.flush()
+            fsync(fp.fileno())
+
+        self.fp.close()
+        rename(temp, self.path)
+        self.fp = open(self.path, 'ab')
+
+        self.debug('Acknowledged up to {}, {} records left.',
+                   seq, len(kept) - 1)
+
+    def close(self):
+        self.flush()
+
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+# vim:set sw=4 ts=4 et:
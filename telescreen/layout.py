@@ -0,0 +1,119 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['LayoutEngine', 'layout_key', 'zone_urls', 'MEDIA_ZONES']
+
+
+# Zone types that play scheduled items, the rest display web pages.
+MEDIA_ZONES = ('video', 'image')
+
+# How many distinct (layout, window size) combinations to remember.
+CACHE_SIZE = 32
+
+
+class LayoutEngine:
+    """
+    Computes and caches zone geometry for layouts and window sizes.
+
+    Geometry is a dictionary mapping zone names to ``(type, x, y, w, h)``
+    tuples in pixels.  The same geometry object is returned for the same
+    layout and window size, so that callers can skip work with a simple
+    identity check.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def geometry(self, key, layout, width, height):
+        """
+        Return geometry of the layout identified by the key.
+        """
+
+        cache_key = (key, width, height)
+
+        if cache_key not in self.cache:
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+
+            self.cache[cache_key] = compute_geometry(layout, width, height)
+
+        return self.cache[cache_key]
+
+
+def layout_key(layout):
+    """
+    Return hashable key identifying the geometry of a layout.
+    """
+
+    if layout.get('mode') == 'zones':
+        zones = [(z['name'], z['type'], z['x'], z['y'],
+                  z['width'], z['height']) for z in layout['zones']]
+        return ('zones', tuple(zones))
+
+    return (layout.get('mode', 'full'),)
+
+
+def compute_geometry(layout, width, height):
+    """
+    Calculate position of zones with respect to the window size.
+
+    Besides the declarative ``zones`` mode where the plan specifies
+    zone rectangles as fractions of the window, the classic ``full``,
+    ``sidebar`` and ``panel`` modes are supported.  They place the
+    ``main`` video zone in a 4:3 box and fill the rest with the
+    ``sidebar`` and ``panel`` web zones.
+    """
+
+    mode = layout.get('mode', 'full')
+
+    if mode == 'zones':
+        geometry = {}
+
+        for zone in layout['zones']:
+            x = round(zone['x'] * width)
+            y = round(zone['y'] * height)
+            w = round((zone['x'] + zone['width']) * width) - x
+            h = round((zone['y'] + zone['height']) * height) - y
+            geometry[zone['name']] = (zone['type'], x, y, w, h)
+
+        return geometry
+
+    if mode == 'sidebar':
+        size = round(height / 3 * 4)
+
+        return {
+            'main': ('video', 0, 0, size, height),
+            'sidebar': ('web', size, 0, width - size, height),
+        }
+
+    if mode == 'panel':
+        panel = round(height / 12)
+        size = round((height - panel) * 4 / 3)
+
+        return {
+            'main': ('video', 0, 0, size, height - panel),
+            'sidebar': ('web', size, 0, width - size, height - panel),
+            'panel': ('web', 0, height - panel, width, panel),
+        }
+
+    return {
+        'main': ('video', 0, 0, width, height),
+    }
+
+
+def zone_urls(layout):
+    """
+    Return mapping of web zone names to the URLs they should display.
+    """
+
+    if layout.get('mode') == 'zones':
+        return {zone['name']: zone.get('url') for zone in layout['zones']
+                if zone['type'] not in MEDIA_ZONES}
+
+    return {
+        'sidebar': layout.get('sidebar'),
+        'panel': layout.get('panel'),
+    }
+
+
+# vim:set sw=4 ts=4 et:
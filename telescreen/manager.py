@@ -3,36 +3,109 @@
 
 from twisted.internet.task import LoopingCall
 from twisted.internet.error import AlreadyCalled
+from twisted.internet.defer import gatherResults, DeferredSemaphore
 from twisted.internet import reactor
-from twisted.python import log
 
 from functools import *
 from datetime import datetime
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from uuid import uuid4
 from os import uname
-
-from telescreen.schema import schema
+from os.path import join, basename
+from glob import glob
+from base64 import b64encode
+from zlib import compress
+from simplejson import loads
+
+from collections import deque
+from time import time
+
+from telescreen.common import Logging, recent, LEVELS
+from telescreen.schema import validator
+from telescreen.metrics import LagProbe, timed
+from telescreen import common
+from telescreen import metrics
+from telescreen.profiling import Profiler
+from telescreen.journal import Journal, JOURNAL_PATH
+from telescreen.plan import Plan
+from telescreen.prober import assess, hints
 from telescreen.scheduler import ItemScheduler, LayoutScheduler, PowerScheduler
+from telescreen.scheduler import engine_item_types
 from telescreen.screen import VideoItem, ImageItem
 
 
 __all__ = ['Manager', 'seconds_since_midnight']
 
 
-class Manager(object):
-    def __init__(self, router, screen, cec):
+# Interval of the status heartbeat, changes are reported right away.
+STATUS_HEARTBEAT = 120
+
+# Changes happening within this many seconds are reported together.
+STATUS_DEBOUNCE = 0.5
+
+# Number of recent playback errors to remember.
+ERROR_HISTORY = 20
+
+# Interval of the proof-of-play journal uploads.
+JOURNAL_UPLOAD = 60
+
+# Most journal records sent to the leader at once.
+JOURNAL_BATCH = 1000
+
+# How long to wait for the leader to acknowledge a journal batch.
+JOURNAL_ACK_TIMEOUT = 300
+
+# How long to wait for the decoders to hand over their thumbnails.
+THUMBNAIL_TIMEOUT = 5
+
+# Number of media files fetched into the peer cache at the same time.
+PREFETCH_CONCURRENCY = 2
+
+# How long to wait for the decoders to write their profiles.
+PROFILE_UPLOAD_DELAY = 5
+
+# Largest compressed profile file we are willing to send to the leader.
+PROFILE_UPLOAD_LIMIT = 4 * 2**20
+
+
+class Manager (Logging):
+    """
+    Drives a screen as told by the leader.
+
+    A process driving more displays runs a manager per screen, each
+    with a name the leader addresses it by.  They share the router,
+    the uplink, the media cache, the prober and the lag probe.
+    """
+
+    def __init__(self, router, screen, cec, peers=None, name=None,
+                 prober=None, uplink=None):
         self.router = router
+
+        # Watches the leader and fails over to another one, optional.
+        self.uplink = uplink
         self.screen = screen
         self.cec = cec
 
+        # Name of the logical screen, None when there is just one.
+        self.name = name
+
+        # Media cache shared with other screens, optional.
+        self.peers = peers
+        self.prefetches = DeferredSemaphore(PREFETCH_CONCURRENCY)
+
+        # Media prober with problems it found in the current plan,
+        # as url -> (problem, description).
+        self.prober = prober
+        self.flagged = {}
+
         # Generate new session identifier, we have just started.
         # When this changes, the next 'status' message will cause
         # leader to send us new plan.
         self.session = uuid4().hex
 
         # Create item playback scheduler.
-        self.item_scheduler = ItemScheduler(screen)
+        self.item_scheduler = ItemScheduler(screen,
+                                            engine_item_types(common.engine))
 
         # Create layout change scheduler.
         self.layout_scheduler = LayoutScheduler(screen)
@@ -40,12 +113,74 @@ class Manager(object):
         # Create power scheduled
         self.power_scheduler = PowerScheduler(cec)
 
+        # Do not decode anything while nobody can see it.
+        self.power_scheduler.on_state_change = self.on_power_change
+
+        # Report what is going on as soon as it happens.
+        self.item_scheduler.on_item_error = self.on_item_error
+        self.item_scheduler.on_item_event = self.on_item_event
+        self.item_scheduler.resolve_url = self.resolve_url
+        self.item_scheduler.check_task = self.check_task
+        self.item_scheduler.media_hints = self.media_hints
+        self.screen.on_layout_change = self.on_layout_change
+
+        if self.cec is not None:
+            self.cec.on_status_change = self.on_power_change
+
         # Identifier of the last plan from the leader.
         self.plan = '0' * 32
 
         # More human readable identifier
         self.hostname = uname().nodename
 
+        # Measures how much is the shared event loop blocked.
+        self.lag_probe = LagProbe()
+
+        # Periodic heartbeat, started along with the schedulers.
+        self.status_loop = None
+
+        # Reasons for the next status update, None when none is pending.
+        self.status_reasons = None
+
+        # Sequence number of the status updates.
+        self.status_seq = 0
+
+        # Recent playback errors.
+        self.errors = deque(maxlen=ERROR_HISTORY)
+
+        # Proof-of-play journal with the batch awaiting acknowledgement,
+        # as (last sequence number, time sent).
+        if name is None:
+            self.journal = Journal()
+        else:
+            self.journal = Journal('{}-{}'.format(JOURNAL_PATH, name))
+        self.journal_batch = None
+        self.journal_loop = None
+
+        # Profiler of the main process, controlled by the leader.
+        if name is None:
+            self.profiler = Profiler('telescreen')
+        else:
+            self.profiler = Profiler('telescreen-' + name)
+        self.profiler.on_done = self.on_profile_done
+        self.profile_upload = False
+
+    def logPrefix(self):
+        if self.name is not None:
+            return 'manager-' + self.name
+
+        return 'manager'
+
+    def send(self, message):
+        """
+        Send message to the leader on behalf of our screen.
+        """
+
+        if self.name is not None:
+            message['screen'] = self.name
+
+        self.router.send(message)
+
     def start(self):
         """
         Start asynchronous jobs.
@@ -60,29 +195,309 @@ class Manager(object):
             # Start CEC periodic tasks as well.
             self.cec.start()
 
-        log.msg('Starting periodic status update...')
-        self.status_loop = LoopingCall(self.send_status)
-        self.status_loop.start(15, now=True)
+        self.lag_probe.start()
+
+        if self.peers is not None:
+            self.peers.start()
 
-        log.msg('Manager started.')
+        self.msg('Starting proof-of-play journal uploads...')
+        self.journal.open()
+        self.journal_loop = LoopingCall(self.upload_journal)
+        self.journal_loop.start(JOURNAL_UPLOAD, now=False)
 
-    def send_status(self):
+        self.msg('Starting status heartbeat...')
+        self.status_loop = LoopingCall(self.send_status, ['heartbeat'])
+        self.status_loop.start(STATUS_HEARTBEAT, now=True)
+
+        self.msg('Manager started.')
+        metrics.mark('manager')
+
+    def send_status(self, reasons=(), sections=()):
         """
         Report telescreen status to the leader.
+
+        The status always carries a compact summary and the reasons
+        that triggered it.  Richer sections are only included when the
+        leader asks for them.
         """
 
-        log.msg('Sending status update...')
-        self.router.send({
+        self.debug('Sending status update ({})...', ', '.join(reasons))
+        self.status_seq += 1
+
+        status = {
+            'seq': self.status_seq,
+            'reasons': list(reasons),
+            'session': self.session,
+            'plan': self.plan,
+            'layout': self.screen.layout,
+            'power': self.cec.status if self.cec else 'unknown',
+            'hostname': self.hostname,
+            'playback': 'suspended' if self.item_scheduler.suspended
+                                    else 'active',
+            'errors': len(self.errors),
+        }
+
+        for section in sections:
+            status[section] = getattr(self, 'status_' + section)()
+
+        self.send({
             'id': uuid4().hex,
             'type': 'status',
-            'status': {
-                'plan': self.plan,
-                'layout': self.screen.layout,
-                'power': self.cec.status if self.cec else 'unknown',
-                'hostname': self.hostname
+            'status': status,
+        })
+
+        # Whatever was pending has just been reported.
+        if self.status_reasons is not None:
+            self.status_reasons = None
+            self.status_timer.cancel()
+
+        # Do not send the heartbeat too soon after this update.
+        if self.status_loop is not None and self.status_loop.running \
+                and 'heartbeat' not in reasons:
+            self.status_loop.reset()
+
+    def notify(self, reason):
+        """
+        Report a change to the leader shortly.
+        """
+
+        if self.status_reasons is None:
+            self.status_reasons = []
+            self.status_timer = reactor.callLater(STATUS_DEBOUNCE,
+                                                  self.flush_status)
+
+        if reason not in self.status_reasons:
+            self.status_reasons.append(reason)
+
+    def flush_status(self):
+        reasons, self.status_reasons = self.status_reasons, None
+        self.send_status(reasons)
+
+    def status_web(self):
+        return self.screen.web.status()
+
+    def status_metrics(self):
+        return metrics.summary()
+
+    def status_errors(self):
+        return list(self.errors)
+
+    def status_items(self):
+        return sorted(repr(item) for item in self.item_scheduler.tasks)
+
+    def status_cec(self):
+        if self.cec is None:
+            return None
+
+        return {
+            'sent': self.cec.queue.sent,
+            'coalesced': self.cec.queue.coalesced,
+            'timeouts': self.cec.queue.timeouts,
+        }
+
+    def status_peers(self):
+        if self.peers is None:
+            return None
+
+        return self.peers.status()
+
+    def status_router(self):
+        return self.router.status()
+
+    def status_media(self):
+        if self.prober is None:
+            return None
+
+        return {
+            'prober': self.prober.status(),
+            'flagged': {url: list(problem)
+                        for url, problem in self.flagged.items()},
+        }
+
+    def status_proxy(self):
+        return self.screen.web.status_proxy()
+
+    def status_startup(self):
+        return dict(metrics.startup)
+
+    def status_leader(self):
+        if self.uplink is None:
+            return None
+
+        return self.uplink.status()
+
+    def on_status(self, request):
+        """
+        Leader requests our status, possibly with more details.
+        """
+
+        self.send_status(['request'], request.get('sections', []))
+
+    def on_layout_change(self, layout):
+        self.notify('layout')
+
+    def on_reconnect(self):
+        """
+        Leader has started responding, possibly a different one.
+
+        Replay our session and plan right away, so that the leader sends
+        a new plan when it has one, and resend any journal batch the
+        previous leader may not have acknowledged.
+        """
+
+        self.send_status(['reconnect'])
+
+        if self.journal_batch is not None:
+            self.journal_batch = None
+            self.upload_journal()
+
+    def on_item_error(self, item, error):
+        """
+        Playback of an item have failed.
+        """
+
+        self.warn('Playback of {!r} failed: {}', item, error)
+        self.errors.append({
+            'time': time(),
+            'url': item.origin,
+            'error': error,
+        })
+        self.journal.record('error', item.origin, plan=self.plan,
+                            zone=item.zone, error=error)
+        self.notify('error')
+
+    def on_item_event(self, item, event):
+        """
+        Record what actually played for the proof-of-play.
+        """
+
+        self.journal.record(event, item.origin, plan=self.plan,
+                            zone=item.zone)
+
+        if event == 'frame' and 'content' not in metrics.startup:
+            metrics.mark('content')
+            self.on_first_content()
+
+    def on_first_content(self):
+        """
+        First item has been shown, report how long it took us to get here.
+        """
+
+        content = metrics.startup['content']
+        self.msg('First content shown {:.1f}s after start, {:.1f}s after '
+                 'boot.', content['process'], content['boot'])
+        self.send_status(['startup'], ['startup'])
+
+    def resolve_url(self, task):
+        """
+        Play from the peer cache when we hold the media already.
+        """
+
+        digest = task.get('sha256')
+
+        if self.peers is None or digest is None:
+            return task['url']
+
+        if self.peers.has(digest):
+            return 'file://' + self.peers.path(digest)
+
+        # Play from the origin this time, but fetch it for the next one.
+        self.prefetch(digest, task['url'])
+        return task['url']
+
+    def prefetch(self, digest, url):
+        """
+        Fetch media into the peer cache, a few files at a time.
+        """
+
+        if self.peers.has(digest) or digest in self.peers.downloads:
+            return
+
+        d = self.prefetches.run(self.peers.fetch, digest, url)
+        d.addErrback(lambda failure: self.warn('Failed to fetch {}: {}',
+                                               url, failure.getErrorMessage()))
+
+    def upload_journal(self):
+        """
+        Send the oldest unacknowledged journal records to the leader.
+        """
+
+        if self.journal_batch is not None:
+            last, sent = self.journal_batch
+
+            if time() - sent < JOURNAL_ACK_TIMEOUT:
+                self.debug('Journal batch {} not acknowledged yet.', last)
+                return
+
+            self.warn('Journal batch {} not acknowledged, resending.', last)
+
+        self.journal.flush()
+        lines = self.journal.pending(JOURNAL_BATCH)
+
+        if not lines:
+            self.journal_batch = None
+            return
+
+        first = loads(lines[0].decode('utf-8'))[0]
+        last = loads(lines[-1].decode('utf-8'))[0]
+
+        self.debug('Sending journal records {} to {}...', first, last)
+        self.journal_batch = (last, time())
+        self.send({
+            'id': uuid4().hex,
+            'type': 'journal',
+            'journal': {
+                'session': self.session,
+                'hostname': self.hostname,
+                'first': first,
+                'last': last,
+                'count': len(lines),
+                'data': b64encode(compress(b''.join(lines))).decode('ascii'),
             },
         })
 
+    def on_journal(self, request):
+        """
+        Leader acknowledges journal records it have stored.
+        """
+
+        self.journal.ack(request['ack'])
+
+        if self.journal_batch is not None \
+                and request['ack'] >= self.journal_batch[0]:
+            self.journal_batch = None
+
+            # There may be more records waiting, do not wait for them.
+            self.upload_journal()
+
+    def on_power_change(self, status):
+        """
+        Suspend or resume item playback as the power state changes.
+
+        Playback is suspended when the plan says the display should be
+        off or, when the plan does not say anything, when the display
+        reports it is off.  A scheduled power-on resumes the playback
+        a little bit in advance so that the content is ready.
+        """
+
+        scheduled = self.power_scheduler.state
+        display = self.cec.status if self.cec else 'unknown'
+
+        if scheduled in ('on', 'waking'):
+            active = True
+        elif scheduled == 'standby':
+            active = False
+        else:
+            active = display not in ('standby', 'to-standby')
+
+        if active:
+            self.item_scheduler.resume()
+        else:
+            self.item_scheduler.suspend()
+
+        self.notify('power')
+
+    @timed('manager.on_message')
     def on_message(self, message, sender):
         """
         Handle incoming message from the leader.
@@ -92,24 +507,24 @@ class Manager(object):
         """
 
         try:
-            validate(message, schema)
+            validator().validate(message)
         except ValidationError as e:
             if isinstance(message, dict):
                 t = message.get('type')
-                log.msg('Invalid message received, type {!r}.'.format(t))
+                self.warn('Invalid message received, type {!r}.', t)
             else:
-                log.msg('Invalid message received, not an object.')
+                self.warn('Invalid message received, not an object.')
 
             return
 
-        log.msg('Received {} message...'.format(message['type']))
+        self.debug('Received {} message...', message['type'])
         handler = 'on_' + message['type']
 
         if hasattr(self, handler):
             payload = message.get(message['type'], {})
             reactor.callLater(0, getattr(self, handler), payload)
         else:
-            log.msg('Message {} not implemented.'.format(message['type']))
+            self.warn('Message {} not implemented.', message['type'])
 
     def on_plan(self, plan):
         """
@@ -117,12 +532,29 @@ class Manager(object):
         """
 
         if plan['id'] == self.plan:
-            log.msg('We already use plan {}, ignoring.'.format(self.plan))
+            self.debug('We already use plan {}, ignoring.', self.plan)
             return
 
         self.plan = plan['id']
+        metrics.mark('plan')
+
+        # Loops are only expanded as the playback gets to them.
+        items = Plan(plan['items'], plan.get('loops', []))
+
+        if self.peers is not None:
+            # Get all the media the plan refers to in advance.
+            for task in items.distinct('sha256'):
+                self.prefetch(task['sha256'], task['url'])
+
+            for loop in items.loops:
+                for item in loop['items']:
+                    if 'sha256' in item:
+                        self.prefetch(item['sha256'], item['url'])
+
+        if self.prober is not None:
+            # Learn about the media long before their slots.
+            self.probe_media(items)
 
-        items = plan['items']
         layouts = plan['layouts']
         power = plan['power']
 
@@ -130,13 +562,211 @@ class Manager(object):
         reactor.callLater(0, self.layout_scheduler.change_plan, layouts)
         reactor.callLater(0, self.power_scheduler.change_plan, power)
 
+        # Acknowledge the plan right away.
+        self.notify('plan')
+
+    def probe_media(self, items):
+        """
+        Probe all distinct media of the plan.
+        """
+
+        self.flagged = {}
+        tasks = items.distinct('url')
+
+        for loop in items.loops:
+            tasks.extend(loop['items'])
+
+        for task in tasks:
+            d = self.prober.probe(task['url'], task.get('sha256'))
+            d.addCallback(self.on_probed, task['url'], task['type'])
+
+    def on_probed(self, info, url, media):
+        """
+        Report media that are not going to play well.
+        """
+
+        if info is None:
+            return
+
+        problem = assess(info, media)
+
+        if problem is None or self.flagged.get(url) == problem:
+            return
+
+        self.flagged[url] = problem
+        self.warn('Media {} flagged as {}: {}', url, *problem)
+
+        self.errors.append({
+            'time': time(),
+            'url': url,
+            'error': '{}: {}'.format(*problem),
+        })
+        self.journal.record('flag', url, plan=self.plan,
+                            problem=problem[0], detail=problem[1])
+        self.notify('error')
+
+    def check_task(self, task):
+        """
+        Skip items known not to be decodable.
+        """
+
+        if self.prober is None:
+            return None
+
+        info = self.prober.lookup(task['url'], task.get('sha256'))
+
+        if info is None:
+            return None
+
+        problem = assess(info, task['type'])
+
+        if problem is not None and problem[0] == 'undecodable':
+            return problem[1]
+
+        return None
+
+    def media_hints(self, task):
+        """
+        Let the decoder build simpler pipeline for well known media.
+        """
+
+        if self.prober is None:
+            return None
+
+        info = self.prober.lookup(task['url'], task.get('sha256'))
+
+        if info is None:
+            return None
+
+        return hints(info)
+
+    def on_logs(self, request):
+        """
+        Leader requests recent log messages from the ring buffer.
+        """
+
+        minimum = LEVELS[request.get('level', 'info')]
+        limit = request.get('limit', 500)
+
+        self.send({
+            'id': uuid4().hex,
+            'type': 'logs',
+            'logs': {
+                'session': self.session,
+                'entries': recent(minimum, limit),
+            },
+        })
+
+    def on_profile(self, request):
+        """
+        Leader requests that we profile ourselves and our decoders.
+        """
+
+        mode = request.get('mode', 'sample')
+        duration = request.get('duration', 30)
+
+        session = self.profiler.start(mode, duration)
+
+        if session is None:
+            return
+
+        self.profile_upload = request.get('upload', False)
+
+        if request.get('decoders', True):
+            for item in self.item_scheduler.tasks:
+                if item.decoder is not None:
+                    item.decoder.profile(mode, duration, session)
+
+    def on_thumbnail(self, request):
+        """
+        Leader requests thumbnails of what is playing right now.
+
+        Thumbnails are taken by the decoders from the frames they have
+        already decoded, we only collect them.
+        """
+
+        zones = request.get('zones')
+        items = [item for item in self.item_scheduler.tasks
+                 if item.playing and item.decoder is not None
+                 and (zones is None or item.zone in zones)]
+
+        def fetch(item):
+            d = item.decoder.thumbnail()
+            d.addTimeout(THUMBNAIL_TIMEOUT, reactor)
+            d.addErrback(lambda failure: None)
+            d.addCallback(lambda data: {
+                'url': item.origin,
+                'zone': item.zone,
+                'data': data,
+            })
+            return d
+
+        def send(thumbnails):
+            self.send({
+                'id': uuid4().hex,
+                'type': 'thumbnail',
+                'thumbnail': {
+                    'session': self.session,
+                    'items': thumbnails,
+                },
+            })
+
+        gatherResults([fetch(item) for item in items]).addCallback(send)
+
+    def toggle_profile(self):
+        """
+        Start or stop profiling, used from signal handlers.
+        """
+
+        if self.profiler.running:
+            self.profiler.stop()
+        else:
+            self.on_profile({})
+
+    def on_profile_done(self, path):
+        if self.profile_upload:
+            reactor.callLater(PROFILE_UPLOAD_DELAY, self.upload_profiles,
+                              self.profiler.session)
+
+    def upload_profiles(self, session):
+        """
+        Send all profiles of the session to the leader.
+        """
+
+        pattern = join(self.profiler.directory, session + '-*')
+
+        for path in sorted(glob(pattern)):
+            with open(path, 'rb') as fp:
+                data = compress(fp.read())
+
+            if len(data) > PROFILE_UPLOAD_LIMIT:
+                self.warn('Profile {} is too large to send.', path)
+                continue
+
+            self.msg('Sending profile {}...', path)
+            self.send({
+                'id': uuid4().hex,
+                'type': 'profile',
+                'profile': {
+                    'session': session,
+                    'name': basename(path),
+                    'data': b64encode(data).decode('ascii'),
+                },
+            })
+
     def on_close(self):
         """
         Do what needs to be done before shutdown
         """
 
-        log.msg('Closing Indoktrinator...')
-        log.msg('Shutting down CEC...')
-        self.cec.close()
+        self.msg('Closing Indoktrinator...')
+        self.journal.close()
+
+        if self.peers is not None:
+            self.peers.stop()
+
+        if self.cec is not None:
+            self.msg('Shutting down CEC...')
+            self.cec.close()
 
 # vim:set sw=4 ts=4 et:
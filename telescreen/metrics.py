@@ -0,0 +1,253 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from bisect import bisect_left
+from functools import wraps
+from os import sysconf
+from simplejson import dumps
+from time import perf_counter
+
+from telescreen.common import Logging
+
+
+__all__ = ['Histogram', 'LagProbe', 'histogram', 'timed', 'snapshot',
+           'summary', 'listen', 'mark', 'startup']
+
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+           0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float('inf'))
+
+# Interval of the reactor lag probe, in seconds.
+PROBE_INTERVAL = 0.25
+
+
+histograms = {}
+"""
+All histograms by their names.
+"""
+
+startup = {}
+"""
+Ends of the startup phases as seconds since the process and the system
+have started, by phase names.
+"""
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram of durations.
+
+    Adding a sample is cheap and the memory used does not grow with the
+    number of samples, so it can be used on hot paths.
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Return upper bound of the bucket with the given quantile.
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def snapshot(self):
+        """
+        Return full contents of the histogram.
+        """
+
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'buckets': [[bound if bound != float('inf') else None, count]
+                        for bound, count in zip(BUCKETS, self.counts)],
+        }
+
+    def summary(self):
+        """
+        Return compact summary of the histogram.
+        """
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+class LagProbe (Logging):
+    """
+    Measures how late the reactor runs a periodic call.
+
+    Any handler blocking the shared Gtk / Twisted loop shows up as
+    a lag of this probe.
+    """
+
+    def __init__(self, interval=PROBE_INTERVAL, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+        self.histogram = histogram('reactor.lag')
+        self.last = None
+        self.loop = None
+
+    def logPrefix(self):
+        return 'metrics'
+
+    def start(self):
+        if self.loop is not None:
+            # Already started, the probe may be shared.
+            return
+
+        self.msg('Starting reactor lag probe...')
+        self.last = perf_counter()
+        self.loop = LoopingCall(self.tick)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, now=False)
+
+    def tick(self):
+        now = perf_counter()
+        self.histogram.add(max(now - self.last - self.interval, 0.0))
+        self.last = now
+
+
+class MetricsResource (Resource):
+    """
+    Web resource returning snapshot of all histograms.
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        return dumps(snapshot()).encode('utf-8')
+
+
+def histogram(name):
+    """
+    Return histogram with given name, creating it when necessary.
+    """
+
+    if name not in histograms:
+        histograms[name] = Histogram()
+
+    return histograms[name]
+
+
+def timed(name):
+    """
+    Decorator recording duration of every call into a histogram.
+    """
+
+    def decorator(fn):
+        target = histogram(name)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            t = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                target.add(perf_counter() - t)
+
+        return wrapper
+
+    return decorator
+
+
+def mark(phase):
+    """
+    Record end of a startup phase, only the first time it ends.
+    """
+
+    if phase in startup:
+        return
+
+    now = uptime()
+
+    startup[phase] = {
+        'process': round(now - process_started(), 3),
+        'boot': round(now, 3),
+    }
+
+
+def uptime():
+    """
+    Return seconds since the system has booted.
+    """
+
+    with open('/proc/uptime') as fp:
+        return float(fp.read().split()[0])
+
+
+def process_started():
+    """
+    Return seconds since boot at which this process has started.
+    """
+
+    with open('/proc/self/stat') as fp:
+        stat = fp.read()
+
+    # The command name is in parentheses and may contain spaces, the
+    # start time is the 22nd field.
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[19]) / sysconf('SC_CLK_TCK')
+
+
+def snapshot():
+    """
+    Return full contents of all histograms.
+    """
+
+    return {name: h.snapshot() for name, h in sorted(histograms.items())}
+
+
+def summary():
+    """
+    Return compact summary of all histograms for the status report.
+    """
+
+    return {name: h.summary() for name, h in sorted(histograms.items())}
+
+
+def listen(port, interface='127.0.0.1'):
+    """
+    Serve the metrics as JSON over HTTP on the local interface.
+    """
+
+    return reactor.listenTCP(port, Site(MetricsResource()),
+                             interface=interface)
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,537 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.protocol import Protocol
+from twisted.internet import reactor
+from twisted.web.client import Agent, ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+from base64 import b64encode, b64decode
+from hashlib import sha256
+from os import makedirs, listdir, rename, unlink
+from os.path import join, exists, getsize
+from random import random, choice
+
+from telescreen.common import Logging
+from telescreen.tzmq import Router
+
+import re
+
+
+__all__ = ['PeerCache']
+
+
+# Where the media files are kept, named by their SHA-256 hashes.
+CACHE_DIR = '/var/cache/telescreen/media'
+
+# Size of the chunks transferred between the peers.
+CHUNK_SIZE = 2**18
+
+# Number of chunks requested at the same time.
+WINDOW = 4
+
+# How long to wait for a chunk before asking someone else.
+CHUNK_TIMEOUT = 5
+
+# Interval of the advertisements of what we hold.
+ADVERTISE_INTERVAL = 30
+
+# Longest random delay before going to the origin, so that the peers
+# wanting the same file have a chance to see that someone else is
+# already fetching it.
+ORIGIN_JITTER = 5
+
+# How long to wait for a peer fetching from the origin before we go
+# there ourselves.
+ORIGIN_WAIT = 300
+
+# Valid content hash.
+HASH_RE = re.compile('^[0-9a-f]{64}$')
+
+
+class PeerCache (Logging):
+    """
+    Media cache shared with the other screens over 0MQ.
+
+    Every screen advertises hashes of the files it holds to the peers
+    it knows about and serves them in chunks.  Files are downloaded
+    from the peers first and only when no peer has them from the
+    origin.  Peers fetching a file from the origin say so, so that the
+    others wait for them instead of fetching the very same file.  Origin
+    traffic then grows with the number of distinct files, not with the
+    number of screens.
+
+    Peers are identified by their endpoints, which must be reachable
+    by the other peers.
+    """
+
+    def __init__(self, endpoint, peers=(), directory=CACHE_DIR, clock=reactor):
+        self.endpoint = endpoint
+        self.peers = list(peers)
+        self.directory = directory
+        self.clock = clock
+
+        self.router = Router(endpoint)
+        self.router.on_message = self.on_message
+
+        # Hash -> peers holding the complete file.
+        self.holders = {}
+
+        # Hash -> peers fetching the file from the origin.
+        self.fetchers = {}
+
+        # Hash -> download in progress.
+        self.downloads = {}
+
+        self.stats = {
+            'peer_bytes': 0,
+            'origin_bytes': 0,
+            'served_bytes': 0,
+        }
+
+        self.advertise_loop = None
+
+    def logPrefix(self):
+        return 'peers'
+
+    def start(self):
+        if self.advertise_loop is not None:
+            # Already started, the cache may be shared by more screens.
+            return
+
+        self.msg('Starting peer cache on {}...', self.endpoint)
+        makedirs(self.directory, exist_ok=True)
+
+        self.router.bind(self.endpoint)
+
+        for peer in self.peers:
+            self.router.connect(peer)
+
+        self.advertise_loop = LoopingCall(self.advertise)
+        self.advertise_loop.clock = self.clock
+        self.advertise_loop.start(ADVERTISE_INTERVAL, now=True)
+
+    def stop(self):
+        if self.advertise_loop is None:
+            return
+
+        if self.advertise_loop.running:
+            self.advertise_loop.stop()
+
+        self.advertise_loop = None
+        self.router.shutdown()
+
+    def path(self, digest):
+        return join(self.directory, digest)
+
+    def has(self, digest):
+        return exists(self.path(digest))
+
+    def local(self):
+        """
+        Return hashes of all complete files we hold.
+        """
+
+        return sorted(name for name in listdir(self.directory)
+                      if HASH_RE.match(name))
+
+    def advertise(self):
+        """
+        Tell all peers what we hold and what we fetch from the origin.
+        """
+
+        hashes = self.local()
+        fetching = [digest for digest, download in self.downloads.items()
+                    if download.source == 'origin']
+
+        for peer in self.peers:
+            self.router.send({
+                'type': 'have',
+                'have': {'hashes': hashes, 'fetching': fetching},
+            }, peer)
+
+    def on_message(self, message, sender):
+        try:
+            handler = getattr(self, 'on_' + message['type'], None)
+
+            if handler is None:
+                self.warn('Unknown message {!r} from {!r}.',
+                          message['type'], sender)
+                return
+
+            handler(message[message['type']], sender)
+
+        except (KeyError, TypeError, ValueError) as e:
+            self.warn('Malformed message from {!r}: {}', sender, e)
+
+    def on_have(self, have, sender):
+        for table, hashes in ((self.holders, have['hashes']),
+                              (self.fetchers, have['fetching'])):
+            for peers in table.values():
+                peers.discard(sender)
+
+            for digest in hashes:
+                table.setdefault(digest, set()).add(sender)
+
+        # Someone may now have what we are waiting for.
+        for digest, download in list(self.downloads.items()):
+            if digest in have['hashes']:
+                download.poke()
+
+    def on_get(self, get, sender):
+        digest = get['hash']
+        index = int(get['chunk'])
+        reply = {'hash': digest, 'chunk': index}
+
+        if not HASH_RE.match(digest) or not self.has(digest):
+            reply['missing'] = True
+        else:
+            path = self.path(digest)
+
+            with open(path, 'rb') as fp:
+                fp.seek(index * CHUNK_SIZE)
+                data = fp.read(CHUNK_SIZE)
+
+            reply['size'] = getsize(path)
+            reply['data'] = b64encode(data).decode('ascii')
+            self.stats['served_bytes'] += len(data)
+
+        self.router.send({'type': 'chunk', 'chunk': reply}, sender)
+
+    def on_chunk(self, chunk, sender):
+        download = self.downloads.get(chunk['hash'])
+
+        if download is not None:
+            download.on_chunk(chunk, sender)
+
+    def fetch(self, digest, url):
+        """
+        Make sure we hold the file, return Deferred firing with its path.
+        """
+
+        if not HASH_RE.match(digest):
+            return fail(ValueError('invalid hash {!r}'.format(digest)))
+
+        if self.has(digest):
+            return succeed(self.path(digest))
+
+        if digest not in self.downloads:
+            self.downloads[digest] = Download(self, digest, url)
+            self.downloads[digest].start()
+
+        return self.downloads[digest].wait()
+
+    def status(self):
+        return dict(self.stats, downloads=len(self.downloads),
+                    peers=len(self.peers))
+
+
+class Download (Logging):
+    """
+    Single file being downloaded, from the peers or from the origin.
+    """
+
+    def __init__(self, cache, digest, url):
+        self.cache = cache
+        self.digest = digest
+        self.url = url
+        self.clock = cache.clock
+
+        # Where we download from, 'peers', 'origin' or None when waiting.
+        self.source = None
+
+        # Deferreds waiting for the file.
+        self.waiters = []
+
+        # Peers that failed us during this download.
+        self.failed = set()
+
+        # Pending decision on going to the origin and whether we have
+        # already waited for a peer fetching it from there.
+        self.timer = None
+        self.waited = False
+
+        self.fp = None
+        self.size = None
+        self.chunks = None
+        self.pending = {}
+        self.received = set()
+
+    def logPrefix(self):
+        return 'peers'
+
+    @property
+    def partial(self):
+        return self.cache.path(self.digest) + '.part'
+
+    def wait(self):
+        d = Deferred()
+        self.waiters.append(d)
+        return d
+
+    def start(self):
+        self.msg('Fetching {}...', self.digest)
+        self.poke()
+
+    def holders(self):
+        return self.cache.holders.get(self.digest, set()) - self.failed
+
+    def poke(self):
+        """
+        Decide where to download from.
+        """
+
+        if self.source is not None:
+            return
+
+        if self.holders():
+            return self.from_peers()
+
+        if self.timer is None:
+            self.timer = self.clock.callLater(random() * ORIGIN_JITTER,
+                                              self.decide)
+
+    def decide(self):
+        self.timer = None
+
+        if self.holders():
+            return self.from_peers()
+
+        if self.cache.fetchers.get(self.digest) and not self.waited:
+            # Somebody is already fetching it, wait for them.
+            self.waited = True
+            self.timer = self.clock.callLater(ORIGIN_WAIT, self.decide)
+            return
+
+        self.from_origin()
+
+    def cancel_timer(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+
+        self.timer = None
+
+    def from_peers(self):
+        self.cancel_timer()
+        self.source = 'peers'
+        self.fp = open(self.partial, 'wb')
+
+        # Size is only known once the first chunk arrives.
+        self.request(0)
+
+    def request(self, index):
+        if self.source != 'peers':
+            return
+
+        holders = self.holders()
+
+        if not holders:
+            return self.give_up_peers()
+
+        peer = choice(sorted(holders))
+        timer = self.clock.callLater(CHUNK_TIMEOUT, self.on_timeout, index)
+        self.pending[index] = (peer, timer)
+
+        self.cache.router.send({
+            'type': 'get',
+            'get': {'hash': self.digest, 'chunk': index},
+        }, peer)
+
+    def on_timeout(self, index):
+        peer, timer = self.pending.pop(index)
+        self.warn('Peer {!r} did not send chunk {} of {}.',
+                  peer, index, self.digest)
+        self.failed.add(peer)
+        self.request(index)
+
+    def on_chunk(self, chunk, sender):
+        index = chunk['chunk']
+
+        if self.source != 'peers' or index not in self.pending:
+            return
+
+        peer, timer = self.pending.pop(index)
+        timer.cancel()
+
+        if chunk.get('missing'):
+            self.failed.add(sender)
+            return self.request(index)
+
+        data = b64decode(chunk['data'])
+        self.fp.seek(index * CHUNK_SIZE)
+        self.fp.write(data)
+        self.received.add(index)
+        self.cache.stats['peer_bytes'] += len(data)
+
+        if self.chunks is None:
+            self.size = chunk['size']
+            self.chunks = max(1, -(-self.size // CHUNK_SIZE))
+
+        if len(self.received) == self.chunks:
+            return self.complete()
+
+        # Keep the window full.
+        wanted = (i for i in range(self.chunks)
+                  if i not in self.received and i not in self.pending)
+
+        for index in wanted:
+            if len(self.pending) >= WINDOW or self.source != 'peers':
+                break
+
+            self.request(index)
+
+    def give_up_peers(self):
+        self.msg('No more peers for {}.', self.digest)
+
+        for peer, timer in self.pending.values():
+            timer.cancel()
+
+        self.pending.clear()
+        self.received.clear()
+        self.chunks = None
+        self.fp.close()
+
+        self.source = None
+        self.from_origin()
+
+    def from_origin(self):
+        self.cancel_timer()
+        self.msg('Fetching {} from origin {}...', self.digest, self.url)
+        self.source = 'origin'
+
+        # Let the others know so that they wait for us.
+        self.cache.advertise()
+
+        self.fp = open(self.partial, 'wb')
+
+        agent = Agent(reactor)
+        d = agent.request(b'GET', self.url.encode('utf-8'))
+        d.addCallback(self.on_response)
+        d.addErrback(self.on_failure)
+
+    def on_response(self, response):
+        if response.code != 200:
+            raise IOError('origin returned {}'.format(response.code))
+
+        done = Deferred()
+        response.deliverBody(BodyWriter(self.fp, self.cache.stats, done))
+        done.addCallback(lambda result: self.complete())
+        return done
+
+    def on_failure(self, failure):
+        self.warn('Failed to fetch {}: {}', self.digest,
+                  failure.getErrorMessage())
+        self.finish(failure)
+
+    def complete(self):
+        """
+        Verify the downloaded file and make it available.
+        """
+
+        self.fp.close()
+        digest = sha256()
+
+        with open(self.partial, 'rb') as fp:
+            for block in iter(lambda: fp.read(2**20), b''):
+                digest.update(block)
+
+        if digest.hexdigest() != self.digest:
+            self.warn('Hash mismatch of {} from {}.', self.digest, self.source)
+
+            if self.source == 'peers':
+                # Do not trust any of them with this file.
+                self.failed.update(self.cache.holders.get(self.digest, ()))
+                return self.from_origin()
+
+            return self.finish(IOError('hash mismatch'))
+
+        rename(self.partial, self.cache.path(self.digest))
+        self.msg('Fetched {} from {}.', self.digest, self.source)
+
+        self.finish(self.cache.path(self.digest))
+
+        # Offer it to the others right away.
+        self.cache.advertise()
+
+    def finish(self, result):
+        self.cache.downloads.pop(self.digest, None)
+
+        if self.fp is not None and not self.fp.closed:
+            self.fp.close()
+
+        if exists(self.partial):
+            unlink(self.partial)
+
+        for d in self.waiters:
+            if isinstance(result, str):
+                d.callback(result)
+            else:
+                d.errback(result)
+
+        self.waiters = []
+
+
+class BodyWriter (Protocol):
+    """
+    Writes response body to a file.
+    """
+
+    def __init__(self, fp, stats, done):
+        self.fp = fp
+        self.stats = stats
+        self.done = done
+
+    def dataReceived(self, data):
+        self.fp.write(data)
+        self.stats['origin_bytes'] += len(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.done.callback(None)
+        else:
+            self.done.errback(reason)
+
+
+if __name__ == '__main__':
+    # Run a standalone peer, for example in several terminals:
+    #
+    #   python3 -m telescreen.peers tcp://127.0.0.1:6001 /tmp/a \
+    #       --peer=tcp://127.0.0.1:6002 --fetch=<sha256>@<url>
+    #
+    from getopt import gnu_getopt
+    from twisted.python import log
+    from sys import argv, stderr, exit
+
+    from telescreen import common
+
+    opts, args = gnu_getopt(argv[1:], 'p:f:', ['peer=', 'fetch='])
+
+    if len(args) != 2:
+        print('Usage: python3 -m telescreen.peers endpoint directory '
+              '[--peer=endpoint] [--fetch=sha256@url]')
+        exit(1)
+
+    peers = [v for k, v in opts if k in ('--peer', '-p')]
+    fetches = [v.split('@', 1) for k, v in opts if k in ('--fetch', '-f')]
+
+    log.startLogging(stderr)
+    common.level = common.INFO
+
+    cache = PeerCache(args[0], peers, args[1])
+
+    def report(result):
+        print('fetched', result, cache.status())
+
+    def start():
+        cache.start()
+
+        for digest, url in fetches:
+            cache.fetch(digest, url).addBoth(report)
+
+    reactor.callLater(0, start)
+    reactor.run()
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,358 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left
+from datetime import datetime, time, timedelta
+from heapq import heappush, heappop
+from itertools import count, takewhile
+from operator import itemgetter
+from simplejson import dumps
+
+
+__all__ = ['Plan', 'PlanQueue', 'TaskView', 'expand_loop']
+
+
+class Missing:
+    """
+    Placeholder for fields a task does not have.
+    """
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+MISSING_KEY = ('Missing', None)
+
+
+class Plan:
+    """
+    Compact, read-only plan sorted by the task start times.
+
+    Validated plans from the leader are lists of dicts that repeat the
+    same keys, types and often the same URLs over and over.  Here the
+    start and end times are kept in two arrays of doubles and every
+    other field is an array of indexes into a table of distinct values,
+    so that tens of thousands of tasks cost a few bytes each.
+
+    Tasks are accessed through light-weight ``TaskView`` instances that
+    behave like the original dicts.
+
+    Recurring loops are kept as they are and only expanded when needed,
+    see ``expand_loop``.
+    """
+
+    __slots__ = ('starts', 'ends', 'columns', 'values', 'loops')
+
+    def __init__(self, tasks=(), loops=()):
+        self.loops = list(loops)
+
+        tasks = sorted(tasks, key=itemgetter('start'))
+
+        self.starts = array('d', [task['start'] for task in tasks])
+        self.ends = array('d', [task['end'] for task in tasks])
+
+        # Field name -> array of indexes into the values of the field.
+        self.columns = {}
+
+        # Field name -> distinct values, first one is always MISSING.
+        self.values = {}
+
+        fields = set()
+        for task in tasks:
+            fields.update(task)
+
+        fields.difference_update(('start', 'end'))
+
+        for field in sorted(fields):
+            raw = [task.get(field, MISSING) for task in tasks]
+
+            # Strings are by far the most common, use them as they are.
+            keys = [value if type(value) is str else intern_key(value)
+                    for value in raw]
+
+            seen = {MISSING_KEY: 0}
+            column = array('I', [seen.setdefault(key, len(seen))
+                                 for key in keys])
+
+            values = [MISSING] * len(seen)
+            for index, value in zip(column, raw):
+                values[index] = value
+
+            self.columns[field] = column
+            self.values[field] = values
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return len(self.starts) > 0 or len(self.loops) > 0
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError('plan index out of range')
+
+        return TaskView(self, index % len(self))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TaskView(self, index)
+
+    def __repr__(self):
+        return 'Plan({} tasks)'.format(len(self))
+
+    def distinct(self, field):
+        """
+        Return first task with every distinct value of the field.
+        """
+
+        column = self.columns.get(field, ())
+        first = {}
+
+        for index, value in enumerate(column):
+            if value and value not in first:
+                first[value] = index
+
+        return [TaskView(self, index) for index in first.values()]
+
+    def window(self, ending_after, starting_before):
+        """
+        Return list of tasks in the given window.
+        """
+
+        ends = self.ends
+        stop = bisect_left(self.starts, starting_before)
+
+        tasks = [TaskView(self, i) for i in range(stop)
+                 if ending_after < ends[i]]
+
+        for loop in self.loops:
+            tasks.extend(takewhile(
+                lambda task: task['start'] < starting_before,
+                expand_loop(loop, ending_after)))
+
+        return tasks
+
+
+class TaskView:
+    """
+    Read-only dict-like view of a single task in a ``Plan``.
+    """
+
+    __slots__ = ('plan', 'index')
+
+    def __init__(self, plan, index):
+        self.plan = plan
+        self.index = index
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+
+        if value is MISSING:
+            raise KeyError(key)
+
+        return value
+
+    def get(self, key, default=None):
+        if key == 'start':
+            return self.plan.starts[self.index]
+
+        if key == 'end':
+            return self.plan.ends[self.index]
+
+        column = self.plan.columns.get(key)
+
+        if column is None:
+            return default
+
+        value = self.plan.values[key][column[self.index]]
+        return default if value is MISSING else value
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def keys(self):
+        keys = ['start', 'end']
+
+        for field, column in self.plan.columns.items():
+            if column[self.index]:
+                keys.append(field)
+
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, TaskView):
+            if other.plan is self.plan:
+                return other.index == self.index
+
+            return self.items() == other.items()
+
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'TaskView({!r})'.format(dict(self.items()))
+
+
+class PlanQueue:
+    """
+    Tasks of a plan remaining to be scheduled.
+
+    Instead of copying the plan and popping from the front of the copy,
+    the queue only remembers position of the next task.  Tasks of the
+    loops are generated as the queue advances and merged in.
+    """
+
+    __slots__ = ('plan', 'cursor', 'heap', 'order')
+
+    def __init__(self, plan, cursor=0):
+        self.plan = plan
+        self.cursor = cursor
+
+        # Next task of every loop as (start, order, task, generator),
+        # created on the first pop so that the loops start from then.
+        self.heap = None
+        self.order = count()
+
+    def __len__(self):
+        return len(self.plan) - self.cursor
+
+    def pop(self, secs, now):
+        """
+        Remove tasks starting in the next ``secs`` seconds.
+
+        Tasks that have already ended are skipped.
+        """
+
+        plan = self.plan
+        starts = plan.starts
+        ends = plan.ends
+        limit = now + secs
+        tasks = []
+
+        while self.cursor < len(starts):
+            index = self.cursor
+
+            # Stop at tasks too far in the future.
+            if starts[index] > limit:
+                break
+
+            self.cursor += 1
+
+            # Discard tasks already in the past.
+            if ends[index] < now:
+                continue
+
+            # Schedule this task next...
+            tasks.append(TaskView(plan, index))
+
+        if self.heap is None:
+            self.heap = []
+
+            for loop in plan.loops:
+                self.advance(expand_loop(loop, now))
+
+        while self.heap and self.heap[0][0] <= limit:
+            start, order, task, tasks_of_loop = heappop(self.heap)
+            self.advance(tasks_of_loop)
+
+            if task['end'] >= now:
+                tasks.append(task)
+
+        tasks.sort(key=itemgetter('start'))
+        return tasks
+
+    def advance(self, tasks_of_loop):
+        """
+        Put next task of the loop on the heap, unless the loop ended.
+        """
+
+        task = next(tasks_of_loop, None)
+
+        if task is not None:
+            heappush(self.heap, (task['start'], next(self.order),
+                                 task, tasks_of_loop))
+
+
+def expand_loop(loop, since):
+    """
+    Generate tasks of a recurring loop ending after the given time.
+
+    Loop items are played back to back from ``from`` to ``to`` seconds
+    after the local midnight of every listed week day (0 is Monday),
+    over and over, with the last one cut short at the end of the day.
+    Only days between the optional ``start`` and ``end`` of the loop are
+    considered.  The generator is endless unless the loop ends.
+    """
+
+    items = loop['items']
+    days = set(loop['days'])
+
+    if not items or not days or loop['from'] >= loop['to']:
+        return
+
+    first = max(since, loop.get('start', since))
+    last = loop.get('end', float('inf'))
+    zone = loop.get('zone', 'main')
+    cycle = sum(item['duration'] for item in items)
+
+    day = datetime.fromtimestamp(first).date() - timedelta(days=1)
+
+    while True:
+        day += timedelta(days=1)
+        midnight = datetime.combine(day, time()).timestamp()
+
+        if midnight + loop['from'] >= last:
+            return
+
+        if day.weekday() not in days:
+            continue
+
+        start = midnight + loop['from']
+        finish = min(midnight + loop['to'], last)
+
+        # Skip whole rounds of the loop that ended before we start.
+        if start < first:
+            start += (first - start) // cycle * cycle
+
+        while start < finish:
+            for item in items:
+                end = min(start + item['duration'], finish)
+
+                if end > first and start >= loop.get('start', start):
+                    task = dict(item, start=start, end=end, zone=zone)
+                    del task['duration']
+                    yield task
+
+                start = end
+
+                if start >= finish:
+                    break
+
+
+def intern_key(value):
+    """
+    Return hashable key identifying the value.
+    """
+
+    if value is MISSING:
+        return MISSING_KEY
+
+    if isinstance(value, (list, dict)):
+        return (type(value).__name__, dumps(value, sort_keys=True))
+
+    # Keep 1 and True apart, they hash the same.
+    return (type(value).__name__, value)
+
+
+# vim:set sw=4 ts=4 et:
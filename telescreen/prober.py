@@ -0,0 +1,323 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.defer import Deferred, DeferredSemaphore, succeed
+from twisted.internet.utils import getProcessOutputAndValue
+from twisted.internet import reactor
+
+from os import makedirs, rename, environ
+from os.path import dirname, exists
+from simplejson import dumps, loads, JSONDecodeError
+from time import time
+
+from telescreen.common import Logging
+
+import sys
+
+
+__all__ = ['Prober', 'assess', 'hints', 'discover']
+
+
+# Where the results are kept across restarts.
+INDEX_PATH = '/var/lib/telescreen/media.json'
+
+# Number of probes running at the same time.  Probing competes with
+# the playback, so keep it low.
+PROBE_WORKERS = 1
+
+# Longest time a single discovery may take, in seconds.
+PROBE_TIMEOUT = 20
+
+# Results for URLs without a content hash may go stale, probe them
+# again after this many seconds.
+URL_TTL = 24 * 3600
+
+# Most results kept in each of the tables.
+MAX_ENTRIES = 5000
+
+# Delay before the index is written out after a change.
+SAVE_DELAY = 5
+
+# Decoded pixels per second the box handles comfortably.
+MAX_PIXEL_RATE = 1920 * 1080 * 60
+
+
+class Prober (Logging):
+    """
+    Learns about the media before they are played.
+
+    GStreamer discovery runs in separate processes, so that a broken
+    file cannot take the telescreen down, and only a few at a time.
+    Results are kept in an index keyed by the content hash when known
+    and by the URL otherwise and persisted across restarts.
+
+    Only results saying something about the media themselves are kept.
+    Unreachable servers and timeouts are forgotten, so that the media
+    get probed again later.
+    """
+
+    def __init__(self, path=INDEX_PATH, workers=PROBE_WORKERS,
+                 executable=None, clock=reactor):
+        self.path = path
+        self.clock = clock
+
+        if executable is None:
+            executable = sys.argv[0]
+
+        self.executable = executable
+
+        # Results by content hash and by URL.
+        self.hashes = {}
+        self.urls = {}
+
+        # Probes in progress by URL, with Deferreds waiting for them.
+        self.pending = {}
+
+        self.workers = DeferredSemaphore(workers)
+        self.save_timer = None
+
+        self.stats = {
+            'probed': 0,
+            'failed': 0,
+        }
+
+    def logPrefix(self):
+        return 'prober'
+
+    def load(self):
+        """
+        Read results of earlier probes.
+        """
+
+        if not exists(self.path):
+            return
+
+        try:
+            with open(self.path) as fp:
+                index = loads(fp.read())
+
+            self.hashes = index.get('hashes', {})
+            self.urls = index.get('urls', {})
+
+        except (OSError, JSONDecodeError, AttributeError) as e:
+            self.warn('Failed to load media index: {}', e)
+
+        self.msg('Loaded {} media descriptions.',
+                 len(self.hashes) + len(self.urls))
+
+    def save(self):
+        """
+        Write the index out, atomically.
+        """
+
+        self.save_timer = None
+
+        for table in (self.hashes, self.urls):
+            if len(table) > MAX_ENTRIES:
+                ordered = sorted(table, key=lambda k: table[k]['probed'])
+
+                for key in ordered[:len(table) - MAX_ENTRIES]:
+                    del table[key]
+
+        makedirs(dirname(self.path), exist_ok=True)
+        temp = self.path + '.new'
+
+        with open(temp, 'w') as fp:
+            fp.write(dumps({'hashes': self.hashes, 'urls': self.urls}))
+
+        rename(temp, self.path)
+
+    def lookup(self, url, digest=None):
+        """
+        Return known description of the media or None.
+        """
+
+        if digest is not None and digest in self.hashes:
+            return self.hashes[digest]
+
+        info = self.urls.get(url)
+
+        if info is not None and info['probed'] + URL_TTL > time():
+            return info
+
+        return None
+
+    def probe(self, url, digest=None):
+        """
+        Describe the media, probing them when not known yet.
+
+        Returns a Deferred firing with the description or None when the
+        media could not be probed right now.
+        """
+
+        info = self.lookup(url, digest)
+
+        if info is not None:
+            return succeed(info)
+
+        d = Deferred()
+
+        if url in self.pending:
+            self.pending[url].append(d)
+            return d
+
+        self.pending[url] = [d]
+
+        run = self.workers.run(self.discover, url)
+        run.addCallback(self.on_result, url, digest)
+        run.addErrback(self.on_failure, url)
+        run.addCallback(self.finish, url)
+
+        return d
+
+    def discover(self, url):
+        self.debug('Probing {}...', url)
+        return getProcessOutputAndValue(self.executable,
+                                        ['--quiet', '--probe', url],
+                                        env=environ)
+
+    def on_result(self, result, url, digest):
+        out, err, code = result
+
+        if code != 0:
+            raise IOError('prober exited with {}'.format(code))
+
+        info = loads(out.decode('utf-8'))
+
+        if 'unreachable' in info:
+            self.debug('Cannot probe {} now: {}', url, info['unreachable'])
+            return None
+
+        self.stats['probed'] += 1
+
+        if digest is not None:
+            self.hashes[digest] = info
+        else:
+            self.urls[url] = info
+
+        if self.save_timer is None:
+            self.save_timer = self.clock.callLater(SAVE_DELAY, self.save)
+
+        return info
+
+    def on_failure(self, reason, url):
+        self.stats['failed'] += 1
+        self.warn('Failed to probe {}: {}', url, reason.getErrorMessage())
+
+    def finish(self, info, url):
+        for d in self.pending.pop(url, []):
+            d.callback(info)
+
+    def status(self):
+        return dict(self.stats, known=len(self.hashes) + len(self.urls),
+                    pending=len(self.pending))
+
+
+def assess(info, media):
+    """
+    Find out whether there is something wrong with the media.
+
+    Returns None when the media should play fine, otherwise a tuple of
+    ``undecodable`` or ``heavy`` and a description of the problem.
+    """
+
+    if info['error'] is not None:
+        return ('undecodable', info['error'])
+
+    if info['missing']:
+        return ('undecodable', 'missing ' + ', '.join(info['missing']))
+
+    if not info['video']:
+        return ('undecodable', 'no picture')
+
+    for video in info['video']:
+        fps = video['fps'] or 1
+        rate = video['width'] * video['height'] * fps
+
+        if media != 'image' and rate > MAX_PIXEL_RATE:
+            return ('heavy', '{}x{}@{:g} {}'.format(
+                video['width'], video['height'], fps, video['codec']))
+
+    return None
+
+
+def hints(info):
+    """
+    Return decoder hints for the media.
+    """
+
+    return {
+        'audio': int(bool(info['audio'])),
+        'text': int(bool(info['subtitles'])),
+    }
+
+
+def discover(url, timeout=PROBE_TIMEOUT):
+    """
+    Describe the media using GStreamer discovery.
+
+    Runs in the prober process, see ``telescreen --probe``.
+    """
+
+    from gi.repository import GLib, Gst, GstPbutils
+
+    info = {
+        'probed': time(),
+        'error': None,
+        'missing': [],
+        'duration': None,
+        'seekable': False,
+        'live': False,
+        'video': [],
+        'audio': [],
+        'subtitles': 0,
+    }
+
+    discoverer = GstPbutils.Discoverer.new(timeout * Gst.SECOND)
+
+    try:
+        result = discoverer.discover_uri(url)
+
+    except GLib.Error as e:
+        # Say nothing about the media when we could not get to them.
+        if e.domain == 'gst-resource-error-quark' \
+                or 'timeout' in e.message.lower():
+            return {'unreachable': e.message}
+
+        info['error'] = e.message
+        return info
+
+    if result.get_result() == GstPbutils.DiscovererResult.MISSING_PLUGINS:
+        info['missing'] = list(result.get_missing_elements_installer_details())
+
+    duration = result.get_duration()
+
+    if duration != Gst.CLOCK_TIME_NONE:
+        info['duration'] = duration / Gst.SECOND
+
+    info['seekable'] = result.get_seekable()
+    info['live'] = result.get_live()
+
+    for stream in result.get_video_streams():
+        fps = stream.get_framerate_num() / (stream.get_framerate_denom() or 1)
+
+        info['video'].append({
+            'codec': stream.get_caps().get_structure(0).get_name(),
+            'width': stream.get_width(),
+            'height': stream.get_height(),
+            'fps': None if stream.is_image() else fps,
+        })
+
+    for stream in result.get_audio_streams():
+        info['audio'].append({
+            'codec': stream.get_caps().get_structure(0).get_name(),
+            'channels': stream.get_channels(),
+            'rate': stream.get_sample_rate(),
+        })
+
+    info['subtitles'] = len(result.get_subtitle_streams())
+
+    return info
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,184 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor
+
+from collections import Counter
+from os import getpid, makedirs
+from os.path import join, basename
+from threading import Thread, Event, main_thread
+from time import strftime
+
+import cProfile
+import sys
+
+from telescreen.common import Logging
+
+
+__all__ = ['Profiler']
+
+
+# Where the profiles are written to.
+PROFILE_DIR = '/var/tmp/telescreen'
+
+# Default and maximal length of the profiling window, in seconds.
+DEFAULT_DURATION = 30
+MAX_DURATION = 600
+
+# Interval between two samples of the sampling profiler, in seconds.
+SAMPLE_INTERVAL = 0.005
+
+
+class Sampler (Thread):
+    """
+    Thread periodically sampling stack of the main thread.
+
+    Stacks are counted in the folded format understood by the usual
+    flame graph tools, one ``frame;frame;frame count`` per line.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name='sampler', daemon=True)
+
+        self.interval = interval
+        self.target = main_thread().ident
+        self.stacks = Counter()
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(basename(code.co_filename),
+                                            code.co_name))
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def dump(self, path):
+        with open(path, 'w') as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write('{} {}\n'.format(stack, count))
+
+
+class Profiler (Logging):
+    """
+    Runtime profiler that can be started and stopped at will.
+
+    Profiles are collected for a bounded window and written to the
+    profile directory as ``<session>-<name>-<pid>.<ext>`` files, where
+    the session groups profiles of cooperating processes together.
+    The ``sample`` mode uses a cheap sampling profiler producing folded
+    stacks, the ``trace`` mode uses the deterministic cProfile and
+    produces pstats files.
+    """
+
+    def __init__(self, name, directory=PROFILE_DIR):
+        self.name = name
+        self.directory = directory
+
+        self.session = None
+        self.mode = None
+        self.profile = None
+        self.sampler = None
+        self.timer = None
+
+    def logPrefix(self):
+        return 'profiler'
+
+    @property
+    def running(self):
+        return self.session is not None
+
+    def start(self, mode='sample', duration=DEFAULT_DURATION, session=None):
+        """
+        Start profiling for the given number of seconds.
+        """
+
+        if self.running:
+            self.msg('Already profiling, ignoring.')
+            return None
+
+        if session is None:
+            session = strftime('%Y%m%d-%H%M%S')
+
+        duration = max(1, min(duration, MAX_DURATION))
+
+        self.msg('Starting {} profiler for {} seconds...', mode, duration)
+
+        self.session = session
+        self.mode = mode
+
+        makedirs(self.directory, exist_ok=True)
+
+        if mode == 'trace':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.sampler = Sampler()
+            self.sampler.start()
+
+        self.timer = reactor.callLater(duration, self.stop)
+        return session
+
+    def stop(self):
+        """
+        Stop profiling and write the profile to disk.
+        """
+
+        if not self.running:
+            return None
+
+        if self.timer.active():
+            self.timer.cancel()
+
+        path = self.path('pstats' if self.mode == 'trace' else 'folded')
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(path)
+            self.profile = None
+
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.dump(path)
+            self.sampler = None
+
+        self.msg('Profile written to {}.', path)
+        self.on_done(path)
+        self.session = None
+
+        return path
+
+    def on_done(self, path):
+        """Method called once a profile have been written. Override."""
+        pass
+
+    def toggle(self):
+        """
+        Start or stop profiling, used from signal handlers.
+        """
+
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def path(self, ext):
+        """
+        Return path of a profile file of the current session.
+        """
+
+        return join(self.directory, '{}-{}-{}.{}'
+                    .format(self.session, self.name, getpid(), ext))
+
+
+# vim:set sw=4 ts=4 et:
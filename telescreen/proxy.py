@@ -0,0 +1,695 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.defer import Deferred, TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.internet import reactor
+from twisted.protocols.basic import FileSender
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.client import FileBodyProducer
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.web.resource import Resource
+from twisted.web.server import Site, Request, NOT_DONE_YET
+
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from hashlib import sha256
+from io import BytesIO
+from os import makedirs, listdir, rename, unlink, utime
+from os.path import join, getmtime, getsize
+from simplejson import load, dump
+from time import time
+from uuid import uuid4
+
+from telescreen.common import Logging
+
+
+__all__ = ['CachingProxy']
+
+
+# Port the proxy listens on, on the loopback interface only.
+PROXY_PORT = 8780
+
+# Where the cached responses are kept.
+CACHE_DIR = '/var/cache/telescreen/web'
+
+# Total size of the cached response bodies.
+CACHE_LIMIT = 256 * 2**20
+
+# Responses larger than this fraction of the cache are passed through.
+ENTRY_FRACTION = 16
+
+# How long to wait for the upstream servers.
+CONNECT_TIMEOUT = 10
+UPSTREAM_TIMEOUT = 30
+
+# Responses without explicit lifetime stay fresh for this fraction of
+# time since their last modification, but at most for HEURISTIC_LIMIT.
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_LIMIT = 24 * 3600
+
+# Responses that may be stored.
+CACHEABLE = (200, 203, 300, 301, 404, 410)
+
+# Headers that only make sense for a single connection.
+HOP_BY_HOP = {
+    b'connection', b'keep-alive', b'proxy-authenticate',
+    b'proxy-authorization', b'proxy-connection', b'te', b'trailer',
+    b'transfer-encoding', b'upgrade',
+}
+
+# Headers of the request we do not pass upstream.  Encodings would have
+# to be decoded again, conditionals are ours to make and the length is
+# set by the agent.
+DROPPED = HOP_BY_HOP | {
+    b'content-length', b'accept-encoding',
+    b'if-none-match', b'if-modified-since', b'if-match',
+    b'if-unmodified-since', b'if-range', b'range',
+}
+
+
+class CachingProxy (Logging):
+    """
+    Caching HTTP proxy for the web views.
+
+    Screens show the same widgets over and over, often next to other
+    screens showing the very same ones.  Responses are kept on disk,
+    served right away while fresh according to their cache headers and
+    revalidated once they are stale.  When the upstream server cannot
+    be reached, stale responses are served anyway, so that the pages
+    survive uplink outages.  In the offline mode the network is not
+    used at all.
+
+    The cache is bounded and the least recently used responses are
+    evicted first.  Cache directives of the requests are ignored, pages
+    reloading themselves would otherwise bypass the cache.
+
+    Only plain HTTP can be cached, TLS connections go around the proxy.
+    """
+
+    def __init__(self, port=PROXY_PORT, directory=CACHE_DIR,
+                 limit=CACHE_LIMIT, offline=False, clock=reactor):
+        self.port = port
+        self.directory = directory
+        self.limit = limit
+        self.offline = offline
+        self.clock = clock
+
+        # Key -> size of the body, least recently used first.
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.stats = {
+            'hits': 0,
+            'revalidated': 0,
+            'misses': 0,
+            'stale': 0,
+            'passed': 0,
+            'errors': 0,
+        }
+
+        self.agent = Agent(reactor, connectTimeout=CONNECT_TIMEOUT,
+                           pool=quiet_pool(reactor))
+
+        self.listening = None
+
+    def logPrefix(self):
+        return 'proxy'
+
+    def uri(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        if self.listening is not None:
+            return
+
+        self.msg('Starting caching proxy on port {}{}...', self.port,
+                 ', offline' if self.offline else '')
+
+        makedirs(self.directory, exist_ok=True)
+        self.load()
+
+        self.listening = reactor.listenTCP(self.port,
+                                           QuietSite(ProxyResource(self)),
+                                           interface='127.0.0.1')
+
+    def stop(self):
+        if self.listening is not None:
+            self.listening.stopListening()
+            self.listening = None
+
+    def set_offline(self, offline):
+        if offline != self.offline:
+            self.msg('Switching {} the offline mode.',
+                     'to' if offline else 'out of')
+            self.offline = offline
+
+    def load(self):
+        """
+        Find responses cached before, drop incomplete ones.
+        """
+
+        names = set(listdir(self.directory))
+        found = []
+
+        for name in names:
+            path = join(self.directory, name)
+
+            if name.endswith('.tmp'):
+                unlink(path)
+
+            elif name.endswith('.json'):
+                if name[:-5] in names:
+                    found.append((getmtime(path), name[:-5]))
+                else:
+                    unlink(path)
+
+            elif name + '.json' not in names:
+                unlink(path)
+
+        for mtime, key in sorted(found):
+            size = getsize(self.path(key))
+            self.entries[key] = size
+            self.size += size
+
+        self.msg('Found {} cached responses, {} MiB.',
+                 len(self.entries), self.size // 2**20)
+        self.evict()
+
+    def path(self, key):
+        return join(self.directory, key)
+
+    def lookup(self, key, url):
+        """
+        Return metadata of the cached response or None.
+        """
+
+        if key not in self.entries:
+            return None
+
+        try:
+            with open(self.path(key) + '.json') as fp:
+                meta = load(fp)
+        except (OSError, ValueError):
+            self.forget(key)
+            return None
+
+        if meta['url'] != url:
+            return None
+
+        return meta
+
+    def handle(self, request):
+        """
+        Answer request of a web view, from the cache if possible.
+        """
+
+        url = request.uri.decode('latin-1')
+
+        if not url.startswith('http://'):
+            request.setResponseCode(400)
+            return b'Only absolute HTTP URLs can be proxied.\n'
+
+        if request.method not in (b'GET', b'HEAD'):
+            self.forward(request, url, None, None)
+            return NOT_DONE_YET
+
+        key = sha256(url.encode('utf-8')).hexdigest()
+        meta = self.lookup(key, url)
+
+        if meta is not None and (self.offline or is_fresh(meta, time())):
+            self.stats['hits'] += 1
+            self.serve(request, key, meta)
+            return NOT_DONE_YET
+
+        if self.offline:
+            request.setResponseCode(504)
+            return b'Not cached and offline.\n'
+
+        self.forward(request, url, key, meta)
+        return NOT_DONE_YET
+
+    def forward(self, request, url, key, meta):
+        """
+        Pass the request upstream, revalidating the cached response.
+        """
+
+        headers = Headers()
+
+        for name, values in request.requestHeaders.getAllRawHeaders():
+            if name.lower() not in DROPPED:
+                headers.setRawHeaders(name, values)
+
+        if meta is not None:
+            for name, value in meta['headers']:
+                if name.lower() == 'etag':
+                    headers.addRawHeader(b'If-None-Match',
+                                         value.encode('latin-1'))
+                elif name.lower() == 'last-modified':
+                    headers.addRawHeader(b'If-Modified-Since',
+                                         value.encode('latin-1'))
+
+        body = None
+        content = request.content.read()
+
+        if content:
+            body = FileBodyProducer(BytesIO(content))
+
+        d = self.agent.request(request.method, url.encode('utf-8'),
+                               headers, body)
+        d.addTimeout(UPSTREAM_TIMEOUT, self.clock)
+        d.addCallback(self.on_response, request, url, key, meta)
+        d.addErrback(self.on_failure, request, url, key, meta)
+
+    def on_response(self, response, request, url, key, meta):
+        if meta is not None:
+            if response.code == 304:
+                response.deliverBody(Protocol())
+
+                self.stats['revalidated'] += 1
+                meta = refresh(meta, response)
+                self.write_meta(key, meta)
+                self.serve(request, key, meta)
+                return
+
+            if response.code >= 500:
+                response.deliverBody(Protocol())
+                self.stale(request, key, meta, 'upstream {}'
+                           .format(response.code))
+                return
+
+        request.setResponseCode(response.code, response.phrase)
+
+        for name, values in response.headers.getAllRawHeaders():
+            if name.lower() not in HOP_BY_HOP | {b'content-length'}:
+                request.responseHeaders.setRawHeaders(name, values)
+
+        fp = None
+        temp = None
+
+        if key is not None and self.storable(request, response):
+            self.stats['misses'] += 1
+            temp = '{}.{}.tmp'.format(self.path(key), uuid4().hex[:8])
+            fp = open(temp, 'wb')
+        else:
+            self.stats['passed'] += 1
+
+        done = Deferred()
+        relay = Relay(request, fp, self.limit // ENTRY_FRACTION, done)
+        response.deliverBody(relay)
+
+        def finished(stored):
+            if not request.gone:
+                request.finish()
+
+            if stored:
+                self.store(key, temp, {
+                    'url': url,
+                    'code': response.code,
+                    'headers': decode_headers(response.headers),
+                    'stored': time(),
+                })
+
+        def failed(reason):
+            self.warn('Response for {} broken: {}', url,
+                      reason.getErrorMessage())
+
+            if not request.gone:
+                request.loseConnection()
+
+        done.addCallbacks(finished, failed)
+
+    def on_failure(self, reason, request, url, key, meta):
+        self.stats['errors'] += 1
+
+        if meta is not None:
+            self.stale(request, key, meta, reason.getErrorMessage())
+            return
+
+        self.warn('Failed to fetch {}: {}', url, reason.getErrorMessage())
+
+        if not request.finished and not request.gone:
+            request.setResponseCode(504 if reason.check(TimeoutError)
+                                    else 502)
+            request.write(b'Upstream server unreachable.\n')
+            request.finish()
+
+    def stale(self, request, key, meta, why):
+        """
+        Serve stale response because the upstream server is unavailable.
+        """
+
+        self.debug('Serving stale {} ({}).', meta['url'], why)
+        self.stats['stale'] += 1
+
+        request.responseHeaders.addRawHeader(
+            b'Warning', b'111 - "Revalidation Failed"')
+        self.serve(request, key, meta)
+
+    def storable(self, request, response):
+        """
+        Decide whether the response may be stored.
+        """
+
+        if request.method != b'GET' or response.code not in CACHEABLE:
+            return False
+
+        directives = cache_control(response.headers)
+
+        if 'no-store' in directives:
+            return False
+
+        if request.requestHeaders.hasHeader(b'authorization'):
+            if 'public' not in directives:
+                return False
+
+        for value in response.headers.getRawHeaders(b'vary', []):
+            for name in value.split(b','):
+                if name.strip().lower() not in (b'', b'accept-encoding'):
+                    return False
+
+        if response.length is not UNKNOWN_LENGTH:
+            if response.length > self.limit // ENTRY_FRACTION:
+                return False
+
+        return True
+
+    def serve(self, request, key, meta):
+        """
+        Send the cached response to the web view.
+        """
+
+        if request.finished or request.gone:
+            return
+
+        path = self.path(key)
+
+        try:
+            fp = open(path, 'rb')
+        except OSError:
+            self.forget(key)
+            request.setResponseCode(504)
+            request.finish()
+            return
+
+        self.entries.move_to_end(key)
+        utime(path + '.json')
+
+        request.setResponseCode(meta['code'])
+
+        # Replace our own Date and Server headers with the original ones.
+        headers = OrderedDict()
+
+        for name, value in meta['headers']:
+            if name.lower() not in ('content-length', 'transfer-encoding'):
+                headers.setdefault(name.encode('latin-1'), []) \
+                       .append(value.encode('latin-1'))
+
+        for name, values in headers.items():
+            request.responseHeaders.setRawHeaders(name, values)
+
+        request.setHeader(b'Content-Length',
+                          str(self.entries[key]).encode('ascii'))
+
+        if request.method == b'HEAD':
+            fp.close()
+            request.finish()
+            return
+
+        def done(result):
+            fp.close()
+
+            if not request.gone:
+                request.finish()
+
+        FileSender().beginFileTransfer(fp, request).addBoth(done)
+
+    def store(self, key, temp, meta):
+        """
+        Make a completely received response part of the cache.
+        """
+
+        path = self.path(key)
+
+        self.forget(key, remove=False)
+        rename(temp, path)
+        self.write_meta(key, meta)
+
+        size = getsize(path)
+        self.entries[key] = size
+        self.size += size
+
+        self.evict()
+
+    def write_meta(self, key, meta):
+        temp = '{}.{}.tmp'.format(self.path(key), uuid4().hex[:8])
+
+        with open(temp, 'w') as fp:
+            dump(meta, fp)
+
+        rename(temp, self.path(key) + '.json')
+
+    def forget(self, key, remove=True):
+        """
+        Drop response from the cache.
+        """
+
+        size = self.entries.pop(key, None)
+
+        if size is not None:
+            self.size -= size
+
+        if remove:
+            for path in (self.path(key), self.path(key) + '.json'):
+                try:
+                    unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def evict(self):
+        """
+        Drop least recently used responses over the limit.
+        """
+
+        while self.size > self.limit and self.entries:
+            key = next(iter(self.entries))
+            self.debug('Evicting {}.', key)
+            self.forget(key)
+
+    def status(self):
+        """
+        Return cache statistics for the leader.
+        """
+
+        return dict(self.stats, entries=len(self.entries), size=self.size,
+                    offline=self.offline)
+
+
+class ProxyResource (Resource):
+    """
+    Web resource answering all requests through the proxy.
+    """
+
+    isLeaf = True
+
+    def __init__(self, proxy):
+        super().__init__()
+        self.proxy = proxy
+
+    def render(self, request):
+        return self.proxy.handle(request)
+
+
+class ProxyRequest (Request):
+    """
+    Request that remembers whether the web view went away.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.gone = False
+        self.notifyFinish().addErrback(self.on_gone)
+
+    def on_gone(self, reason):
+        self.gone = True
+
+
+class QuietSite (Site):
+    """
+    Site that does not log every request.
+    """
+
+    requestFactory = ProxyRequest
+
+    def log(self, request):
+        pass
+
+
+class Relay (Protocol):
+    """
+    Passes response body to the web view and to a cache file.
+    """
+
+    def __init__(self, request, fp, limit, done):
+        self.request = request
+        self.fp = fp
+        self.limit = limit
+        self.done = done
+        self.written = 0
+
+    def dataReceived(self, data):
+        if not self.request.gone:
+            self.request.write(data)
+
+        if self.fp is not None:
+            self.written += len(data)
+
+            if self.written > self.limit:
+                # Turned out too large to be cached.
+                self.discard()
+            else:
+                self.fp.write(data)
+
+    def discard(self):
+        self.fp.close()
+        unlink(self.fp.name)
+        self.fp = None
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            if self.fp is not None:
+                self.fp.close()
+                self.done.callback(True)
+            else:
+                self.done.callback(False)
+        else:
+            if self.fp is not None:
+                self.discard()
+
+            self.done.errback(reason)
+
+
+def quiet_pool(reactor):
+    """
+    Return connection pool that does not log every connection.
+
+    Twisted offers no public way to silence the client factory of the
+    pool, so it is only replaced as long as it is where we expect it.
+    """
+
+    pool = HTTPConnectionPool(reactor)
+    factory = getattr(pool, '_factory', None)
+
+    if isinstance(factory, type):
+        pool._factory = type('QuietClientFactory', (factory,),
+                             {'noisy': False})
+
+    return pool
+
+
+def cache_control(headers):
+    """
+    Return directives of the Cache-Control header as a dict.
+    """
+
+    directives = {}
+
+    for value in headers.getRawHeaders(b'cache-control', []):
+        for item in value.decode('latin-1').split(','):
+            name, _, arg = item.strip().partition('=')
+
+            if name:
+                directives[name.lower()] = arg.strip('"')
+
+    return directives
+
+
+def is_fresh(meta, now):
+    """
+    Decide whether the cached response can be served without asking.
+    """
+
+    headers = Headers()
+    for name, value in meta['headers']:
+        headers.addRawHeader(name.encode('latin-1'), value.encode('latin-1'))
+
+    directives = cache_control(headers)
+
+    if 'no-cache' in directives:
+        return False
+
+    date = header_time(headers, b'date') or meta['stored']
+
+    if 's-maxage' in directives or 'max-age' in directives:
+        try:
+            lifetime = int(directives.get('s-maxage',
+                                          directives.get('max-age')))
+        except ValueError:
+            lifetime = 0
+
+    elif headers.hasHeader(b'expires'):
+        expires = header_time(headers, b'expires')
+        lifetime = expires - date if expires else 0
+
+    elif headers.hasHeader(b'last-modified'):
+        modified = header_time(headers, b'last-modified') or date
+        lifetime = min((date - modified) * HEURISTIC_FRACTION,
+                       HEURISTIC_LIMIT)
+
+    else:
+        lifetime = 0
+
+    try:
+        age = int(headers.getRawHeaders(b'age', [b'0'])[0])
+    except ValueError:
+        age = 0
+
+    return age + now - meta['stored'] < lifetime
+
+
+def header_time(headers, name):
+    """
+    Return time in the header as a timestamp or None.
+    """
+
+    value = headers.getRawHeaders(name, [None])[0]
+
+    if value is None:
+        return None
+
+    try:
+        return parsedate_to_datetime(value.decode('latin-1')).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def refresh(meta, response):
+    """
+    Update metadata of a cached response with a revalidation response.
+    """
+
+    fresh = {name.lower(): [name, value]
+             for name, value in decode_headers(response.headers)}
+
+    headers = [fresh.pop(name.lower(), [name, value])
+               for name, value in meta['headers']]
+    headers.extend(fresh.values())
+
+    return dict(meta, headers=headers, stored=time())
+
+
+def decode_headers(headers):
+    """
+    Return response headers worth keeping as [name, value] pairs.
+    """
+
+    return [[name.decode('latin-1'), value.decode('latin-1')]
+            for name, values in headers.getAllRawHeaders()
+            if name.lower() not in HOP_BY_HOP
+            for value in values]
+
+
+# vim:set sw=4 ts=4 et:
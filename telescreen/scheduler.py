@@ -3,33 +3,68 @@
 
 from twisted.internet.task import LoopingCall
 from twisted.internet import reactor
-from twisted.python import log
 
 from telescreen.common import Logging
+from telescreen.metrics import histogram
+from telescreen.plan import Plan, PlanQueue
 from telescreen.screen import VideoItem, ImageItem, StreamItem
 
 
-__all__ = ['Scheduler', 'ItemScheduler', 'LayoutScheduler', 'PowerScheduler']
+__all__ = ['Scheduler', 'ItemScheduler', 'LayoutScheduler', 'PowerScheduler',
+           'engine_item_types']
 
 
+# How many seconds before a scheduled power-on to resume item playback,
+# so that the first item is already prerolled when the display wakes up.
+PREWAKE = 30
+
 ITEM_TYPES = {
     'video': VideoItem,
     'image': ImageItem,
     'stream': StreamItem,
 }
 
+# Item types that look the same no matter when they are started, so that
+# consecutive items with the same URL can be played as one.
+CONTINUOUS_TYPES = ('image', 'stream')
+
+
+def engine_item_types(engine):
+    """
+    Return item types of the playback engine.
+
+    The compositor is only imported when selected, since it needs the
+    GStreamer controller library the decoders do without.
+    """
+
+    if engine == 'compositor':
+        from telescreen import compositor
+
+        return {
+            'video': compositor.CompositedVideoItem,
+            'image': compositor.CompositedImageItem,
+            'stream': compositor.CompositedStreamItem,
+        }
+
+    return ITEM_TYPES
+
 
 class Scheduler (Logging):
     """
     Facilitates precise task planning and smooth plan transitions.
+
+    All timing goes through the clock, which is the reactor by default
+    but can be any ``IReactorTime`` provider, such as a ``task.Clock``.
     """
 
-    def __init__(self):
+    def __init__(self, clock=reactor):
+        self.clock = clock
+
         # Current plan is only used to detect differences to a new plan.
-        self.plan = []
+        self.plan = Plan()
 
         # Items remaining in the plan to be scheduled later.
-        self.queue = []
+        self.queue = PlanQueue(self.plan)
 
         # Tasks that are currently running.
         self.tasks = set()
@@ -47,6 +82,7 @@ class Scheduler (Logging):
 
         self.msg('Starting scheduling loop...')
         self.scheduling_loop = LoopingCall(self.schedule)
+        self.scheduling_loop.clock = self.clock
         self.scheduling_loop.start(5)
 
         self.msg('Scheduler started.')
@@ -57,28 +93,46 @@ class Scheduler (Logging):
         """
 
         event = None
-        delta = max(ts - reactor.seconds(), 0)
+        now = self.clock.seconds()
+        delta = max(ts - now, 0)
+        lateness = histogram(self.logPrefix() + '.lateness')
+
+        # Events already due, such as items starting mid-plan, are only
+        # late by how long the timer took, not by how old they are.
+        due = max(ts, now)
 
         def wrapper():
+            lateness.add(max(self.clock.seconds() - due, 0))
             self.events.discard(event)
             return fn(*args, **kwargs)
 
-        event = reactor.callLater(delta, wrapper)
+        event = self.clock.callLater(delta, wrapper)
         self.events.add(event)
+        return event
+
+    def cancel_event(self, event):
+        """
+        Cancel a pending event.
+        """
+
+        if event in self.events:
+            self.events.discard(event)
+            event.cancel()
 
     def change_plan(self, plan):
         """
         Install new plan from the leader and immediately reschedule.
         """
 
-        # First, sort the new plan by event start times.
-        plan.sort(key=lambda task: task['start'])
+        # First, pack the new plan sorted by event start times.
+        if not isinstance(plan, Plan):
+            plan = Plan(plan)
 
-        # Queue will be modified, plan will stay as it is.
-        queue = list(plan)
+        # Queue will advance, plan will stay as it is.
+        queue = PlanQueue(plan)
 
         # Establish a common time base.
-        now = reactor.seconds()
+        now = self.clock.seconds()
 
         # Catch up with the current scheduling.
         self.schedule(now)
@@ -90,19 +144,10 @@ class Scheduler (Logging):
 
         if cur != new:
             self.msg('Resetting schedule...')
-
-            # Stop and get rid of all currently instantiated tasks.
-            for task in list(self.tasks):
-                self.discard_task(task)
-                self.stop_task(task)
-
-            # Cancel all pending events.
-            for event in list(self.events):
-                self.events.discard(event)
-                event.cancel()
+            self.reset()
 
         else:
-            self.msg('Adjusting schedule...')
+            self.debug('Adjusting schedule...')
 
             # Work through the new queue up to the same point so that
             # the handoff will go smoothly and tasks won't overlap.
@@ -119,6 +164,21 @@ class Scheduler (Logging):
             # Reset when we have no plan at all.
             return self.no_plan()
 
+    def reset(self):
+        """
+        Stop all running tasks and cancel all pending events.
+        """
+
+        # Stop and get rid of all currently instantiated tasks.
+        for task in list(self.tasks):
+            self.discard_task(task)
+            self.stop_task(task)
+
+        # Cancel all pending events.
+        for event in list(self.events):
+            self.events.discard(event)
+            event.cancel()
+
     def schedule(self, now=None):
         """
         Schedule tasks coming up in the next minute.
@@ -127,6 +187,9 @@ class Scheduler (Logging):
         facilitate transition from the current to the incoming plan.
         """
 
+        if now is None:
+            now = self.clock.seconds()
+
         for task in pop_queue_tasks(self.queue, now=now):
             self.schedule_task(task)
 
@@ -152,44 +215,183 @@ class Scheduler (Logging):
 
 
 class ItemScheduler (Scheduler):
-    def __init__(self, screen):
-        super().__init__()
+    def __init__(self, screen, item_types=ITEM_TYPES, clock=reactor):
+        super().__init__(clock)
 
         self.screen = screen
+        self.item_types = item_types
+
+        # Playback is suspended while the display is off.
+        self.suspended = False
+
+        # Running items -> (type, end, stop event), used to extend them.
+        self.stops = {}
 
     def logPrefix(self):
         return 'item-sched'
 
+    def schedule(self, now=None):
+        """
+        Schedule upcoming items unless the playback is suspended.
+        """
+
+        if not self.suspended:
+            super().schedule(now)
+
+    def suspend(self):
+        """
+        Stop playback and do not prepare any more items.
+        """
+
+        if self.suspended:
+            return
+
+        self.msg('Suspending playback...')
+        self.suspended = True
+        self.reset()
+
+    def resume(self):
+        """
+        Resume playback of the current plan.
+        """
+
+        if not self.suspended:
+            return
+
+        self.msg('Resuming playback...')
+        self.suspended = False
+
+        # Items stopped on suspend need to be prepared again, so rebuild
+        # the queue from the whole plan and let schedule() skip the past.
+        self.queue = PlanQueue(self.plan)
+        self.schedule()
+
     def schedule_task(self, task):
         """
         Schedule playback of a specific item.
         """
 
+        problem = self.check_task(task)
+
+        if problem is not None:
+            self.msg('Skipping {} ({}).', task['url'], problem)
+            return
+
+        url = self.resolve_url(task)
+
+        # Keep playing the same stream instead of reconnecting.
+        item = self.continued_item(task, url)
+
+        if item is not None:
+            return self.extend_task(item, task)
+
         # Create the item using the correct class and register it.
-        ItemType = ITEM_TYPES[task['type']]
-        item = ItemType(task['url'])
+        ItemType = self.item_types[task['type']]
+        item = ItemType(url, task.get('zone', 'main'))
+        item.origin = task['url']
+        item.hints = self.media_hints(task)
         self.add_task(item)
 
+        # Report playback failures and the first frame of the item.
+        item.on_error = lambda error='': self.on_item_error(item, error)
+        item.on_rendered = lambda: self.on_item_rendered(item)
+
         # Put the item actor on the screen and start buffering.
         item.prepare(self.screen)
 
-        self.msg('Schedule {!r}...'.format(item))
+        self.debug('Schedule {!r}...', item)
         self.add_event(task['start'], self.start_task, item)
-        self.add_event(task['end'], self.stop_task, item)
+        stop = self.add_event(task['end'], self.stop_task, item)
+        self.stops[item] = (task['type'], task['end'], stop)
+
+    def resolve_url(self, task):
+        """Return URL to play the task from. Override."""
+        return task['url']
+
+    def check_task(self, task):
+        """Return reason not to play the task, if any. Override."""
+        return None
+
+    def media_hints(self, task):
+        """Return decoder hints for media of the task. Override."""
+        return None
+
+    def continued_item(self, task, url):
+        """
+        Find item the task continues seamlessly, if any.
+
+        That is an item of a continuous type with the same URL and zone,
+        which ends no sooner than the task starts.
+        """
+
+        if task['type'] not in CONTINUOUS_TYPES:
+            return None
+
+        zone = task.get('zone', 'main')
+
+        for item in self.tasks:
+            kind, end, stop = self.stops[item]
+
+            if kind == task['type'] and item.url == url \
+                    and item.zone == zone and task['start'] <= end:
+                return item
+
+        return None
+
+    def extend_task(self, item, task):
+        """
+        Let the item play until the end of the task as well.
+        """
+
+        kind, end, stop = self.stops[item]
+
+        # Proof-of-play still sees the task as played on its own.
+        self.add_event(task['start'], self.on_item_event, item, 'continue')
+
+        if task['end'] <= end:
+            return
+
+        self.debug('Extend {!r} until {}...', item, task['end'])
+        self.cancel_event(stop)
+
+        stop = self.add_event(task['end'], self.stop_task, item)
+        self.stops[item] = (kind, task['end'], stop)
 
     def stop_task(self, item):
-        self.msg('Stop {!r}...'.format(item))
+        self.msg('Stop {!r}...', item)
         self.discard_task(item)
+        self.stops.pop(item, None)
         item.stop()
+        self.on_item_event(item, 'stop')
 
     def start_task(self, item):
-        log.msg('Start {!r}'.format(item))
+        self.msg('Start {!r}', item)
         item.start()
+        self.on_item_event(item, 'start')
+
+    def on_item_rendered(self, item):
+        """
+        Report the first frame of the item, unless nobody could see it.
+
+        Frames of items that were never started, or were already stopped,
+        went to a hidden stage and do not count as played.
+        """
+
+        if item.playing:
+            self.on_item_event(item, 'frame')
+
+    def on_item_event(self, item, event):
+        """Method called when an item starts, shows or stops. Override."""
+        pass
+
+    def on_item_error(self, item, error):
+        """Method called when playback of an item fails. Override."""
+        self.warn('Playback of {!r} failed: {}', item, error)
 
 
 class LayoutScheduler (Scheduler):
-    def __init__(self, screen):
-        super().__init__()
+    def __init__(self, screen, clock=reactor):
+        super().__init__(clock)
 
         self.screen = screen
 
@@ -201,29 +403,53 @@ class LayoutScheduler (Scheduler):
         Schedule layout change.
         """
 
-        self.msg('Schedule layout change to {} mode...'.format(task['mode']))
+        self.debug('Schedule layout change to {} mode...', task['mode'])
         self.add_event(task['start'], self.screen.set_layout, {
             'mode': task['mode'],
-            'panel': task['panel'],
-            'sidebar': task['sidebar'],
+            'panel': task.get('panel'),
+            'sidebar': task.get('sidebar'),
+            'zones': task.get('zones', []),
         })
 
     def no_plan(self):
-        self.screen.set_layout({'mode': 'full'})
+        self.screen.set_layout({'mode': 'full', 'zones': []})
 
 
 class PowerScheduler (Scheduler):
-    def __init__(self, cec):
-        super().__init__()
+    def __init__(self, cec, clock=reactor):
+        super().__init__(clock)
 
         self.cec = cec
 
+        # Scheduled power state: 'on', 'standby', 'waking' or None when
+        # the plan does not say anything.
+        self.state = None
+
     def logPrefix(self):
         return 'power-sched'
 
+    def on_state_change(self, state):
+        """Method called when the scheduled power state changes."""
+        pass
+
+    def change_state(self, state):
+        if self.state != state:
+            self.state = state
+            self.on_state_change(state)
+
+    def prewake(self):
+        """
+        Power-on is coming up shortly, let the playback prepare.
+        """
+
+        if self.state != 'on':
+            self.change_state('waking')
+
     def set_power_status(self, status):
+        self.change_state(status)
+
         if self.cec is None:
-            log.msg('CEC not available, would go to {!r}.'.format(status))
+            self.msg('CEC not available, would go to {!r}.', status)
             return
 
         if self.cec.status != status:
@@ -237,22 +463,23 @@ class PowerScheduler (Scheduler):
         Schedule power change.
         """
 
-        self.msg('Schedule power change to {} ...'.format(task['power']))
+        self.debug('Schedule power change to {} ...', task['power'])
         self.add_event(task['start'], self.set_power_status, task['power'])
 
+        if task['power'] == 'on':
+            if task['start'] - PREWAKE > self.clock.seconds():
+                self.add_event(task['start'] - PREWAKE, self.prewake)
+
+    def no_plan(self):
+        self.change_state(None)
+
 
 def plan_window(plan, ending_after, starting_before):
     """
     Return list of items in the given window.
     """
 
-    window_tasks = []
-
-    for task in plan:
-        if ending_after < task['end'] and task['start'] < starting_before:
-            window_tasks.append(task)
-
-    return window_tasks
+    return plan.window(ending_after, starting_before)
 
 
 def pop_queue_tasks(queue, secs=60, now=None):
@@ -260,26 +487,10 @@ def pop_queue_tasks(queue, secs=60, now=None):
     Remove upcoming items from the queue.
     """
 
-    tasks = []
     if now is None:
         now = reactor.seconds()
 
-    while len(queue) > 0:
-        task = queue.pop(0)
-
-        # Discard tasks already in the past.
-        if task['end'] < now:
-            continue
-
-        # Stop at tasks too far in the future.
-        if task['start'] > now + 60:
-            queue.insert(0, task)
-            break
-
-        # Schedule this task next...
-        tasks.append(task)
-
-    return tasks
+    return queue.pop(secs, now)
 
 
 # vim:set sw=4 ts=4 et:
@@ -1,15 +1,91 @@
 #!/usr/bin/python3 -tt
 # -*- coding: utf-8 -*-
 
-from yaml import load
+from jsonschema import Draft4Validator
+from os import makedirs, rename, stat
 from os.path import dirname, join
+from simplejson import load, dump
 
+import yaml
 
-__all__ = ['schema']
 
+__all__ = ['schema', 'validator']
 
-with open(join(dirname(__file__), 'schema.yaml')) as fp:
-    schema = load(fp)
+
+# The message schema in its source form.
+SCHEMA_PATH = join(dirname(__file__), 'schema.yaml')
+
+# Parsed schema, so that we do not have to parse YAML on every start.
+CACHE_PATH = '/var/cache/telescreen/schema.json'
+
+# Use the fast C parser when available.
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed schema and its validator, once needed.
+cache = {}
+
+
+def schema():
+    """
+    Return the message schema.
+
+    The schema is parsed on the first use only, preferably from a cached
+    JSON copy that is refreshed whenever the YAML source changes.
+    """
+
+    if 'schema' not in cache:
+        cache['schema'] = load_schema(SCHEMA_PATH, CACHE_PATH)
+
+    return cache['schema']
+
+
+def validator():
+    """
+    Return validator of the messages with the schema already checked.
+    """
+
+    if 'validator' not in cache:
+        # Fail here rather than on every message with a SchemaError.
+        Draft4Validator.check_schema(schema())
+        cache['validator'] = Draft4Validator(schema())
+
+    return cache['validator']
+
+
+def load_schema(source=SCHEMA_PATH, path=CACHE_PATH):
+    """
+    Read the schema from the cache or from the source.
+    """
+
+    info = stat(source)
+    version = [info.st_mtime, info.st_size]
+
+    try:
+        with open(path) as fp:
+            cached = load(fp)
+
+        if cached['version'] == version:
+            return cached['schema']
+
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    with open(source) as fp:
+        parsed = yaml.load(fp, Loader=Loader)
+
+    try:
+        makedirs(dirname(path), exist_ok=True)
+
+        with open(path + '.new', 'w') as fp:
+            dump({'version': version, 'schema': parsed}, fp)
+
+        rename(path + '.new', path)
+
+    except OSError:
+        # Nothing to worry about, we will parse it again next time.
+        pass
+
+    return parsed
 
 
 # vim:set sw=4 ts=4 et:
@@ -3,26 +3,38 @@
 
 from gi.repository import Gdk
 from gi.repository import Gtk
-from gi.repository import WebKit2
 
 from twisted.internet import reactor
-from twisted.python import log
 
 from urllib.parse import quote
 from os.path import dirname
 
+from telescreen.common import Logging
 from telescreen.decoder.client import DecoderClient
+from telescreen.web import WebContent
+from telescreen.layout import LayoutEngine, layout_key, zone_urls, MEDIA_ZONES
+from telescreen.metrics import timed, mark
 
 
-__all__ = ['Screen', 'VideoItem', 'ImageItem', 'StreamItem']
+__all__ = ['Screen', 'StagePool', 'VideoItem', 'ImageItem', 'StreamItem']
 
 
-class Screen:
+# Number of stages to realize in advance, enough for the current item,
+# the next one and an item being torn down.
+STAGE_POOL_SIZE = 3
+
+
+class Screen (Logging):
     """
     Window of the content player.
+
+    Screens can be placed on a specific monitor and share the web
+    content with other screens of the same process.
     """
 
-    def __init__(self):
+    def __init__(self, monitor=None, web=None):
+        self.monitor = monitor
+
         self.window = Gtk.ApplicationWindow(title='Telescreen')
 
         black = Gdk.RGBA()
@@ -42,46 +54,82 @@ class Screen:
         image.set_valign(Gtk.Align.CENTER)
         self.bin.add(image)
 
-        self.sidebar = WebKit2.WebView()
-        self.fixed.add(self.sidebar)
+        self.stages = StagePool(self.bin)
+
+        self.web = web if web is not None else WebContent()
+
+        # Widgets of all known zones, both media and web ones.  Web views
+        # are only created once a layout places them on the screen.
+        self.zones = {'main': self.bin}
+
+        # Stage pools of the media zones.
+        self.pools = {'main': self.stages}
 
-        self.panel = WebKit2.WebView()
-        self.fixed.add(self.panel)
+        # Geometry currently applied to the widgets.
+        self.engine = LayoutEngine()
+        self.geometry = None
+        self.placed = {}
+        self.visible = set()
 
         self.window.connect('delete-event', self.on_delete)
         self.window.connect('check-resize', self.on_resize)
         self.window.connect('realize', self.on_realize)
 
+        # Startup is measured until the window is actually drawn.
+        self.draw_handler = self.window.connect('draw', self.on_first_draw)
+
         self.layout = {
             'mode': 'full',
             'sidebar': None,
             'panel': None,
         }
+        self.layout_key = layout_key(self.layout)
 
         self.xid = None
 
+    def logPrefix(self):
+        return 'screen'
+
     def start(self):
         """
         Show the application window and start any periodic processes.
         """
 
-        log.msg('Showing the player window...')
-        self.window.fullscreen()
+        self.msg('Showing the player window...')
+
+        if self.monitor is None:
+            self.window.fullscreen()
+        else:
+            self.window.fullscreen_on_monitor(self.window.get_screen(),
+                                              self.monitor)
+
         self.window.show_all()
+
+        # Make sure only zones of the current layout are visible.
+        self.geometry = None
+        self.visible = set(self.zones.values())
         self.on_resize(self.window)
 
-        log.msg('Screen started.')
+        self.web.start()
+
+        self.msg('Screen started.')
 
     def on_realize(self, window):
         cursor = Gdk.Cursor.new(Gdk.CursorType.BLANK_CURSOR)
         window.get_window().set_cursor(cursor)
 
+    def on_first_draw(self, window, context):
+        window.disconnect(self.draw_handler)
+        mark('window')
+        return False
+
+    @timed('screen.on_resize')
     def on_resize(self, widget):
         """
         Window has been resized.
 
         Calculate position of elements with respect to new window size
-        and configured layout mode.
+        and configured layout and move those that are out of place.
         """
 
         width, height = widget.get_size()
@@ -89,39 +137,75 @@ class Screen:
         if width < 0 or height < 0:
             return
 
-        if self.layout['mode'] == 'full':
-            self.fixed.move(self.bin, 0, 0)
-            self.bin.set_size_request(width, height)
+        geometry = self.engine.geometry(self.layout_key, self.layout,
+                                        width, height)
+
+        if geometry is self.geometry:
+            # Nothing changed since the last time we were called.
+            return
+
+        visible = set()
+
+        for name, (kind, x, y, w, h) in geometry.items():
+            widget = self.get_zone(name, kind)
+
+            if widget is None:
+                continue
 
-            self.sidebar.hide()
-            self.panel.hide()
+            visible.add(widget)
 
-        elif self.layout['mode'] == 'sidebar':
-            size = height / 3 * 4
+            if self.placed.get(widget) != (x, y, w, h):
+                self.fixed.move(widget, x, y)
+                widget.set_size_request(w, h)
+                self.placed[widget] = (x, y, w, h)
 
-            self.fixed.move(self.bin, 0, 0)
-            self.bin.set_size_request(size, height)
+            if widget not in self.visible:
+                widget.show()
 
-            self.sidebar.show()
-            self.fixed.move(self.sidebar, size, 0)
-            self.sidebar.set_size_request(width - size, height)
+        for widget in self.visible - visible:
+            widget.hide()
 
-            self.panel.hide()
+        self.visible = visible
+        self.geometry = geometry
 
-        elif self.layout['mode'] == 'panel':
-            panel = height / 12
-            size = (height - panel) * 4 / 3
+    def get_zone(self, name, kind):
+        """
+        Return widget of the zone, creating it when necessary.
+        """
+
+        if name not in self.zones:
+            if kind in MEDIA_ZONES:
+                widget = Gtk.Overlay()
+                self.pools[name] = StagePool(widget)
+            else:
+                widget = self.web.create_view()
 
-            self.fixed.move(self.bin, 0, 0)
-            self.bin.set_size_request(size, height - panel)
+            widget.show()
+            self.fixed.add(widget)
+            self.zones[name] = widget
 
-            self.sidebar.show()
-            self.fixed.move(self.sidebar, size, 0)
-            self.sidebar.set_size_request(width - size, height - panel)
+        elif (kind in MEDIA_ZONES) != (name in self.pools):
+            self.warn('Zone {!r} cannot change its type to {!r}, ignoring.',
+                      name, kind)
+            return None
 
-            self.panel.show()
-            self.fixed.move(self.panel, 0, height - panel)
-            self.panel.set_size_request(width, panel)
+        return self.zones[name]
+
+    def stage_pool(self, zone):
+        """
+        Return pool of stages of the given media zone.
+
+        Zones not present in the current layout are created hidden,
+        so that items can prepare before the layout is switched.
+        """
+
+        if zone not in self.pools:
+            if self.get_zone(zone, 'video') is None:
+                return self.stages
+
+            self.zones[zone].hide()
+
+        return self.pools[zone]
 
     def on_delete(self, target, event):
         """
@@ -131,87 +215,241 @@ class Screen:
         This should stop the application.
         """
 
-        log.msg('Window closed, stopping reactor...')
+        self.msg('Window closed, stopping reactor...')
         reactor.stop()
         Gtk.main_quit()
 
-        log.msg('Bye.')
+        self.msg('Bye.')
 
     def set_layout(self, layout):
         """
         Change the screen layout.
 
-        Layout is a dictionary with ``mode``, ``sidebar``, and ``panel`` keys.
-        Valid values for ``mode`` are ``full``, ``sidebar``, and ``panel``.
+        Layout is a dictionary with ``mode``, ``sidebar``, ``panel`` and
+        ``zones`` keys.  Valid values for ``mode`` are ``full``,
+        ``sidebar``, ``panel`` and ``zones``.
 
         - ``full`` represents a fullscreen video with no web content.
         - ``sidebar`` shrinks video to 4:3 and adds a web sidebar.
         - ``panel`` builds on the ``sidebar`` and adds a bottom web panel.
+        - ``zones`` places the ``zones`` given by the layout itself.
 
         Both ``sidebar`` and ``panel`` key values are valid URLs or None.
+        Every zone has a ``name``, a ``type`` (``video``, ``image`` or
+        ``web``), its position and size as fractions of the window and
+        web zones also an ``url``.
         """
 
         if self.layout != layout:
             self.layout = layout
+            self.layout_key = layout_key(layout)
             self.on_resize(self.window)
+            self.on_layout_change(layout)
+
+            urls = zone_urls(layout)
+
+            for name, widget in self.zones.items():
+                if name in self.pools:
+                    continue
+
+                uri = urls.get(name) or 'about:blank'
+                if self.web.views[widget] != uri:
+                    self.web.load(widget, uri)
+
+    def on_layout_change(self, layout):
+        """Method called when the layout changes."""
+        pass
+
+
+class StagePool (Logging):
+    """
+    Pool of pre-realized DrawingAreas (stages) for the item decoders.
+
+    Stages live in the overlay for the whole lifetime of the screen and
+    keep their X windows, so that items only change their size and
+    stacking order instead of creating and destroying widgets.
+    """
+
+    def __init__(self, overlay, size=STAGE_POOL_SIZE):
+        self.overlay = overlay
+
+        # Stages ready to be borrowed and stages currently lent out.
+        self.idle = []
+        self.busy = set()
+
+        # Handlers waiting for a stage to get realized.
+        self.pending = {}
+
+        # Known XIDs of the stages.
+        self.xids = {}
+
+        for i in range(size):
+            self.idle.append(self.create())
+
+    def logPrefix(self):
+        return 'stages'
+
+    def create(self):
+        """
+        Create new hidden stage in the overlay.
+        """
+
+        stage = Gtk.DrawingArea()
+        stage.set_double_buffered(False)
+        stage.connect('realize', self.on_realize)
+
+        self.overlay.add_overlay(stage)
+        self.lower_stage(stage)
+        stage.show()
 
-            self.sidebar.load_uri(layout.get('sidebar') or 'about:blank')
-            self.panel.load_uri(layout.get('panel') or 'about:blank')
+        if self.overlay.get_realized():
+            stage.realize()
 
+        return stage
 
-class Item:
+    def acquire(self):
+        """
+        Borrow an idle stage, creating a new one if the pool is empty.
+        """
+
+        if self.idle:
+            stage = self.idle.pop()
+        else:
+            self.msg('Stage pool exhausted, adding a stage...')
+            stage = self.create()
+
+        self.busy.add(stage)
+        return stage
+
+    def release(self, stage):
+        """
+        Return a stage to the pool.
+        """
+
+        self.pending.pop(stage, None)
+
+        if stage in self.busy:
+            self.busy.discard(stage)
+            self.lower_stage(stage)
+            self.idle.append(stage)
+
+    def when_realized(self, stage, handler):
+        """
+        Call the handler with the stage once it gets realized.
+        """
+
+        self.pending[stage] = handler
+
+    def on_realize(self, stage):
+        self.xids[stage] = stage.get_window().get_xid()
+
+        handler = self.pending.pop(stage, None)
+        if handler is not None:
+            handler(stage)
+
+    def xid(self, stage):
+        """
+        Return XID of a realized stage.
+        """
+
+        if stage not in self.xids:
+            self.xids[stage] = stage.get_window().get_xid()
+
+        return self.xids[stage]
+
+    def raise_stage(self, stage):
+        """
+        Bring the stage above all other stages and allow it to expand.
+        """
+
+        stage.set_size_request(-1, -1)
+        stage.set_halign(Gtk.Align.FILL)
+        stage.set_valign(Gtk.Align.FILL)
+        self.overlay.reorder_overlay(stage, -1)
+
+    def lower_stage(self, stage):
+        """
+        Hide the stage behind all other stages.
+
+        The stage is kept as a 0x0 widget in the top-left corner of the
+        overlay, so that it keeps its X window while not being visible.
+        """
+
+        stage.set_size_request(0, 0)
+        stage.set_halign(Gtk.Align.START)
+        stage.set_valign(Gtk.Align.START)
+        self.overlay.reorder_overlay(stage, 0)
+
+
+class Item (Logging):
     """
     Playlist item with its associated DrawingArea and a decoder.
     """
 
-    def __init__(self, url):
+    def __init__(self, url, zone='main'):
         self.url = url
+        self.zone = zone
+
+        # URL from the plan, the item may play a local copy instead.
+        self.origin = url
+
+        # Decoder hints about the media, if known in advance.
+        self.hints = None
+
+        self.stages = None
         self.stage = None
         self.decoder = None
 
+        # Whether the item have been started and not stopped yet.
+        self.playing = False
+
+    def logPrefix(self):
+        return 'item'
+
     def prepare(self, screen):
         """
-        Prepare the Item for playback by DrawingArea construction.
+        Prepare the Item for playback by borrowing a stage from the screen.
         """
 
         if self.stage is not None:
-            log.msg('Cannot prepare Item twice, ignoring.')
+            self.warn('Cannot prepare {!r} twice, ignoring.', self)
             return
 
-        self.stage = Gtk.DrawingArea()
-        self.stage.set_double_buffered(False)
+        self.stages = screen.stage_pool(self.zone)
+        self.stage = self.stages.acquire()
 
-        #
-        # FIXME: Find a better way to hide stage before the playback starts.
-        #        Ideally hide it with another widget.
-        #
-        # Put the stage as a 1x1 pixel in the top-left corner of the screen
-        # put it behind any active content that will cover it. The only
-        # moment when it will not will be 5s before playback starts anew.
-        #
-        self.stage.set_size_request(0, 0)
-        self.stage.set_halign(Gtk.Align.START)
-        self.stage.set_valign(Gtk.Align.START)
-
-        self.stage.connect('realize', self.on_realize)
-        self.stage.show()
-
-        screen.bin.add_overlay(self.stage)
-        screen.bin.reorder_overlay(self.stage, 0)
+        if self.stage.get_realized():
+            self.on_realize(self.stage)
+        else:
+            self.stages.when_realized(self.stage, self.on_realize)
 
     def on_realize(self, stage):
         """
-        Called when the DrawingArea (stage) gets realized.
+        Called when the DrawingArea (stage) is realized.
 
         With its XID known, launches a Decoder process (controlled using
         a DecoderClient instance) and immediately instruct it to preroll
         the pipeline.
         """
 
-        self.xid = self.stage.get_window().get_xid()
+        self.xid = self.stages.xid(self.stage)
         self.decoder = DecoderClient(self.xid, self.MEDIA, self.url)
+        self.decoder.on_error = self.on_error
+        self.decoder.on_rendered = self.on_rendered
+
+        if self.hints:
+            self.decoder.hints(self.hints)
+
         self.decoder.prepare()
 
+    def on_error(self, error=''):
+        """Method called when the decoder fails."""
+        pass
+
+    def on_rendered(self):
+        """Method called when the first frame have been shown."""
+        pass
+
     def make_pipeline(self, url):
         """Create GStreamer pipeline for playback of this item."""
         raise NotImplementedError('make_pipeline')
@@ -222,34 +460,44 @@ class Item:
         """
 
         if self.decoder is None:
-            log.msg('Cannot start without a Decoder, ignoring.')
+            self.warn('Cannot start {!r} without a Decoder, ignoring.', self)
             return
 
         # Start playback.
         self.decoder.play()
+        self.playing = True
 
         # Bring the stage forward and allow it to expand.
-        self.stage.set_size_request(-1, -1)
-        self.stage.set_halign(Gtk.Align.FILL)
-        self.stage.set_valign(Gtk.Align.FILL)
-        self.stage.get_parent().reorder_overlay(self.stage, 1)
+        self.stages.raise_stage(self.stage)
 
     def stop(self):
         """
         Stop pipeline and make the actor disappear.
         """
 
+        if self.stage is None:
+            return
+
+        stage, self.stage = self.stage, None
+        self.stages.lower_stage(stage)
+        self.playing = False
+
         if self.decoder is None:
+            # Decoder have not been started yet, stage is free right away.
+            self.stages.release(stage)
             return
 
         self.decoder.stop()
 
-        self.stage.get_parent().remove(self.stage)
-
+        # Do not lend the window to anyone else until the decoder is gone.
+        self.decoder.ended.addBoth(lambda result: self.stages.release(stage))
         self.decoder = None
-        self.stage = None
 
     def __repr__(self):
+        if self.zone != 'main':
+            return '{}(url={!r}, zone={!r})' \
+                   .format(type(self).__name__, self.url, self.zone)
+
         return '{}(url={!r})'.format(type(self).__name__, self.url)
 
 
@@ -1,16 +1,17 @@
 #!/usr/bin/python3 -tt
 # -*- coding: utf-8 -*-
 
-from twisted.python import log
 from twisted.internet import reactor
-from twisted.internet.interfaces import IFileDescriptor, IReadDescriptor
-from zope.interface import implementer
+from twisted.python.failure import Failure
 
+from collections import deque
 from simplejson import loads, dumps
+from threading import Thread, Lock
 from time import time
 from uuid import uuid4
 
-from telescreen import common
+from telescreen.metrics import timed
+from telescreen.common import Logging
 
 import yaml
 import zmq
@@ -19,10 +20,33 @@ import zmq
 __all__ = ['Router']
 
 
-@implementer(IReadDescriptor, IFileDescriptor)
-class Router(object):
+# Received messages waiting for the reactor.  When the reactor falls
+# this far behind, the oldest messages are dropped.
+QUEUE_LIMIT = 1000
+
+# Messages passed to on_message() in one reactor iteration.  The rest
+# waits for the next one, so that rendering is not starved.
+BUDGET = 20
+
+# Outgoing messages waiting for the I/O thread.
+PIPE_LIMIT = 10000
+
+# Messages older than this many seconds are dropped.
+MAX_AGE = 15
+
+# How often to check that the I/O thread still lives while waiting for
+# it to carry out a request, in milliseconds.
+REQUEST_POLL = 100
+
+
+class Router (Logging):
     """
     Twisted-compatible ZMQ router.
+
+    The socket is owned by a dedicated I/O thread that receives, frames
+    and decodes messages and hands them to the reactor through a bounded
+    queue.  Outgoing messages and other requests reach the thread
+    through an inproc pipe.
     """
 
     def __init__(self, identity=None, default_recipient=None):
@@ -39,8 +63,10 @@ class Router(object):
         Make sure your machines use NTP to synchronize their clocks.
         """
 
+        context = zmq.Context.instance()
+
         # Create the 0MQ socket.
-        self.socket = zmq.Context.instance().socket(zmq.ROUTER)
+        self.socket = context.socket(zmq.ROUTER)
 
         # Hand over socket when peer relocates.
         # This means that we trust peer identities.
@@ -60,50 +86,226 @@ class Router(object):
             else:
                 self.default_recipient = default_recipient
 
-        # Register ourselves with Twisted reactor loop.
-        reactor.addReader(self)
+        # Pipe to the I/O thread, our end and the thread's end.
+        address = 'inproc://tzmq-' + uuid4().hex
+
+        self.pipe = context.socket(zmq.PAIR)
+        self.pipe.setsockopt(zmq.SNDHWM, PIPE_LIMIT)
+        self.pipe.bind(address)
+
+        pipe = context.socket(zmq.PAIR)
+        pipe.setsockopt(zmq.RCVHWM, PIPE_LIMIT)
+        pipe.connect(address)
 
-    def fileno(self):
-        return self.socket.getsockopt(zmq.FD)
+        # Decoded messages as (payload, sender), filled by the thread.
+        # The lock guards the queue and the counters below.
+        self.queue = deque()
+        self.lock = Lock()
+
+        # Whether the reactor has been asked to drain the queue.
+        self.scheduled = False
+
+        # Counters shared with the I/O thread.
+        self.counters = {
+            'received': 0,
+            'sent': 0,
+            'stale': 0,
+            'malformed': 0,
+            'dropped': 0,
+            'unsent': 0,
+            'max_depth': 0,
+        }
+
+        # Malformed messages already reported.
+        self.reported = 0
+
+        self.thread = Thread(target=self.run, args=(pipe,), daemon=True,
+                             name='tzmq-' + self.socket.identity.decode())
+        self.thread.start()
 
     def shutdown(self):
-        reactor.removeReader(self)
-        self.socket.close()
+        if self.thread.is_alive():
+            self.request(b'close')
+            self.thread.join()
 
-    def connectionLost(self, reason):
-        pass
+        self.pipe.close()
 
-    def doRead(self):
-        events = self.socket.getsockopt(zmq.EVENTS)
-        if events & zmq.POLLIN:
+    def run(self, pipe):
+        """
+        Body of the I/O thread.  Owns the socket until closed.
+        """
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(pipe, zmq.POLLIN)
+
+        try:
             while True:
+                events = dict(poller.poll())
+
+                if self.socket in events:
+                    self.receive()
+
+                if pipe in events:
+                    if not self.serve(pipe):
+                        break
+
+        except Exception:
+            # Nobody would notice otherwise.  Requests fail from now on.
+            reactor.callFromThread(self.err, Failure(), 'I/O thread failed')
+
+        finally:
+            self.socket.close(linger=0)
+            pipe.close()
+
+    def receive(self):
+        """
+        Read all waiting messages and queue them for the reactor.
+        """
+
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+            try:
+                sender, data, t = frames
+
+                if int(t) + MAX_AGE < time():
+                    self.count('stale')
+                    continue
+
+                payload = loads(data)
+
+            except ValueError:
+                self.count('malformed')
+                continue
+
+            with self.lock:
+                self.counters['received'] += 1
+
+                if len(self.queue) >= QUEUE_LIMIT:
+                    self.queue.popleft()
+                    self.counters['dropped'] += 1
+
+                self.queue.append((payload, sender))
+
+                if len(self.queue) > self.counters['max_depth']:
+                    self.counters['max_depth'] = len(self.queue)
+
+                if not self.scheduled:
+                    self.scheduled = True
+                    reactor.callFromThread(self.drain)
+
+    def serve(self, pipe):
+        """
+        Carry out all requests waiting in the pipe.
+
+        Returns False when the thread is supposed to stop.
+        """
+
+        while True:
+            try:
+                command, *args = pipe.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return True
+
+            if command == b'send':
                 try:
-                    sender, data, t = self.socket.recv_multipart(zmq.NOBLOCK)
-                    if int(t) + 15 < time():
-                        continue
+                    self.socket.send_multipart(args)
+                except zmq.ZMQError:
+                    self.count('unsent')
+                else:
+                    self.count('sent')
+
+                continue
+
+            try:
+                if command == b'connect':
+                    self.socket.connect(args[0].decode('utf-8'))
+                elif command == b'disconnect':
+                    self.socket.disconnect(args[0].decode('utf-8'))
+                elif command == b'bind':
+                    self.socket.bind(args[0].decode('utf-8'))
+                elif command == b'close':
+                    pipe.send_multipart([b'ok'])
+                    return False
+
+            except zmq.ZMQError as e:
+                pipe.send_multipart([b'error', str(e).encode('utf-8')])
+                continue
+
+            pipe.send_multipart([b'ok'])
+
+    def request(self, command, *args):
+        """
+        Ask the I/O thread to do something and wait for it.
 
-                    payload = loads(data)
+        Raises ZMQError when the thread fails to carry it out or when it
+        is not running any more.
+        """
 
-                    if common.debug:
-                        text = yaml.dump(payload, default_flow_style=False)
-                        log.msg('Received message (from {!r}):\n{}'
-                                .format(sender, text))
+        if not self.thread.is_alive():
+            raise zmq.ZMQError(msg='I/O thread is not running')
 
-                    self.on_message(payload, sender)
+        self.pipe.send_multipart([command] + list(args))
 
-                except zmq.ZMQError as e:
-                    if e.errno == zmq.EAGAIN:
-                        break
-                    raise
+        while not self.pipe.poll(REQUEST_POLL):
+            if not self.thread.is_alive():
+                raise zmq.ZMQError(msg='I/O thread is not running')
+
+        status, *details = self.pipe.recv_multipart()
+
+        if status == b'error':
+            raise zmq.ZMQError(msg=details[0].decode('utf-8'))
+
+    @timed('router.drain')
+    def drain(self):
+        """
+        Pass queued messages to on_message(), up to the budget.
+        """
+
+        with self.lock:
+            malformed = self.counters['malformed']
+
+        if malformed > self.reported:
+            self.warn('Dropped {} malformed messages.',
+                      malformed - self.reported)
+            self.reported = malformed
+
+        for i in range(BUDGET):
+            with self.lock:
+                if not self.queue:
+                    self.scheduled = False
+                    return
+
+                payload, sender = self.queue.popleft()
+
+            self.debug('Received message (from {!r}):\n{}',
+                       sender, YAML(payload))
+
+            try:
+                self.on_message(payload, sender)
+            except Exception:
+                self.err()
+
+        # Let the reactor do other work before handling the rest.
+        reactor.callLater(0, self.drain)
 
     def connect(self, address):
         """Connects to ZMQ endpoint."""
-        self.socket.connect(address)
+        self.request(b'connect', address.encode('utf-8'))
+        return self
+
+    def disconnect(self, address):
+        """Disconnects from ZMQ endpoint."""
+        self.request(b'disconnect', address.encode('utf-8'))
         return self
 
     def bind(self, address):
         """Binds as ZMQ endpoint."""
-        self.socket.bind(address)
+        self.request(b'bind', address.encode('utf-8'))
         return self
 
     def on_message(self, message, sender):
@@ -126,9 +328,7 @@ class Router(object):
             if not isinstance(recipient, bytes):
                 recipient = recipient.encode('utf-8')
 
-        if common.debug:
-            text = yaml.dump(message, default_flow_style=False)
-            log.msg('Sending message (to {!r}):\n'.format(recipient) + text)
+        self.debug('Sending message (to {!r}):\n{}', recipient, YAML(message))
 
         # JSON-encode the message.
         json = dumps(message, for_json=True).encode('utf-8')
@@ -136,18 +336,52 @@ class Router(object):
         # Get current time as a byte sequence.
         now = str(int(time())).encode('utf-8')
 
-        # Send the message.
-        self.socket.send_multipart([recipient, json, now])
+        self.send_frames(recipient, [json, now])
+
+    def send_frames(self, recipient, frames):
+        """
+        Send raw frames to specified peer via the I/O thread.
+        """
+
+        try:
+            self.pipe.send_multipart([b'send', recipient] + frames,
+                                     zmq.NOBLOCK)
+        except zmq.Again:
+            # The I/O thread is hopelessly behind, do not block on it.
+            self.count('unsent')
 
-        # Check for potential replies.
-        # This is absolutely essential to do, because Twisted is going to
-        # miss replies received during the send_multipart() above.
-        reactor.callLater(0, self.doRead)
+    def count(self, name):
+        """
+        Increment a counter, from either of the threads.
+        """
+
+        with self.lock:
+            self.counters[name] += 1
+
+    def status(self):
+        """
+        Return counters of the router and depth of the queue.
+        """
+
+        with self.lock:
+            return dict(self.counters, depth=len(self.queue))
 
     def logPrefix(self):
         return 'tzmq'
 
 
+class YAML(object):
+    """
+    Message that is dumped as YAML only when really formatted.
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+    def __format__(self, spec):
+        return yaml.dump(self.message, default_flow_style=False)
+
+
 if __name__ == '__main__':
     server = Router(identity='server')
     server.bind('tcp://127.0.0.1:4321')
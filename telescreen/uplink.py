@@ -0,0 +1,188 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+
+from uuid import uuid4
+from zmq import ZMQError
+
+from telescreen.common import Logging
+from telescreen.schema import validator
+
+
+__all__ = ['Uplink']
+
+
+# Leader silent for this many seconds is considered gone.
+LEADER_DEADLINE = 6
+
+# Longest interval of the pings while the leader is quiet, in seconds.
+# Shorter deadlines ping more often, so that a few pings fit in.
+PING_INTERVAL = 2
+
+
+class Uplink (Logging):
+    """
+    Connection to the first responding of several leaders.
+
+    The leaders share the same identity, so the router is connected to
+    just one of them at a time.  Every message from the leader shows it
+    is alive and quiet leaders are pinged, expected to answer with
+    a pong.  When the leader stays silent past the deadline, the router
+    moves over to the next endpoint.
+
+    Once a leader answers for the first time, be it at startup, after
+    a switchover or after an outage, ``on_reconnect()`` is called so
+    that the managers can replay their session and plan to it.
+    """
+
+    def __init__(self, router, endpoints, deadline=LEADER_DEADLINE,
+                 clock=reactor):
+        assert endpoints, 'Expected at least one leader endpoint'
+
+        self.router = router
+        self.router.on_message = self.on_router_message
+
+        self.endpoints = list(endpoints)
+        self.deadline = deadline
+        self.interval = min(PING_INTERVAL, deadline / 3)
+        self.clock = clock
+
+        # Endpoint we are connected to, by its index.
+        self.index = 0
+
+        # When we have last heard from the leader and whether it has
+        # answered since we have connected or lost it.
+        self.last_seen = None
+        self.alive = False
+
+        # Last ping as (sequence number, time sent).
+        self.ping_seq = 0
+        self.ping_sent = None
+
+        self.loop = None
+
+        self.stats = {
+            'pings': 0,
+            'pongs': 0,
+            'lost': 0,
+            'switches': 0,
+            'rtt': None,
+        }
+
+    def logPrefix(self):
+        return 'uplink'
+
+    @property
+    def endpoint(self):
+        return self.endpoints[self.index]
+
+    def start(self):
+        self.msg('Connecting to leader at {}...', self.endpoint)
+        self.router.connect(self.endpoint)
+        self.last_seen = self.clock.seconds()
+
+        self.loop = LoopingCall(self.check)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, now=True)
+
+    def check(self):
+        """
+        Ping a quiet leader and give up on a silent one.
+        """
+
+        quiet = self.clock.seconds() - self.last_seen
+
+        if quiet >= self.deadline:
+            if self.alive:
+                self.warn('Leader at {} silent for {:.1f}s.',
+                          self.endpoint, quiet)
+                self.alive = False
+                self.stats['lost'] += 1
+
+            self.switch()
+
+        if not self.alive or quiet >= self.interval:
+            self.ping()
+
+    def ping(self):
+        self.ping_seq += 1
+        self.ping_sent = (self.ping_seq, self.clock.seconds())
+        self.stats['pings'] += 1
+
+        self.router.send({
+            'id': uuid4().hex,
+            'type': 'ping',
+            'ping': {'seq': self.ping_seq},
+        })
+
+    def switch(self):
+        """
+        Move over to the next leader, if there is another one.
+        """
+
+        # With a single leader we just wait for it, 0MQ keeps trying
+        # to reconnect on its own.
+        if len(self.endpoints) > 1:
+            try:
+                self.router.disconnect(self.endpoint)
+            except ZMQError as e:
+                self.warn('Failed to disconnect from {}: {}',
+                          self.endpoint, e)
+
+            self.index = (self.index + 1) % len(self.endpoints)
+            self.stats['switches'] += 1
+
+            self.msg('Switching over to leader at {}...', self.endpoint)
+            self.router.connect(self.endpoint)
+
+        # Give the leader the full deadline to answer.
+        self.last_seen = self.clock.seconds()
+
+    def on_router_message(self, message, sender):
+        """
+        Note that the leader is alive and pass its message on.
+        """
+
+        self.last_seen = self.clock.seconds()
+
+        if not self.alive:
+            self.alive = True
+            self.msg('Leader at {} is responding.', self.endpoint)
+            self.on_reconnect()
+
+        if isinstance(message, dict) and message.get('type') == 'pong':
+            if validator().is_valid(message):
+                self.on_pong(message['pong'])
+            else:
+                self.warn('Malformed pong, ignoring.')
+
+            return
+
+        self.on_message(message, sender)
+
+    def on_pong(self, pong):
+        self.stats['pongs'] += 1
+
+        if self.ping_sent is not None and pong['seq'] == self.ping_sent[0]:
+            self.stats['rtt'] = self.clock.seconds() - self.ping_sent[1]
+
+    def on_message(self, message, sender):
+        """Method called for every other message. Override."""
+        raise NotImplementedError('You need to override on_message()')
+
+    def on_reconnect(self):
+        """Method called when a leader starts responding."""
+        pass
+
+    def status(self):
+        status = dict(self.stats, endpoint=self.endpoint, alive=self.alive)
+
+        if self.last_seen is not None:
+            status['quiet'] = self.clock.seconds() - self.last_seen
+
+        return status
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,295 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from gi.repository import WebKit2
+
+from twisted.internet.task import LoopingCall
+
+from os import getpid, listdir
+
+from telescreen.common import Logging
+
+
+__all__ = ['WebContent']
+
+
+# Total resident memory all web processes may use before we recycle them.
+RSS_BUDGET = 384 * 2**20
+
+# How often (in seconds) to check memory usage of the web processes.
+CHECK_INTERVAL = 60
+
+# How often (in seconds) to drop in-memory caches of the web processes.
+RECLAIM_INTERVAL = 15 * 60
+
+
+class WebContent (Logging):
+    """
+    Shared web context for all web views of the telescreen.
+
+    Uses a single WebContext tuned for long-running pages that are
+    rarely navigated away from, keeps web process memory in check and
+    recycles the web processes when they grow beyond the budget.
+
+    With a caching proxy given, plain HTTP traffic of the web views
+    goes through it.
+    """
+
+    def __init__(self, rss_budget=RSS_BUDGET, proxy=None):
+        self.rss_budget = rss_budget
+        self.proxy = proxy
+
+        # Web views we manage and the URIs they are supposed to show.
+        self.views = {}
+
+        # Last measured memory usage of the web processes.
+        self.rss = 0
+        self.processes = 0
+
+        # Number of times we had to recycle the web processes.
+        self.recycled = 0
+
+        # Whether we have complained we cannot recycle them.
+        self.cannot_recycle = False
+
+        # Created along with the first web view, so that screens without
+        # any web zones do not start the web processes at all.
+        self.context = None
+
+        self.check_loop = None
+        self.reclaim_loop = None
+
+    def logPrefix(self):
+        return 'web'
+
+    def make_context(self):
+        """
+        Create the shared WebContext with conservative memory settings.
+        """
+
+        kwargs = {}
+
+        # Memory pressure settings are only available since WebKitGTK 2.34.
+        if hasattr(WebKit2, 'MemoryPressureSettings'):
+            settings = WebKit2.MemoryPressureSettings.new()
+            settings.set_memory_limit(self.rss_budget // 2**20)
+            settings.set_conservative_threshold(0.33)
+            settings.set_strict_threshold(0.5)
+            settings.set_poll_interval(30)
+            kwargs['memory_pressure_settings'] = settings
+
+        context = WebKit2.WebContext(**kwargs)
+
+        # We display a few pages for a long time, not browse the web.
+        context.set_cache_model(WebKit2.CacheModel.DOCUMENT_VIEWER)
+        context.set_process_model(
+            WebKit2.ProcessModel.MULTIPLE_SECONDARY_PROCESSES)
+
+        if self.proxy is not None:
+            self.use_proxy(context)
+
+        return context
+
+    def use_proxy(self, context):
+        """
+        Route plain HTTP requests of the context through our proxy.
+        """
+
+        # Proxy settings are only available since WebKitGTK 2.16.
+        if not hasattr(WebKit2, 'NetworkProxySettings'):
+            self.warn('WebKit is too old to use the caching proxy.')
+            return
+
+        # Other schemes, namely https, connect directly.
+        settings = WebKit2.NetworkProxySettings.new(
+            None, ['localhost', '127.0.0.0/8', '::1'])
+        settings.add_proxy_for_scheme('http', self.proxy.uri())
+
+        # The settings have moved to the data manager in WebKitGTK 2.32.
+        manager = context.get_website_data_manager()
+
+        if hasattr(manager, 'set_network_proxy_settings'):
+            manager.set_network_proxy_settings(
+                WebKit2.NetworkProxyMode.CUSTOM, settings)
+        else:
+            context.set_network_proxy_settings(
+                WebKit2.NetworkProxyMode.CUSTOM, settings)
+
+    def create_view(self):
+        """
+        Create new WebView using the shared context.
+        """
+
+        if self.context is None:
+            self.context = self.make_context()
+
+        view = WebKit2.WebView.new_with_context(self.context)
+        view.connect('web-process-terminated', self.on_terminated)
+        self.views[view] = 'about:blank'
+        return view
+
+    def start(self):
+        """
+        Start periodic memory checks and cache reclaims.
+        """
+
+        if self.check_loop is not None:
+            # Already started by another screen sharing the content.
+            return
+
+        self.msg('Starting web memory checks...')
+        self.check_loop = LoopingCall(self.check)
+        self.check_loop.start(CHECK_INTERVAL, now=False)
+
+        self.reclaim_loop = LoopingCall(self.reclaim)
+        self.reclaim_loop.start(RECLAIM_INTERVAL, now=False)
+
+    def load(self, view, uri):
+        """
+        Load given URI in the view and remember it for later recycling.
+        """
+
+        self.views[view] = uri or 'about:blank'
+        view.load_uri(self.views[view])
+
+    def check(self):
+        """
+        Measure web process memory and recycle them when over budget.
+        """
+
+        pids = web_processes()
+        self.processes = len(pids)
+        self.rss = sum(process_rss(pid) for pid in pids)
+
+        if self.rss > self.rss_budget:
+            self.msg('Web processes use {} MiB, over budget, recycling...',
+                     self.rss // 2**20)
+            self.recycle()
+
+    def reclaim(self):
+        """
+        Drop in-memory caches of the web processes.
+        """
+
+        if self.context is None:
+            return
+
+        manager = self.context.get_website_data_manager()
+
+        if hasattr(manager, 'clear'):
+            manager.clear(WebKit2.WebsiteDataTypes.MEMORY_CACHE,
+                          0, None, None, None)
+        else:
+            self.context.clear_cache()
+
+    def recycle(self):
+        """
+        Terminate all web processes, views will reload their pages.
+        """
+
+        # Older WebKit can only reload the pages, which frees nothing and
+        # would only make the pages flicker on every check.
+        if not hasattr(WebKit2.WebView, 'terminate_web_process'):
+            if not self.cannot_recycle:
+                self.warn('WebKit cannot terminate web processes, '
+                          'not recycling them.')
+                self.cannot_recycle = True
+
+            return
+
+        self.recycled += 1
+
+        for view in self.views:
+            view.terminate_web_process()
+
+    def on_terminated(self, view, reason):
+        """
+        Web process have crashed or have been terminated, reload the page.
+        """
+
+        self.msg('Web process terminated ({}), reloading {!r}...',
+                 reason.value_nick, self.views[view])
+        view.load_uri(self.views[view])
+
+    def status(self):
+        """
+        Return memory status of the web processes for the leader.
+        """
+
+        return {
+            'rss': self.rss,
+            'processes': self.processes,
+            'recycled': self.recycled,
+        }
+
+    def status_proxy(self):
+        """
+        Return statistics of the caching proxy, if any.
+        """
+
+        if self.proxy is None:
+            return None
+
+        return self.proxy.status()
+
+
+def web_processes():
+    """
+    Return pids of WebKit web processes spawned by this process.
+    """
+
+    parents = {}
+    candidates = []
+
+    for name in listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open('/proc/{}/stat'.format(name)) as fp:
+                stat = fp.read()
+        except OSError:
+            continue
+
+        # The command name is in parentheses and may contain spaces.
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+
+        pid = int(name)
+        parents[pid] = ppid
+
+        if comm.startswith('WebKitWebProces'):
+            candidates.append(pid)
+
+    ours = getpid()
+    pids = []
+
+    for pid in candidates:
+        # Web processes may be wrapped in a sandbox, walk up the tree.
+        parent = parents.get(pid)
+        while parent and parent != ours:
+            parent = parents.get(parent)
+
+        if parent == ours:
+            pids.append(pid)
+
+    return pids
+
+
+def process_rss(pid):
+    """
+    Return resident memory of the process in bytes.
+    """
+
+    try:
+        with open('/proc/{}/status'.format(pid)) as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return 0
+
+
+# vim:set sw=4 ts=4 et:
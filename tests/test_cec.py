@@ -0,0 +1,172 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import Clock
+
+from telescreen import cec as module
+from telescreen.cec import CEC, MIN_INTERVAL, REPLY_TIMEOUT
+
+import pytest
+
+
+# Fixed virtual time the tests start at.
+EPOCH = 1000
+
+# Client executable, never actually started.
+COMMAND = ['/usr/bin/cec-client', '-d', '9', '-t', 'p']
+
+# How long the scripted client takes to reply.
+REPLY_DELAY = 0.1
+
+
+class ScriptedClient:
+    """
+    Stand-in for the cec-client process answering from a script.
+
+    The script maps command lines to lines the client prints in reply,
+    a moment later, as the real client talking to the bus would.
+    """
+
+    def __init__(self, clock, script=None):
+        self.clock = clock
+        self.script = script or {}
+        self.written = []
+        self.spawned = 0
+        self.protocol = None
+
+    def spawn(self, protocol, executable, args):
+        self.spawned += 1
+        self.protocol = protocol
+        protocol.makeConnection(self)
+        return self
+
+    def write(self, data):
+        line = data.decode('utf-8').strip()
+        self.written.append(line)
+
+        for reply in self.script.get(line, []):
+            self.clock.callLater(REPLY_DELAY, self.print, reply)
+
+    def print(self, line):
+        self.protocol.outReceived((line + '\n').encode('utf-8'))
+
+    def exit(self):
+        self.protocol.processExited(None)
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    clock.advance(EPOCH)
+    return clock
+
+
+def make_cec(clock, script=None, start=False):
+    client = ScriptedClient(clock, script)
+    cec = CEC(COMMAND, clock, client.spawn)
+    cec.changes = []
+    cec.on_status_change = cec.changes.append
+
+    if start:
+        cec.start()
+    else:
+        # Talk to the client without the periodic status queries.
+        client.spawn(cec.protocol, COMMAND[0], COMMAND)
+
+    return cec, client
+
+
+def results(d):
+    seen = []
+    d.addCallback(seen.append)
+    return seen
+
+
+def test_power_commands_coalesce(clock):
+    cec, client = make_cec(clock)
+
+    first = results(cec.set_power_status('on'))
+    second = results(cec.set_power_status('standby'))
+    third = results(cec.set_power_status('on'))
+
+    # The first one goes out right away, the second one is replaced.
+    assert client.written == ['on 0']
+    assert first == [None]
+    assert second == [None]
+    assert third == []
+
+    clock.advance(MIN_INTERVAL)
+
+    assert client.written == ['on 0', 'on 0']
+    assert third == [None]
+    assert cec.queue.coalesced == 1
+
+
+def test_coalesced_callers_get_own_results(clock):
+    cec, client = make_cec(clock)
+
+    first = cec.query_power_status()
+    second = cec.query_power_status()
+    assert first is not second
+
+    # One caller changing its result must not affect the other one.
+    first.addCallback(lambda status: 'mangled')
+    seen = results(second)
+
+    client.print('power status: on')
+
+    assert client.written == ['pow 0']
+    assert seen == ['on']
+    assert cec.status == 'on'
+
+
+def test_reply_timeout(clock):
+    cec, client = make_cec(clock)
+    seen = results(cec.query_power_status())
+
+    clock.advance(REPLY_TIMEOUT)
+
+    assert seen == [None]
+    assert cec.queue.timeouts == 1
+
+
+def test_traffic(clock):
+    cec, client = make_cec(clock, {'pow 0': ['power status: on']}, True)
+    clock.advance(REPLY_DELAY)
+
+    assert client.written == ['pow 0']
+    assert cec.changes == ['on']
+
+    # Output arrives in arbitrary chunks.
+    client.protocol.outReceived(b'TRAFFIC: [  7017]\t>> 0f')
+    client.protocol.outReceived(b':36\nTRAFFIC: [  7018]\t>> 40:36\n')
+    assert cec.changes == ['on', 'standby']
+
+    # Wake up hints make us ask for the status.
+    client.print('TRAFFIC: [  8000]\t>> 0f:86:10:00')
+    clock.advance(MIN_INTERVAL)
+    clock.advance(REPLY_DELAY)
+    assert client.written == ['pow 0', 'pow 0']
+    assert cec.changes == ['on', 'standby', 'on']
+
+    client.print('TRAFFIC: [  9000]\t>> 01:90:01')
+    assert cec.changes == ['on', 'standby', 'on', 'standby']
+
+
+def test_restart_and_give_up(clock, monkeypatch):
+    stopped = []
+    monkeypatch.setattr(module.reactor, 'stop', lambda: stopped.append(1))
+
+    cec, client = make_cec(clock, start=True)
+
+    clock.advance(11)
+    client.exit()
+    assert client.spawned == 2
+
+    clock.advance(5)
+    client.exit()
+    assert client.spawned == 2
+    assert stopped == [1]
+
+
+# vim:set sw=4 ts=4 et:
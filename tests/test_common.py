@@ -0,0 +1,57 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+from telescreen import common
+from telescreen.common import Logging, recent, DEBUG, ERROR
+
+import pytest
+
+
+class Logger (Logging):
+    def logPrefix(self):
+        return 'test'
+
+
+@pytest.fixture
+def ring(monkeypatch):
+    ring = deque(maxlen=common.RING_SIZE)
+    monkeypatch.setattr(common, 'ring', ring)
+    monkeypatch.setattr(common, 'ring_level', DEBUG)
+    monkeypatch.setattr(common, 'level', ERROR + 1)
+    return ring
+
+
+def test_ring_keeps_text(ring):
+    logger = Logger()
+    payload = {'items': [1]}
+
+    logger.msg('Plan {}', payload)
+    logger.debug('Plan {}', payload)
+    payload['items'].append(2)
+
+    # Only debug messages keep their arguments until read.
+    assert [entry[4] for entry in ring] == [(), (payload,)]
+    assert [entry[3] for entry in recent()] == [
+        "Plan {'items': [1]}",
+        "Plan {'items': [1, 2]}",
+    ]
+
+
+def test_ring_keeps_failure_text(ring, monkeypatch):
+    monkeypatch.setattr(common.log, 'err', lambda *args, **kw: None)
+
+    try:
+        raise ValueError('broken')
+    except ValueError:
+        Logger().err(why='Handler failed')
+
+    entry, = ring
+    assert entry[1] == ERROR
+    assert entry[4] == ()
+    assert entry[3].startswith('Handler failed: [Failure instance')
+    assert 'broken' in entry[3]
+
+
+# vim:set sw=4 ts=4 et:
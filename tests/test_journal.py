@@ -0,0 +1,131 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import Clock
+
+from simplejson import loads
+
+from telescreen.journal import Journal, FLUSH_BATCH, FLUSH_DELAY
+
+import pytest
+
+
+# Fixed virtual time the tests start at.
+EPOCH = 1500000000
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    clock.advance(EPOCH)
+    return clock
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'telescreen' / 'journal')
+
+
+def open_journal(path, clock):
+    journal = Journal(path, clock)
+    journal.open()
+    return journal
+
+
+def records(path):
+    with open(path, 'rb') as fp:
+        return [loads(line.decode('utf-8')) for line in fp]
+
+
+def test_partial_tail(path, clock):
+    journal = open_journal(path, clock)
+    journal.record('start', 'http://a/')
+    journal.record('stop', 'http://a/')
+    journal.close()
+
+    # Crash in the middle of writing the third record.
+    with open(path, 'ab') as fp:
+        fp.write(b'[3,1500000000.0,"sta')
+
+    journal = open_journal(path, clock)
+    assert journal.seq == 2
+    assert journal.record('start', 'http://b/') == 3
+    journal.close()
+
+    assert [r[0] for r in records(path)] == [1, 2, 3]
+
+
+def test_seq_continues_after_ack(path, clock):
+    journal = open_journal(path, clock)
+
+    for i in range(3):
+        journal.record('start', 'http://a/')
+
+    journal.ack(3)
+    journal.close()
+
+    # Nothing is left but the marker, which keeps the sequence.
+    assert [(r[0], r[2]) for r in records(path)] == [(3, 'ack')]
+
+    journal = open_journal(path, clock)
+    assert journal.seq == 3
+    assert journal.record('start', 'http://b/') == 4
+    journal.close()
+
+
+def test_ack_keeps_later_records(path, clock):
+    journal = open_journal(path, clock)
+
+    for i in range(4):
+        journal.record('start', 'http://a/')
+
+    journal.ack(2)
+    journal.close()
+
+    assert [(r[0], r[2]) for r in records(path)] == \
+           [(2, 'ack'), (3, 'start'), (4, 'start')]
+
+
+def test_flush_delay(path, clock):
+    journal = open_journal(path, clock)
+    journal.record('start', 'http://a/')
+
+    assert journal.pending(10) == []
+
+    clock.advance(FLUSH_DELAY - 1)
+    assert journal.pending(10) == []
+
+    clock.advance(1)
+    assert len(journal.pending(10)) == 1
+    assert not clock.getDelayedCalls()
+
+
+def test_flush_batch(path, clock):
+    journal = open_journal(path, clock)
+
+    for i in range(FLUSH_BATCH - 1):
+        journal.record('start', 'http://a/')
+
+    assert journal.pending(FLUSH_BATCH) == []
+
+    # The full batch is written right away, without the timer.
+    journal.record('start', 'http://a/')
+    assert len(journal.pending(FLUSH_BATCH)) == FLUSH_BATCH
+    assert not clock.getDelayedCalls()
+
+
+def test_pending_skips_marker(path, clock):
+    journal = open_journal(path, clock)
+
+    for i in range(5):
+        journal.record('start', 'http://a/')
+
+    journal.ack(2)
+
+    lines = journal.pending(2)
+    assert [loads(line.decode('utf-8'))[0] for line in lines] == [3, 4]
+
+    journal.close()
+
+
+# vim:set sw=4 ts=4 et:
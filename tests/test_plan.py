@@ -0,0 +1,137 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, date, time
+
+from telescreen.plan import Plan, PlanQueue, MISSING
+
+import pytest
+
+
+# Fixed time the tests start at.
+EPOCH = 1500000000
+
+
+def task(start, end, url, **fields):
+    return dict(fields, start=start, end=end, type='video', url=url)
+
+
+def starts(tasks):
+    return [task['start'] - EPOCH for task in tasks]
+
+
+def test_task_view_is_dict_like():
+    plan = Plan([
+        task(EPOCH + 10, EPOCH + 20, 'http://b/'),
+        task(EPOCH, EPOCH + 10, 'http://a/', hints={'fps': 25}),
+    ])
+
+    first, second = plan
+
+    assert first['start'] == EPOCH
+    assert first['url'] == 'http://a/'
+    assert first.get('hints') == {'fps': 25}
+    assert 'hints' in first
+
+    # Fields other tasks have are missing, not None.
+    assert 'hints' not in second
+    assert second.get('hints') is None
+    assert second.get('hints', 'none') == 'none'
+
+    with pytest.raises(KeyError):
+        second['hints']
+
+    with pytest.raises(KeyError):
+        second['unknown']
+
+    assert second == task(EPOCH + 10, EPOCH + 20, 'http://b/')
+    assert dict(first.items()) == task(EPOCH, EPOCH + 10, 'http://a/',
+                                       hints={'fps': 25})
+    assert plan[-1] == second
+
+
+def test_interning():
+    plan = Plan([task(EPOCH + i, EPOCH + i + 1, 'http://a/',
+                      hints={'fps': 25}, flag=bool(i % 2), level=i % 2)
+                 for i in range(100)])
+
+    # Equal values are stored once, no matter how many tasks share them.
+    assert plan.values['url'] == [MISSING, 'http://a/']
+    assert plan.values['hints'] == [MISSING, {'fps': 25}]
+
+    # Values that hash the same but differ in type are kept apart.
+    assert plan.values['flag'] == [MISSING, False, True]
+    assert plan.values['level'] == [MISSING, 0, 1]
+    assert plan[1]['flag'] is True
+    assert plan[1]['level'] == 1 and plan[1]['level'] is not True
+
+
+def test_window():
+    plan = Plan([
+        task(EPOCH, EPOCH + 10, 'http://a/'),
+        task(EPOCH + 10, EPOCH + 30, 'http://b/'),
+        task(EPOCH + 20, EPOCH + 25, 'http://c/'),
+        task(EPOCH + 40, EPOCH + 50, 'http://d/'),
+    ])
+
+    # Tasks ending after the start and starting before the end.
+    assert starts(plan.window(EPOCH + 10, EPOCH + 40)) == [10, 20]
+    assert starts(plan.window(EPOCH + 9, EPOCH + 41)) == [0, 10, 20, 40]
+    assert plan.window(EPOCH + 50, EPOCH + 60) == []
+    assert plan.window(EPOCH - 10, EPOCH) == []
+
+
+def test_window_with_loop():
+    midnight = datetime.combine(date.fromtimestamp(EPOCH), time())
+    now = midnight.timestamp() + 100
+
+    plan = Plan(loops=[{
+        'days': range(7),
+        'from': 0,
+        'to': 86400,
+        'items': [{'type': 'image', 'url': 'http://a/', 'duration': 10}],
+    }])
+
+    tasks = plan.window(now, now + 30)
+    assert [task['start'] - now for task in tasks] == [0, 10, 20]
+
+
+def test_queue_pop():
+    plan = Plan([
+        task(EPOCH, EPOCH + 10, 'http://a/'),
+        task(EPOCH + 10, EPOCH + 30, 'http://b/'),
+        task(EPOCH + 70, EPOCH + 80, 'http://c/'),
+        task(EPOCH + 130, EPOCH + 140, 'http://d/'),
+    ])
+
+    queue = PlanQueue(plan)
+    assert len(queue) == 4
+
+    # Tasks that have already ended are skipped.
+    assert starts(queue.pop(60, EPOCH + 20)) == [10, 70]
+    assert queue.cursor == 3
+
+    assert queue.pop(10, EPOCH + 100) == []
+    assert starts(queue.pop(60, EPOCH + 100)) == [130]
+    assert len(queue) == 0
+
+
+def test_queue_cursor_across_plans():
+    tasks = [
+        task(EPOCH + 10, EPOCH + 20, 'http://a/'),
+        task(EPOCH + 50, EPOCH + 70, 'http://b/'),
+        task(EPOCH + 120, EPOCH + 130, 'http://c/'),
+    ]
+
+    old = PlanQueue(Plan(tasks))
+    assert starts(old.pop(60, EPOCH)) == [10, 50]
+
+    # New plan with the same near future picks up at the same point.
+    new = PlanQueue(Plan(tasks + [task(EPOCH + 300, EPOCH + 310, 'd')]))
+    assert starts(new.pop(60, EPOCH + 30)) == [50]
+    assert new.cursor == old.cursor
+
+    assert starts(new.pop(60, EPOCH + 70)) == [120]
+
+
+# vim:set sw=4 ts=4 et:
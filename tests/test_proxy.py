@@ -0,0 +1,142 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from email.utils import formatdate
+from types import SimpleNamespace
+
+from telescreen import proxy as module
+from telescreen.proxy import CachingProxy, is_fresh, refresh
+from telescreen.proxy import CACHE_LIMIT, ENTRY_FRACTION, HEURISTIC_LIMIT
+
+import pytest
+
+
+# Fixed time the tests start at.
+EPOCH = 1500000000
+
+# Largest response that is cached.
+ENTRY_LIMIT = CACHE_LIMIT // ENTRY_FRACTION
+
+
+def http_date(offset):
+    return formatdate(EPOCH + offset, usegmt=True)
+
+
+def headers(pairs):
+    result = Headers()
+
+    for name, value in pairs:
+        result.addRawHeader(name.encode('latin-1'), value.encode('latin-1'))
+
+    return result
+
+
+@pytest.mark.parametrize('pairs, stored, fresh', [
+    # No lifetime at all.
+    ([], 0, False),
+
+    # Explicit lifetime, counted from when the response was stored.
+    ([('Cache-Control', 'max-age=300')], -100, True),
+    ([('Cache-Control', 'max-age=60')], -100, False),
+    ([('Cache-Control', 'max-age=oops')], -100, False),
+    ([('Cache-Control', 'public, max-age="300"')], -100, True),
+    ([('Cache-Control', 'no-cache, max-age=300')], -100, False),
+
+    # Shared cache lifetime wins over the private one.
+    ([('Cache-Control', 's-maxage=300, max-age=0')], -100, True),
+    ([('Cache-Control', 's-maxage=0, max-age=300')], -100, False),
+
+    # Time spent in other caches on the way counts.
+    ([('Cache-Control', 'max-age=300'), ('Age', '150')], -100, True),
+    ([('Cache-Control', 'max-age=300'), ('Age', '250')], -100, False),
+
+    # Expires is relative to the Date of the response.
+    ([('Date', http_date(-100)), ('Expires', http_date(200))], -100, True),
+    ([('Date', http_date(-100)), ('Expires', http_date(-40))], -100, False),
+    ([('Date', http_date(-100)), ('Expires', '0')], -100, False),
+
+    # Max-age wins over Expires.
+    ([('Cache-Control', 'max-age=300'), ('Date', http_date(-100)),
+      ('Expires', http_date(-100))], -100, True),
+
+    # Heuristic lifetime is a fraction of the time since modification.
+    ([('Date', http_date(-100)),
+      ('Last-Modified', http_date(-10100))], -100, True),
+    ([('Date', http_date(-100)),
+      ('Last-Modified', http_date(-600))], -100, False),
+
+    # ...but not too long.
+    ([('Date', http_date(-HEURISTIC_LIMIT - 100)),
+      ('Last-Modified', http_date(-400 * 86400))],
+     -HEURISTIC_LIMIT - 100, False),
+])
+def test_is_fresh(pairs, stored, fresh):
+    meta = {'headers': [list(pair) for pair in pairs],
+            'stored': EPOCH + stored}
+
+    assert is_fresh(meta, EPOCH) == fresh
+
+
+@pytest.mark.parametrize('method, code, request_headers, pairs, length, ok', [
+    (b'GET', 200, [], [], 100, True),
+    (b'GET', 200, [], [], UNKNOWN_LENGTH, True),
+    (b'GET', 404, [], [], 100, True),
+    (b'HEAD', 200, [], [], 100, False),
+    (b'POST', 200, [], [], 100, False),
+    (b'GET', 206, [], [], 100, False),
+    (b'GET', 500, [], [], 100, False),
+
+    # Explicitly not to be stored.
+    (b'GET', 200, [], [('Cache-Control', 'no-store')], 100, False),
+
+    # Authorized responses only when marked public.
+    (b'GET', 200, [('Authorization', 'Basic eDp5')], [], 100, False),
+    (b'GET', 200, [('Authorization', 'Basic eDp5')],
+     [('Cache-Control', 'public')], 100, True),
+
+    # We only vary by the encoding, which we never ask for.
+    (b'GET', 200, [], [('Vary', 'Accept-Encoding')], 100, True),
+    (b'GET', 200, [], [('Vary', 'Cookie')], 100, False),
+    (b'GET', 200, [], [('Vary', 'accept-encoding, User-Agent')], 100, False),
+
+    # Too large for the cache.
+    (b'GET', 200, [], [], ENTRY_LIMIT, True),
+    (b'GET', 200, [], [], ENTRY_LIMIT + 1, False),
+])
+def test_storable(method, code, request_headers, pairs, length, ok):
+    request = SimpleNamespace(method=method,
+                              requestHeaders=headers(request_headers))
+    response = SimpleNamespace(code=code, headers=headers(pairs),
+                               length=length)
+
+    assert CachingProxy().storable(request, response) == ok
+
+
+def test_refresh(monkeypatch):
+    monkeypatch.setattr(module, 'time', lambda: EPOCH)
+
+    meta = {
+        'url': 'http://example.com/',
+        'code': 200,
+        'stored': EPOCH - 100,
+        'headers': [['ETag', '"a"'], ['Cache-Control', 'max-age=60'],
+                    ['Content-Type', 'text/html']],
+    }
+
+    response = SimpleNamespace(headers=headers([
+        ('Cache-Control', 'max-age=300'), ('ETag', '"b"'),
+        ('Connection', 'close'), ('Date', http_date(0)),
+    ]))
+
+    # Updated headers stay in place, new ones go last, hop-by-hop ones
+    # are not kept at all.
+    assert refresh(meta, response) == dict(meta, stored=EPOCH, headers=[
+        ['ETag', '"b"'], ['Cache-Control', 'max-age=300'],
+        ['Content-Type', 'text/html'], ['Date', http_date(0)],
+    ])
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,191 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import Clock
+
+import pytest
+
+# The scheduler imports the items of the decoder engine.
+gi = pytest.importorskip('gi')
+gi.require_version('Gtk', '3.0')
+gi.require_version('Gdk', '3.0')
+gi.require_version('WebKit2', '4.0')
+gi.require_version('Gst', '1.0')
+
+from telescreen.scheduler import Scheduler, ItemScheduler
+from telescreen import metrics
+
+
+# Fixed virtual time the tests start at.
+EPOCH = 1500000000
+
+
+class StubItem:
+    """
+    Item that only remembers what it was asked to do.
+    """
+
+    def __init__(self, url, zone='main'):
+        self.url = url
+        self.zone = zone
+        self.origin = url
+        self.hints = None
+        self.playing = False
+
+    def prepare(self, screen):
+        pass
+
+    def start(self):
+        self.playing = True
+
+    def stop(self):
+        self.playing = False
+
+    def on_rendered(self):
+        pass
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    clock.advance(EPOCH)
+    return clock
+
+
+@pytest.fixture
+def scheduler(clock):
+    types = {'video': StubItem, 'image': StubItem, 'stream': StubItem}
+    scheduler = ItemScheduler(None, types, clock)
+    scheduler.recorded = []
+    scheduler.on_item_event = \
+        lambda item, event: scheduler.recorded.append((item.url, event))
+    return scheduler
+
+
+def task(start, end, url, kind='video'):
+    return {'start': start, 'end': end, 'type': kind, 'url': url}
+
+
+def test_no_frame_before_start(scheduler, clock):
+    scheduler.change_plan([task(EPOCH + 10, EPOCH + 20, 'http://a/')])
+    item, = scheduler.tasks
+
+    # The decoder reports a frame of an item prerolled but not started.
+    item.on_rendered()
+    clock.advance(5)
+    scheduler.reset()
+
+    assert ('http://a/', 'frame') not in scheduler.recorded
+
+
+def test_frame_after_start(scheduler, clock):
+    scheduler.change_plan([task(EPOCH + 10, EPOCH + 20, 'http://a/')])
+    item, = scheduler.tasks
+
+    clock.advance(10)
+    item.on_rendered()
+
+    assert scheduler.recorded == [('http://a/', 'start'),
+                                  ('http://a/', 'frame')]
+
+
+def test_error_without_reason(scheduler, clock):
+    scheduler.change_plan([task(EPOCH + 10, EPOCH + 20, 'http://a/')])
+    item, = scheduler.tasks
+
+    errors = []
+    scheduler.on_item_error = \
+        lambda item, error: errors.append((item.url, error))
+
+    # Decoders may fail without telling us why.
+    item.on_error()
+    item.on_error('Not found')
+
+    assert errors == [('http://a/', ''), ('http://a/', 'Not found')]
+
+
+def test_continue_within_playing_item(scheduler, clock):
+    scheduler.change_plan([
+        task(EPOCH + 10, EPOCH + 100, 'http://s/', 'stream'),
+        task(EPOCH + 20, EPOCH + 50, 'http://s/', 'stream'),
+    ])
+
+    clock.advance(100)
+
+    assert scheduler.recorded == [('http://s/', 'start'),
+                                  ('http://s/', 'continue'),
+                                  ('http://s/', 'stop')]
+
+
+def test_continue_extends_playing_item(scheduler, clock):
+    scheduler.change_plan([
+        task(EPOCH + 10, EPOCH + 20, 'http://s/', 'stream'),
+        task(EPOCH + 20, EPOCH + 30, 'http://s/', 'stream'),
+    ])
+
+    clock.advance(20)
+    item, = scheduler.tasks
+
+    clock.advance(10)
+
+    assert scheduler.recorded == [('http://s/', 'start'),
+                                  ('http://s/', 'continue'),
+                                  ('http://s/', 'stop')]
+    assert not item.playing
+
+
+def test_lateness_of_past_events(clock, monkeypatch):
+    monkeypatch.setattr(metrics, 'histograms', {})
+    scheduler = Scheduler(clock)
+
+    # Power entry from hours ago, its timer runs half a second late.
+    scheduler.add_event(EPOCH - 3 * 3600, lambda: None)
+    clock.advance(0.5)
+
+    # Item that starts in a while, right on time.
+    scheduler.add_event(EPOCH + 10, lambda: None)
+    clock.advance(9.5)
+
+    lateness = metrics.histogram('scheduler.lateness')
+    assert lateness.count == 2
+    assert lateness.max == 0.5
+
+
+class RecordingScheduler (Scheduler):
+    """
+    Scheduler that only remembers the tasks it was asked to schedule.
+    """
+
+    def __init__(self, clock):
+        super().__init__(clock)
+        self.scheduled = []
+
+    def schedule_task(self, task):
+        self.scheduled.append(task['url'])
+
+    def stop_task(self, task):
+        pass
+
+
+def test_change_plan_keeps_position(clock):
+    scheduler = RecordingScheduler(clock)
+    tasks = [
+        task(EPOCH + 10, EPOCH + 20, 'http://a/'),
+        task(EPOCH + 50, EPOCH + 70, 'http://b/'),
+        task(EPOCH + 120, EPOCH + 130, 'http://c/'),
+    ]
+
+    scheduler.change_plan(tasks)
+    assert scheduler.scheduled == ['http://a/', 'http://b/']
+
+    # Same near future, nothing is scheduled twice.
+    clock.advance(30)
+    scheduler.change_plan(tasks + [task(EPOCH + 300, EPOCH + 310, 'd')])
+    assert scheduler.scheduled == ['http://a/', 'http://b/']
+
+    clock.advance(40)
+    scheduler.schedule()
+    assert scheduler.scheduled == ['http://a/', 'http://b/', 'http://c/']
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,64 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from jsonschema import validate, ValidationError
+
+from telescreen import schema
+
+import pytest
+
+
+def plan_message(duration):
+    return {
+        'id': '0' * 32,
+        'type': 'plan',
+        'plan': {
+            'id': '1' * 32,
+            'items': [],
+            'layouts': [],
+            'power': [],
+            'loops': [{
+                'days': [0, 1, 2, 3, 4],
+                'from': 8 * 3600,
+                'to': 18 * 3600,
+                'items': [{
+                    'type': 'image',
+                    'url': 'http://example.com/a.png',
+                    'duration': duration,
+                }],
+            }],
+        },
+    }
+
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch, tmp_path):
+    # Keep the cached copy of the schema away from /var/cache.
+    monkeypatch.setattr(schema, 'CACHE_PATH', str(tmp_path / 'schema.json'))
+    monkeypatch.setattr(schema, 'cache', {})
+
+
+def test_plan_with_loop():
+    schema.validator().validate(plan_message(10))
+
+
+def test_loop_item_needs_positive_duration():
+    with pytest.raises(ValidationError):
+        schema.validator().validate(plan_message(0))
+
+
+def test_schema_pins_its_draft():
+    # Generic validation picks the draft from the schema itself.
+    validate(plan_message(10), schema.schema())
+
+    with pytest.raises(ValidationError):
+        validate(plan_message(0), schema.schema())
+
+
+def test_cached_schema():
+    first = schema.schema()
+    schema.cache.clear()
+    assert schema.schema() == first
+
+
+# vim:set sw=4 ts=4 et:
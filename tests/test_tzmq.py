@@ -0,0 +1,193 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from time import time, sleep
+from uuid import uuid4
+
+from telescreen import tzmq as module
+from telescreen.tzmq import Router
+
+import pytest
+import zmq
+
+
+# How long to wait for the I/O threads, in seconds.
+TIMEOUT = 5
+
+
+class Reactor:
+    """
+    Stand-in for the reactor that only collects the calls.
+
+    The tests run the calls themselves, one reactor iteration at a time.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, fn, *args):
+        self.calls.append((fn, args))
+
+    def callLater(self, delay, fn, *args):
+        self.calls.append((fn, args))
+
+    def iterate(self):
+        calls, self.calls = self.calls, []
+
+        for fn, args in calls:
+            fn(*args)
+
+        return len(calls)
+
+
+def wait_until(predicate):
+    deadline = time() + TIMEOUT
+
+    while not predicate():
+        assert time() < deadline, 'Timed out waiting for the I/O thread'
+        sleep(0.01)
+
+
+@pytest.fixture
+def reactor(monkeypatch):
+    reactor = Reactor()
+    monkeypatch.setattr(module, 'reactor', reactor)
+    return reactor
+
+
+@pytest.fixture
+def pair(reactor):
+    address = 'inproc://test-' + uuid4().hex
+    identity = 'server-' + uuid4().hex
+
+    server = Router(identity=identity)
+    server.bind(address)
+    server.received = []
+    server.on_message = lambda message, sender: \
+        server.received.append(message['n'])
+
+    client = Router(default_recipient=identity)
+    client.connect(address)
+
+    # Make sure the client knows the server before counting anything.
+    n = 0
+
+    while not server.status()['received']:
+        client.send({'n': n})
+        n -= 1
+        sleep(0.05)
+
+    while reactor.iterate():
+        pass
+
+    yield server, client
+
+    client.shutdown()
+    server.shutdown()
+
+
+def send(client, server, count):
+    """
+    Send numbered messages and wait for the last one to arrive.
+    """
+
+    before = server.status()['received']
+
+    for n in range(1, count + 1):
+        client.send({'n': n})
+
+    wait_until(lambda: server.status()['received'] == before + count)
+
+
+def test_queue_limit(pair, reactor, monkeypatch):
+    server, client = pair
+    monkeypatch.setattr(module, 'QUEUE_LIMIT', 5)
+
+    send(client, server, 12)
+
+    # The reactor has not been around, the oldest messages are gone.
+    status = server.status()
+    assert status['depth'] == 5
+    assert status['max_depth'] == 5
+    assert status['dropped'] == 7
+
+    reactor.iterate()
+    assert server.received[-5:] == [8, 9, 10, 11, 12]
+
+
+def test_budget(pair, reactor, monkeypatch):
+    server, client = pair
+    monkeypatch.setattr(module, 'BUDGET', 3)
+    server.received = []
+
+    send(client, server, 7)
+
+    # A single drain is scheduled, no matter how many messages arrive.
+    assert len(reactor.calls) == 1
+
+    chunks = []
+
+    while reactor.iterate():
+        chunks.append(list(server.received))
+        server.received = []
+
+    assert chunks == [[1, 2, 3], [4, 5, 6], [7]]
+
+
+def test_drain_rescheduled(pair, reactor):
+    server, client = pair
+    server.received = []
+
+    send(client, server, 1)
+    assert len(reactor.calls) == 1
+
+    reactor.iterate()
+    assert server.received == [1]
+    assert not server.scheduled
+    assert reactor.calls == []
+
+    # Once drained, the next message asks for another drain.
+    send(client, server, 1)
+    assert len(reactor.calls) == 1
+
+    reactor.iterate()
+    assert server.received == [1, 1]
+
+
+def test_request_error(reactor):
+    router = Router()
+
+    try:
+        with pytest.raises(zmq.ZMQError):
+            router.bind('bogus://nowhere')
+
+        # The thread carries on with other requests.
+        router.bind('inproc://test-' + uuid4().hex)
+        assert router.thread.is_alive()
+
+    finally:
+        router.shutdown()
+
+
+def test_request_after_thread_failed(reactor):
+    router = Router()
+
+    def fail(pipe):
+        raise RuntimeError('Broken pipe handling')
+
+    router.serve = fail
+
+    with pytest.raises(zmq.ZMQError):
+        router.connect('inproc://test-' + uuid4().hex)
+
+    # The failure is reported through the reactor.
+    router.thread.join(TIMEOUT)
+    assert [fn for fn, args in reactor.calls] == [router.err]
+
+    with pytest.raises(zmq.ZMQError):
+        router.connect('inproc://test-' + uuid4().hex)
+
+    router.shutdown()
+
+
+# vim:set sw=4 ts=4 et: